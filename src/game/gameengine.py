@@ -30,6 +30,13 @@ class ActorState(StatProvider):
 
         self.status_effects = {}  # StatusEffectType -> turns remaining
 
+        # (stat_type, local) -> stat_value, for the current equipment, status effects and debug settings.
+        # the base stats and the items' stats are assumed to never change.
+        self._stat_cache = {}
+        self._stat_cache_key = None  # (equipment grid, its version, insta kill)
+        self._stat_cache_hits = 0
+        self._stat_cache_misses = 0
+
         self.current_hp = self.max_hp()
         self.current_energy = 0
 
@@ -48,6 +55,20 @@ class ActorState(StatProvider):
                     yield ItemActionProvider(item, action_provider)
 
     def stat_value(self, stat_type, local=False):
+        equip_grid = self.inventory().get_equip_grid()
+        insta_kill = self.is_player() and debug.insta_kill()
+        cache_key = (equip_grid, equip_grid.get_version(), insta_kill)
+        if cache_key != self._stat_cache_key:
+            self._stat_cache.clear()
+            self._stat_cache_key = cache_key
+
+        stat_key = (stat_type, local)
+        if stat_key in self._stat_cache:
+            self._stat_cache_hits += 1
+            return self._stat_cache[stat_key]
+
+        self._stat_cache_misses += 1
+
         res = self.base_stats.stat_value(stat_type, local=local)
         for item in self.inventory().all_equipped_items():
             res += item.stat_value(stat_type, local=local)
@@ -55,11 +76,16 @@ class ActorState(StatProvider):
         for status_effect in self.status_effects:
             res += status_effect.stat_value(stat_type, local=local)
 
-        if self.is_player() and debug.insta_kill() and stat_type == StatTypes.ATT:
+        if insta_kill and stat_type == StatTypes.ATT:
             res += 99
 
+        self._stat_cache[stat_key] = res
         return res
 
+    def get_stat_cache_counts(self):
+        """returns: (hits, misses) of stat_value's cache"""
+        return (self._stat_cache_hits, self._stat_cache_misses)
+
     def get_att_value_with_active_weapon(self):
         if self.is_player(): # enemies can't use weapons... (yet?)
             active_action = gs.get_instance().get_targeting_action_provider()
@@ -217,6 +243,7 @@ class ActorState(StatProvider):
                 del self.status_effects[eff]
 
             self.status_effects[effect] = duration
+            self._stat_cache.clear()
             return True
 
     def get_turns_remaining(self, status_effect):
@@ -240,6 +267,7 @@ class ActorState(StatProvider):
 
             if expired:
                 del self.status_effects[e]
+                self._stat_cache.clear()
 
                 if e == statuseffects.StatusEffectTypes.FLINCHED:
                     add_flinch_recovery = True
@@ -253,6 +281,7 @@ class ActorState(StatProvider):
 
     def clear_all_status_effects(self):
         self.status_effects.clear()
+        self._stat_cache.clear()
 
 
 class ActorController:
@@ -433,15 +462,13 @@ class EnemyController(ActorController):
             p = world.get_player()
             if p is not None:
                 p_pos = world.to_grid_coords(*p.center())
-                path = world.get_path_between(pos, p_pos, max_length=balance.ENEMY_SMART_PATHING_RANGE,
-                                              cond=lambda xy: (xy == p_pos or xy == pos
-                                                               or not world.is_solid(*xy, including_entities=True)))
-                if path is not None and len(path) >= 2:
-                    res = MoveToAction(actor, path[1])
+                step = world.get_step_towards(pos, p_pos, balance.ENEMY_SMART_PATHING_RANGE)
+                if step is not None:
+                    res = MoveToAction(actor, step)
                     if res.is_possible(world):
                         return res
                     else:
-                        print("WARN: world gave {} an impossible path? {}".format(actor, path))
+                        print("WARN: world gave {} an impossible step? {} -> {}".format(actor, pos, step))
 
         # if hidden, avoid stepping next to doors
         # (so that the player can't get instagibbed as they open a door)
@@ -1,3 +1,5 @@
+import os
+import time
 import pygame
 import traceback
 
@@ -10,7 +12,15 @@ DEFAULT_SCREEN_SIZE = (800, 600)
 MINIMUM_SCREEN_SIZE = (800, 600)
 
 
-def init(name_of_game):
+def init(name_of_game, headless=False):
+    """
+        headless: bool -- if True, runs without a window, sound, or gl context (see renderengine/headless.py).
+    """
+    if headless:
+        # these have to be set before pygame initializes
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
     print("INFO: pygame version: " + pygame.version.ver)
     print("INFO: initializing sounds...")
     pygame.mixer.pre_init(44100, -16, 1, 2048)
@@ -28,51 +38,40 @@ def init(name_of_game):
     pygame.display.set_icon(window_icon)
 
     from src.game.windowstate import WindowState
-    WindowState.create_instance(window_size=DEFAULT_SCREEN_SIZE, min_size=MINIMUM_SCREEN_SIZE)
+    WindowState.create_instance(window_size=DEFAULT_SCREEN_SIZE, min_size=MINIMUM_SCREEN_SIZE, headless=headless)
     WindowState.get_instance().set_caption(name_of_game)
     WindowState.get_instance().show()
 
     from src.renderengine.engine import RenderEngine
-    render_eng = RenderEngine.create_instance()
+    render_eng = RenderEngine.create_instance(headless=headless)
     render_eng.init(*DEFAULT_SCREEN_SIZE)
     render_eng.set_min_size(*MINIMUM_SCREEN_SIZE)
+    render_eng.set_stats_enabled(debug.is_dev())
 
-    raw_sheet = pygame.image.load(Utils.resource_path("assets/image.png"))
-    cine_img = pygame.image.load(Utils.resource_path("assets/cinematics.png"))
-    ui_img = pygame.image.load(Utils.resource_path("assets/ui.png"))
-    items_img = pygame.image.load(Utils.resource_path("assets/items.png"))
-    boss_img = pygame.image.load(Utils.resource_path("assets/bosses.png"))
-    cave_horror_img = pygame.image.load(Utils.resource_path("assets/cave_horror.png"))
-    font_img = pygame.image.load(Utils.resource_path("assets/font.png"))
-    animation_img = pygame.image.load(Utils.resource_path("assets/animations.png"))
-    title_scene_img = pygame.image.load(Utils.resource_path("assets/title_scene.png"))
-
-    img_surface = spriteref.build_spritesheet(raw_sheet, cine_img, ui_img, items_img, boss_img, cave_horror_img,
-                                              font_img, animation_img, title_scene_img)
+    atlas_pages = spriteref.load_spritesheet()
 
-    texture_data = pygame.image.tostring(img_surface, "RGBA", 1)
-    width = img_surface.get_width()
-    height = img_surface.get_height()
-    render_eng.set_texture(texture_data, width, height)
+    render_eng.set_textures([(pygame.image.tostring(page, "RGBA", 1), page.get_width(), page.get_height())
+                             for page in atlas_pages])
 
     COLOR = True
     SORTS = True
+    CULL_CELL_SIZE = constants.CELLSIZE
     render_eng.add_layer(
         spriteref.FLOOR_LAYER,
         "floors", 0,
-        False, COLOR)
+        False, COLOR, cull_cell_size=CULL_CELL_SIZE)
     render_eng.add_layer(
         spriteref.SHADOW_LAYER,
         "shadow_layer", 5,
-        False, COLOR)
+        False, COLOR, cull_cell_size=CULL_CELL_SIZE)
     render_eng.add_layer(
         spriteref.WALL_LAYER,
         "walls", 10,
-        False, COLOR)
+        False, COLOR, cull_cell_size=CULL_CELL_SIZE)
     render_eng.add_layer(
         spriteref.ENTITY_LAYER,
         "entities", 15,
-        SORTS, COLOR)
+        SORTS, COLOR, cull_cell_size=CULL_CELL_SIZE)
     render_eng.add_layer(
         spriteref.UI_0_LAYER,
         "ui_0", 20,
@@ -129,7 +128,14 @@ def _calc_pixel_scale(screen_size, px_scale_opt=None, max_scale=4):
         return int(px_scale_opt)
 
 
-def run():
+def run(max_frames=None, scripted_input=None, uncapped=False):
+    """
+        max_frames: int -- if not None, the game exits after this many frames.
+        scripted_input: map of frame number -> list of pygame events to post at the start of that frame.
+        uncapped: bool -- if True, the frame rate isn't limited to 60 fps (for benchmarking).
+        returns: list of the duration of each frame in seconds, if max_frames or scripted_input was given.
+                 otherwise an empty list.
+    """
     # importing is fragile (-_-)
     import src.game.events as events
     import src.game.sound_effects as sound_effects
@@ -143,13 +149,22 @@ def run():
     from src.game.inputs import InputState
 
     world_view = None
+    render_stats_overlay = None
 
     clock = pygame.time.Clock()
     running = True
 
     ignore_resize_events_next_tick = False
 
+    frame_idx = 0
+    frame_times = []  # only recorded when benchmarking, so that it doesn't grow forever during normal play
+    record_frame_times = max_frames is not None or scripted_input is not None
+    frame_start = time.perf_counter()
+
     while running:
+        if scripted_input is not None and frame_idx in scripted_input:
+            for py_event in scripted_input[frame_idx]:
+                pygame.event.post(py_event)
 
         # processing "global" events
         gs.get_instance().global_event_queue().flip()
@@ -346,6 +361,24 @@ def run():
             import src.utils.profiling as profiling
             profiling.get_instance().toggle()
 
+        if debug.is_dev() and input_state.was_pressed(pygame.K_F3):
+            # shows where render time goes, per layer
+            if render_stats_overlay is None:
+                import src.ui.ui as ui
+                render_stats_overlay = ui.RenderStatsOverlay()
+            else:
+                render_stats_overlay.cleanup()
+                render_stats_overlay = None
+
+        if debug.is_dev() and input_state.was_pressed(pygame.K_F2):
+            stats = RenderEngine.get_instance().get_stats()
+            if stats is not None:
+                import src.game.pathutils as pathutils
+                context = stats.get_context()
+                filename = "render_stats_{}".format(context if context is not None else "menus")
+                stats.save_to_disk(str(pathutils.get_save_data_path(with_subpath="render_stats/")), filename,
+                                   context=context)
+
         if debug.is_dev() and world_active and input_state.was_pressed(pygame.K_F6):
             gs.get_instance().menu_manager().set_active_menu(menus.DebugMenu())
             sound_effects.play_sound(soundref.pause_in)
@@ -384,22 +417,42 @@ def run():
 
         gs.get_instance().menu_manager().update()
 
+        stats = RenderEngine.get_instance().get_stats()
+        if stats is not None:
+            stats.set_context(gs.get_instance().get_zone_id() if world_active else None)
+
+        if render_stats_overlay is not None:
+            render_stats_overlay.update()
+            RenderEngine.get_instance().update(render_stats_overlay)
+
         RenderEngine.get_instance().render_layers()
 
         pygame.display.flip()
 
         slo_mo_mode = debug.is_dev() and input_state.is_held(pygame.K_TAB)
-        if slo_mo_mode:
+        if uncapped:
+            clock.tick()
+        elif slo_mo_mode:
             clock.tick(15)
         else:
             clock.tick(60)
 
+        frame_end = time.perf_counter()
+        if record_frame_times:
+            frame_times.append(frame_end - frame_start)
+        frame_start = frame_end
+        frame_idx += 1
+
+        if max_frames is not None and frame_idx >= max_frames:
+            running = False
+
         gs.get_instance().increment_tick_counts()
 
         if gs.get_instance().tick_counter % 60 == 0:
             if clock.get_fps() < 55 and debug.is_dev() and not slo_mo_mode:
-                print("WARN: fps drop: {} ({} sprites)".format(round(clock.get_fps() * 10) / 10.0,
-                                                               RenderEngine.get_instance().count_sprites()))
+                print("WARN: fps drop: {} ({} sprites, {} drawn)".format(round(clock.get_fps() * 10) / 10.0,
+                                                                         RenderEngine.get_instance().count_sprites(),
+                                                                         RenderEngine.get_instance().count_drawn_sprites()))
 
     print("INFO: saving game data before exit...")
     gs.get_instance().save_current_game_to_disk_softly()
@@ -409,3 +462,5 @@ def run():
 
     print("INFO: quitting skeletris")
     pygame.quit()
+
+    return frame_times
@@ -16,6 +16,7 @@ class ItemGrid:
         self._grid_type = grid_type
 
         self._dirty = False
+        self._version = 0  # incremented whenever an item is placed or removed. unlike _dirty, it's never reset
     
     def can_place(self, item, pos, allow_replace=False):
         if item in self.items:
@@ -61,11 +62,15 @@ class ItemGrid:
 
     def set_clean(self):
         self._dirty = False
+
+    def get_version(self):
+        return self._version
         
     def place(self, item, pos):
         if self.can_place(item, pos, allow_replace=False):
             self.items[item] = pos
             self._dirty = True
+            self._version += 1
             return True
         return False
             
@@ -95,6 +100,7 @@ class ItemGrid:
         if item in self.items:
             del self.items[item]
             self._dirty = True
+            self._version += 1
             return True
         return False
 
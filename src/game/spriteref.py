@@ -1,12 +1,20 @@
 import pygame
 import math
+import numpy
+import os
+import time
+import pathlib
+import hashlib
+import traceback
 
 from enum import Enum
 
 from src.items.cubeutils import CubeUtils
 from src.utils.util import Utils
+import src.game.pathutils as pathutils
 
 from src.renderengine.img import ImageModel 
+import src.renderengine.atlas as atlas
 
 FLOOR_LAYER = 0
 SHADOW_LAYER = 5
@@ -727,13 +735,20 @@ def get_cooldown_img(progress):
 def _draw_cd_image(sheet, rect, prog, color):
     c_x = rect[0] + rect[2] / 2
     c_y = rect[1] + rect[3] / 2
-    for x in range(rect[0], rect[0] + rect[2]):
-        for y in range(rect[1], rect[1] + rect[3]):
-            if x % 2 == y % 2:
-                continue
-            angle_prog = (math.atan2(c_y - y, c_x - x) + math.pi) / (2 * math.pi)
-            if angle_prog > prog:
-                sheet.set_at((x, y), color)
+
+    # arrays are indexed [x, y], same as surfarray
+    xs, ys = numpy.meshgrid(numpy.arange(rect[0], rect[0] + rect[2]),
+                            numpy.arange(rect[1], rect[1] + rect[3]), indexing="ij")
+    angle_prog = (numpy.arctan2(c_y - ys, c_x - xs) + math.pi) / (2 * math.pi)
+    mask = (xs % 2 != ys % 2) & (angle_prog > prog)
+
+    # these lock the sheet until they're deleted
+    rgb = pygame.surfarray.pixels3d(sheet)[rect[0]:rect[0] + rect[2], rect[1]:rect[1] + rect[3]]
+    alpha = pygame.surfarray.pixels_alpha(sheet)[rect[0]:rect[0] + rect[2], rect[1]:rect[1] + rect[3]]
+    rgb[mask] = color[0:3]
+    alpha[mask] = color[3] if len(color) > 3 else 255
+    del rgb
+    del alpha
 
 
 def _draw_dark_floor(sheet, darkness, src_rect, dest_rect):
@@ -741,19 +756,18 @@ def _draw_dark_floor(sheet, darkness, src_rect, dest_rect):
 
     MAX_CHANGE = 224
 
-    for x in range(dest_rect[0], dest_rect[0] + dest_rect[2]):
-        for y in range(dest_rect[1], dest_rect[1] + dest_rect[3]):
-            rgb = list(sheet.get_at((x, y)))
-            for i in range(0, 3):
-                val = rgb[i] / 255
-                new_val = (1 - darkness) * val ** (1 / (1 - darkness))
-                new_val = max(val - MAX_CHANGE, new_val)
-                rgb[i] = int(255 * new_val)
-            sheet.set_at((x, y), rgb)
+    x, y, w, h = dest_rect
+    rgb = pygame.surfarray.pixels3d(sheet)[x:x + w, y:y + h]
+    vals = rgb / 255
+    new_vals = (1 - darkness) * vals ** (1 / (1 - darkness))
+    new_vals = numpy.maximum(vals - MAX_CHANGE, new_vals)
+    rgb[:] = (255 * new_vals).astype(numpy.uint8)  # truncates, like int()
+    del rgb
 
 
-def build_cine_sheet(start_pos, raw_cine_img, sheet):
-    sheet.blit(raw_cine_img, start_pos)
+def build_cine_sheet(start_pos, raw_cine_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_cine_img, start_pos)
 
     cs = Cinematics
     cs.blank = cs.convert([(4, 0)], start_pos)
@@ -768,8 +782,9 @@ def build_cine_sheet(start_pos, raw_cine_img, sheet):
     cs.frog_body = cs.convert([(4, 2), (5, 2)], start_pos)
 
 
-def build_items_sheet(start_pos, raw_item_img, sheet):
-    sheet.blit(raw_item_img, start_pos)
+def build_items_sheet(start_pos, raw_item_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_item_img, start_pos)
     Items.piece_small = make(96, 80, 4, 4, shift=start_pos)
     Items.piece_small_inverted = make(100, 80, 4, 4, shift=start_pos)
     Items.piece_bigs = [make(112 + i * 16, 80, 16, 16, shift=start_pos) for i in range(0, 6)]
@@ -821,14 +836,16 @@ def build_items_sheet(start_pos, raw_item_img, sheet):
     Items.slingshot_icon = make(50, 90, 10, 10, shift=start_pos)
 
 
-def build_title_scene_sheet(start_pos, raw_title_scene_img, sheet):
-    sheet.blit(raw_title_scene_img, start_pos)
+def build_title_scene_sheet(start_pos, raw_title_scene_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_title_scene_img, start_pos)
 
     TitleScene.frames = [make(i * 200, 0, 200, 150, shift=start_pos) for i in range(0, 2)]
 
 
-def build_ui_sheet(start_pos, raw_ui_img, sheet):
-    sheet.blit(raw_ui_img, start_pos)
+def build_ui_sheet(start_pos, raw_ui_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_ui_img, start_pos)
 
     UI.inv_panel_top = make(0, 0, 160, 128, shift=start_pos)
     UI.inv_panel_mid = make(0, 128, 160, 16, shift=start_pos)
@@ -911,8 +928,9 @@ def build_ui_sheet(start_pos, raw_ui_img, sheet):
     UI.Cursors.init_cursors(sheet)
 
 
-def build_boss_sheet(start_pos, raw_boss_img, sheet):
-    sheet.blit(raw_boss_img, start_pos)
+def build_boss_sheet(start_pos, raw_boss_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_boss_img, start_pos)
 
     Bosses.robo_idle = [make(i * 64, 320, 64, 80, shift=start_pos) for i in range(0, 2)]
 
@@ -931,15 +949,17 @@ def build_boss_sheet(start_pos, raw_boss_img, sheet):
     Bosses.infected_husk_idle = [make(0 + i * 16, 464, 16, 48, shift=start_pos) for i in range(0, 8)]
 
 
-def build_cave_horror_sheet(start_pos, raw_cave_horror_img, sheet):
-    sheet.blit(raw_cave_horror_img, start_pos)
+def build_cave_horror_sheet(start_pos, raw_cave_horror_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_cave_horror_img, start_pos)
 
     CaveHorror.cave_horror_idle = [make(i * 256, 0, 256, 240, shift=start_pos) for i in range(0, 2)]
     CaveHorror.cave_horror_dead = [make(i * 256, 240, 256, 240, shift=start_pos) for i in range(0, 2)]
 
 
-def build_animations_sheet(start_pos, raw_animations_img, sheet):
-    sheet.blit(raw_animations_img, start_pos)
+def build_animations_sheet(start_pos, raw_animations_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_animations_img, start_pos)
 
     Animations.explosions = [make(i * 16, 0, 16, 16, shift=start_pos) for i in range(0, 8)]
     Animations.sleeping_zees = [make(i * 16, 16, 16, 16, shift=start_pos) for i in range(0, 8)]
@@ -949,8 +969,9 @@ def build_animations_sheet(start_pos, raw_animations_img, sheet):
     Animations.player_absorb_all = [make((i % 8) * 32, 128 + (i // 8) * 32, 32, 32, shift=start_pos) for i in range(0, 24)]
 
 
-def build_font_sheet(start_pos, raw_font_img, sheet):
-    sheet.blit(raw_font_img, start_pos)
+def build_font_sheet(start_pos, raw_font_img, sheet, draw=True):
+    if draw:
+        sheet.blit(raw_font_img, start_pos)
     # sheet needs to be a 32x8 grid of characters
     char_w = round(raw_font_img.get_width() / 32)
     char_h = round(raw_font_img.get_height() / 8)
@@ -960,9 +981,40 @@ def build_font_sheet(start_pos, raw_font_img, sheet):
             Font._alphabet[c] = make(x * char_w, y * char_h, char_w, char_h, shift=start_pos)
 
 
+_n_static_imgs = None  # how many of all_imgs were made at import time, before the sheet was first built
+
+
+def _reset_generated_sprites():
+    """
+        forgets the sprites made by a previous build_spritesheet, so that the next build starts from the same
+        state as the first one. the tables it fills in place are emptied here, and the ImageModels it made are
+        dropped from all_imgs. everything else it sets (e.g. the attributes of UI and Items) is replaced outright.
+    """
+    global _n_static_imgs
+    if _n_static_imgs is None:
+        _n_static_imgs = len(all_imgs)
+        return
+
+    del all_imgs[_n_static_imgs:]
+
+    for wall_type in _wall_types:
+        wall_type[0][:] = [None] * len(wall_type[0])
+
+    for key in [key for key in _floor_lookup if key[2] != 0]:
+        del _floor_lookup[key]
+
+    Items.item_entities.clear()
+    EffectCircles.sprites.clear()
+    Font._alphabet.clear()
+    UI.health_bars_with_length = []
+    cooldown_overlays.clear()
+
+
 def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_boss_img, raw_cave_horror_img,
-                      raw_font_img, raw_animations_img, raw_title_scene_img):
+                      raw_font_img, raw_animations_img, raw_title_scene_img, cached_sheet=None):
     """
+        cached_sheet: Surface -- a previously built sheet. If provided, the sprites are laid out
+            on top of it without drawing anything, which skips all the procedural generation.
         returns: Surface
         Here's how the final sheet is arranged:
         *-------------------------------*
@@ -986,6 +1038,8 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
 
     """
     global walls
+    _reset_generated_sprites()
+
     right_imgs = [raw_cine_img, raw_ui_img, raw_items_img, raw_boss_img, raw_cave_horror_img, raw_font_img,
                   raw_animations_img, raw_title_scene_img]
 
@@ -994,42 +1048,46 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
     sheet_size = (sheet_w, sheet_h)
     left_size = (raw_image.get_width(), sheet_size[1])
 
-    sheet = pygame.Surface(sheet_size, pygame.SRCALPHA, 32)
-    sheet.fill((255, 255, 255, 0))
-    sheet.blit(raw_image, (0, 0))
+    draw = cached_sheet is None
+    if draw:
+        sheet = pygame.Surface(sheet_size, pygame.SRCALPHA, 32)
+        sheet.fill((255, 255, 255, 0))
+        sheet.blit(raw_image, (0, 0))
+    else:
+        sheet = cached_sheet
 
     _x = raw_image.get_width()
     _y = 0
     print("INFO: building cinematics sheet...")
-    build_cine_sheet((_x, _y), raw_cine_img, sheet)
+    build_cine_sheet((_x, _y), raw_cine_img, sheet, draw=draw)
     _y += raw_cine_img.get_height()
 
     print("INFO: building ui sheet...")
-    build_ui_sheet((_x, _y), raw_ui_img, sheet)
+    build_ui_sheet((_x, _y), raw_ui_img, sheet, draw=draw)
     _y += raw_ui_img.get_height()
 
     print("INFO: building items sheet...")
-    build_items_sheet((_x, _y), raw_items_img, sheet)
+    build_items_sheet((_x, _y), raw_items_img, sheet, draw=draw)
     _y += raw_items_img.get_height()
 
     print("INFO: building boss sheet...")
-    build_boss_sheet((_x, _y), raw_boss_img, sheet)
+    build_boss_sheet((_x, _y), raw_boss_img, sheet, draw=draw)
     _y += raw_boss_img.get_height()
 
     print("INFO: building cave_horror sheet...")
-    build_cave_horror_sheet((_x, _y), raw_cave_horror_img, sheet)
+    build_cave_horror_sheet((_x, _y), raw_cave_horror_img, sheet, draw=draw)
     _y += raw_cave_horror_img.get_height()
 
     print("INFO: building animations sheet...")
-    build_animations_sheet((_x, _y), raw_animations_img, sheet)
+    build_animations_sheet((_x, _y), raw_animations_img, sheet, draw=draw)
     _y += raw_animations_img.get_height()
 
     print("INFO: building font sheet...")
-    build_font_sheet((_x, _y), raw_font_img, sheet)
+    build_font_sheet((_x, _y), raw_font_img, sheet, draw=draw)
     _y += raw_font_img.get_height()
 
     print("INFO: building title_scene sheet...")
-    build_title_scene_sheet((_x, _y), raw_title_scene_img, sheet)
+    build_title_scene_sheet((_x, _y), raw_title_scene_img, sheet, draw=draw)
     _y += raw_title_scene_img.get_height()
 
     draw_y = raw_image.get_height()
@@ -1055,10 +1113,11 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
             if key in dupe_preventer:
                 wall_array[i] = dupe_preventer[key]
             else:
-                sheet.blit(raw_image, (draw_x, draw_y), tl)
-                sheet.blit(raw_image, (draw_x + 8, draw_y), tr)
-                sheet.blit(raw_image, (draw_x, draw_y + 8), bl)
-                sheet.blit(raw_image, (draw_x + 8, draw_y + 8), br)
+                if draw:
+                    sheet.blit(raw_image, (draw_x, draw_y), tl)
+                    sheet.blit(raw_image, (draw_x + 8, draw_y), tr)
+                    sheet.blit(raw_image, (draw_x, draw_y + 8), bl)
+                    sheet.blit(raw_image, (draw_x + 8, draw_y + 8), br)
                 model = make(draw_x, draw_y, 16, 16)
                 wall_array[i] = model
                 dupe_preventer[key] = model
@@ -1082,9 +1141,10 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
         h = 1
 
         for c in item:
-            dest = (draw_x + c[0]*4, draw_y + c[1]*4)
-            piece_rect = Items.piece_small.rect()
-            sheet.blit(sheet, dest, piece_rect)
+            if draw:
+                dest = (draw_x + c[0]*4, draw_y + c[1]*4)
+                piece_rect = Items.piece_small.rect()
+                sheet.blit(sheet, dest, piece_rect)
 
             w = max(c[0] + 1, w)
             h = max(c[1] + 1, h)
@@ -1121,9 +1181,10 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
                     draw_x = 0
                     draw_y += h
                 rect = [draw_x, draw_y, w, h]
-                opacity = 1 - frame / (circle_art_num_frames - 1)
-                generator = EffectCircles.get_generator(circle_type)
-                generator.draw(sheet, rect, frame / circle_art_num_frames, opacity=opacity)
+                if draw:
+                    opacity = 1 - frame / (circle_art_num_frames - 1)
+                    generator = EffectCircles.get_generator(circle_type)
+                    generator.draw(sheet, rect, frame / circle_art_num_frames, opacity=opacity)
 
                 EffectCircles.sprites[circle_type][h].append(make(rect[0], rect[1], rect[2], rect[3]))
 
@@ -1141,7 +1202,8 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
             draw_x = 0
             draw_y += cd_size
         rect = [draw_x, draw_y, cd_size, cd_size]
-        _draw_cd_image(sheet, rect, i / n_cooldowns, cd_color)
+        if draw:
+            _draw_cd_image(sheet, rect, i / n_cooldowns, cd_color)
         cooldown_overlays.append(make(*rect))
         draw_x += cd_size
 
@@ -1163,7 +1225,8 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
                     draw_y += src_r[3]
                     dest_r = [draw_x, draw_y, src_r[2], src_r[3]]
 
-                _draw_dark_floor(sheet, darkness / floor_darkness_resolution, src_r, dest_r)
+                if draw:
+                    _draw_dark_floor(sheet, darkness / floor_darkness_resolution, src_r, dest_r)
                 _floor_lookup[(floor_id, encoding, darkness)] = make(dest_r[0], dest_r[1], dest_r[2], dest_r[3])
                 draw_x += dest_r[2]
 
@@ -1176,6 +1239,160 @@ def build_spritesheet(raw_image, raw_cine_img, raw_ui_img, raw_items_img, raw_bo
     return sheet
 
 
+"""Source images, in the order build_spritesheet takes them."""
+SOURCE_IMAGES = ["assets/image.png", "assets/cinematics.png", "assets/ui.png", "assets/items.png",
+                 "assets/bosses.png", "assets/cave_horror.png", "assets/font.png", "assets/animations.png",
+                 "assets/title_scene.png"]
+
+"""Code that affects what the built sheet looks like. Changing any of these invalidates the cache."""
+_GENERATOR_SOURCES = ["src/game/spriteref.py", "src/items/cubeutils.py", "src/utils/geometricgen.py"]
+
+# bump this to force cached sheets to be rebuilt (e.g. if the generators change in a packaged build)
+SHEET_CACHE_VERSION = 1
+
+_SHEET_CACHE_DIR = "cache/"
+_SHEET_CACHE_IMG = "spritesheet.png"
+_SHEET_CACHE_INFO = "spritesheet.json"
+
+
+def _get_sheet_cache_key():
+    """returns: hex digest of the source images, generator code and cache version"""
+    hasher = hashlib.sha1()
+    hasher.update(str(SHEET_CACHE_VERSION).encode("utf-8"))
+    for path in SOURCE_IMAGES + _GENERATOR_SOURCES:
+        hasher.update(path.encode("utf-8"))
+        try:
+            with open(Utils.resource_path(path), "rb") as f:
+                hasher.update(f.read())
+        except OSError:
+            # packaged builds don't ship the .py files, but their code can't change either.
+            pass
+    return hasher.hexdigest()
+
+
+def _get_sheet_cache_paths():
+    cache_dir = pathutils.get_save_data_path(with_subpath=_SHEET_CACHE_DIR)
+    return pathlib.Path(cache_dir, _SHEET_CACHE_IMG), pathlib.Path(cache_dir, _SHEET_CACHE_INFO)
+
+
+def _try_to_load_cached_sheet(cache_key):
+    """returns: (Surface, info_blob), or (None, None) if there's no valid cached sheet"""
+    img_path, info_path = _get_sheet_cache_paths()
+    if not img_path.exists() or not info_path.exists():
+        print("INFO: no cached spritesheet found at {}".format(img_path))
+        return None, None
+
+    try:
+        info = Utils.load_json_from_path(str(info_path))
+        if info.get("key") != cache_key:
+            print("INFO: cached spritesheet is stale")
+            return None, None
+
+        sheet = pygame.image.load(str(img_path))
+        if list(sheet.get_size()) != info["size"]:
+            print("WARN: cached spritesheet has size {}, expected {}".format(sheet.get_size(), info["size"]))
+            return None, None
+
+        return sheet, info
+    except Exception:
+        print("ERROR: failed to load cached spritesheet")
+        traceback.print_exc()
+        return None, None
+
+
+def _try_to_save_cached_sheet(cache_key, sheet, build_time):
+    img_path, info_path = _get_sheet_cache_paths()
+    info = {
+        "key": cache_key,
+        "size": list(sheet.get_size()),
+        "rects": [list(img.rect()) for img in all_imgs],
+        "build_time": build_time
+    }
+    try:
+        Utils.save_json_to_path(info, str(info_path))
+        pygame.image.save(sheet, str(img_path))
+        print("INFO: saved spritesheet to cache at {}".format(img_path))
+    except Exception:
+        print("ERROR: failed to save spritesheet to cache")
+        traceback.print_exc()
+
+        # don't leave a half-written cache behind
+        for path in (info_path, img_path):
+            try:
+                if path.exists():
+                    os.remove(str(path))
+            except OSError:
+                pass
+
+
+# must not be larger than GL_MAX_TEXTURE_SIZE, which is at least 2048 on anything that can run GLSL 1.20
+ATLAS_PAGE_SIZE = (2048, 2048)
+
+
+def build_atlas_pages(sheet, page_size=ATLAS_PAGE_SIZE):
+    """
+        copies every sprite on the (mostly empty) built sheet onto a few smaller texture pages,
+        and moves the ImageModels to their new spots.
+        returns: list of Surfaces, one per page
+    """
+    layout = atlas.AtlasLayout(page_size).pack([img.rect() for img in all_imgs])
+
+    pages = []
+    for i in range(0, layout.num_pages()):
+        page = pygame.Surface(layout.get_page_size(i), pygame.SRCALPHA, 32)
+        page.fill((255, 255, 255, 0))
+        pages.append(page)
+
+    locations = layout.all_locations()
+    for rect in locations:
+        page_idx, x, y = locations[rect]
+        if rect[2] > 0 and rect[3] > 0:
+            pages[page_idx].blit(sheet, (x, y), rect)
+
+    for img in all_imgs:
+        page_idx, x, y = locations[tuple(img.rect())]
+        img.set_atlas_location(page_idx, x, y, pages[page_idx].get_size())
+
+    for line in layout.get_report(sheet.get_size()):
+        print("INFO: atlas {}".format(line))
+
+    return pages
+
+
+def load_spritesheet(use_cache=True):
+    """
+        loads the source images and builds the spritesheet, skipping the procedural generation
+        if a cached copy of the sheet (with the same source images and code) exists on disk.
+        returns: list of Surfaces, the pages of the atlas (see build_atlas_pages)
+    """
+    start_time = time.time()
+    raw_imgs = [pygame.image.load(Utils.resource_path(path)) for path in SOURCE_IMAGES]
+
+    cache_key = _get_sheet_cache_key() if use_cache else None
+    cached_sheet, cached_info = _try_to_load_cached_sheet(cache_key) if use_cache else (None, None)
+
+    if cached_sheet is not None:
+        sheet = build_spritesheet(*raw_imgs, cached_sheet=cached_sheet)
+
+        if [list(img.rect()) for img in all_imgs] == cached_info["rects"]:
+            load_time = time.time() - start_time
+            print("INFO: loaded cached spritesheet in {}ms (building it took {}ms)".format(
+                int(1000 * load_time), int(1000 * cached_info.get("build_time", 0))))
+            return build_atlas_pages(sheet)
+        else:
+            # build_spritesheet resets everything the first build made before drawing the new sheet
+            print("WARN: cached spritesheet's layout doesn't match, rebuilding it")
+
+    sheet = build_spritesheet(*raw_imgs)
+    build_time = time.time() - start_time
+    print("INFO: built spritesheet in {}ms".format(int(1000 * build_time)))
+
+    if use_cache:
+        _try_to_save_cached_sheet(cache_key, sheet, build_time)
+
+    return build_atlas_pages(sheet)
+
+
 if __name__ == "__main__":
     import os
     raw = pygame.image.load(Utils.resource_path("assets/image.png"))
@@ -1191,4 +1408,7 @@ if __name__ == "__main__":
 
     print("INFO: created {} sprites".format(len(all_imgs)))
     pygame.image.save(output, os.path.join("src", "spritesheet.png"))
+
+    for page_idx, page_img in enumerate(build_atlas_pages(output)):
+        pygame.image.save(page_img, os.path.join("src", "spritesheet_page_{}.png".format(page_idx)))
     
@@ -6,27 +6,34 @@ _INSTANCE = None
 
 class WindowState:
 
-    def __init__(self, window_size, min_size=(0, 0)):
+    def __init__(self, window_size, min_size=(0, 0), headless=False):
         self._is_fullscreen = False
         self._window_size = window_size
         self._min_size = min_size
+        self._headless = headless  # if True, there's no real window or gl context
 
         self._cached_fullscreen_size = None
 
     @staticmethod
-    def create_instance(window_size=(640, 480), min_size=(0, 0)):
+    def create_instance(window_size=(640, 480), min_size=(0, 0), headless=False):
 
         global _INSTANCE
         if _INSTANCE is not None:
             raise ValueError("WindowState instance is already created")
         else:
-            _INSTANCE = WindowState(window_size, min_size=min_size)
+            _INSTANCE = WindowState(window_size, min_size=min_size, headless=headless)
 
     @staticmethod
     def get_instance():
         return _INSTANCE
 
+    def is_headless(self):
+        return self._headless
+
     def _get_mods(self):
+        if self._headless:
+            return 0
+
         mods = pygame.OPENGL | pygame.DOUBLEBUF | pygame.HWSURFACE | pygame.RESIZABLE
 
         if self.is_fullscreen():
@@ -339,8 +339,7 @@ class SpriteItem(Item):
     def get_big_img(self, scale, layer_id, input_img=None):
         if input_img is None:
             input_img = img.ImageBundle.new_bundle(layer_id, scale=scale)
-        input_img.update(new_model=self.big_sprite())
-        return input_img
+        return input_img.update(new_model=self.big_sprite())
 
     def rotate(self):
         if not self.can_rotate():
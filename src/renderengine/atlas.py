@@ -0,0 +1,138 @@
+"""
+Packs the sprites of a (large, mostly empty) staging sheet into a few fixed-size texture pages.
+Only the geometry lives here; spriteref copies the pixels and moves the ImageModels.
+"""
+
+
+class AtlasPage:
+
+    def __init__(self, size):
+        self.size = size
+        self.used_area = 0
+        self.used_height = 0  # the bottom of the lowest shelf
+
+        self._shelves = []  # list of [y, height, next free x]
+
+    def fill_ratio(self):
+        return self.used_area / (self.size[0] * self.size[1])
+
+    def try_to_place(self, w, h):
+        """returns: (x, y) of the spot reserved for a w x h rect, or None if it doesn't fit on this page."""
+        for shelf in self._shelves:
+            if h <= shelf[1] and shelf[2] + w <= self.size[0]:
+                res = (shelf[2], shelf[0])
+                shelf[2] += w
+                self.used_area += w * h
+                return res
+
+        if self.used_height + h <= self.size[1] and w <= self.size[0]:
+            self._shelves.append([self.used_height, h, w])
+            res = (0, self.used_height)
+            self.used_height += h
+            self.used_area += w * h
+            return res
+
+        return None
+
+
+class AtlasLayout:
+
+    def __init__(self, page_size, padding=0):
+        """
+            page_size: (int, int) -- size of each page. must not exceed the gl context's max texture size.
+            padding: int -- empty pixels to leave around each rect
+        """
+        self.page_size = page_size
+        self.padding = padding
+        self.pages = []
+
+        self._locations = {}  # source rect -> (page, x, y)
+
+    def pack(self, rects):
+        """
+            rects: list of (x, y, w, h) rects on the staging sheet. rects that share a top left corner
+                   are packed as one (their bounding box), since they're usually prefixes of the same
+                   sprite (e.g. health bars of different lengths).
+            returns: self
+        """
+        groups = {}  # (x, y) -> (w, h) of the group's bounding box
+        for rect in rects:
+            w, h = groups.get((rect[0], rect[1]), (0, 0))
+            groups[(rect[0], rect[1])] = (max(w, rect[2]), max(h, rect[3]))
+
+        # shelf packing works best with the tallest rects first
+        order = sorted(groups.keys(), key=lambda xy: (-groups[xy][1], -groups[xy][0], xy))
+
+        pad = self.padding
+        group_locations = {}
+        for xy in order:
+            w, h = groups[xy]
+            if w <= 0 or h <= 0:
+                group_locations[xy] = (0, 0, 0)
+                continue
+            if w + 2 * pad > self.page_size[0] or h + 2 * pad > self.page_size[1]:
+                raise ValueError("rect at {} of size {} doesn't fit on a page of size {}".format(
+                    xy, (w, h), self.page_size))
+
+            group_locations[xy] = self._place(w + 2 * pad, h + 2 * pad)
+
+        for rect in rects:
+            page, x, y = group_locations[(rect[0], rect[1])]
+            self._locations[tuple(rect)] = (page, x + pad, y + pad)
+
+        return self
+
+    def _place(self, w, h):
+        for i, page in enumerate(self.pages):
+            xy = page.try_to_place(w, h)
+            if xy is not None:
+                return (i, xy[0], xy[1])
+
+        self.pages.append(AtlasPage(self.page_size))
+        xy = self.pages[-1].try_to_place(w, h)
+        return (len(self.pages) - 1, xy[0], xy[1])
+
+    def get_location(self, rect):
+        """returns: (page, x, y) of the rect's top left corner in the atlas."""
+        return self._locations[tuple(rect)]
+
+    def all_locations(self):
+        """returns: map of source rect -> (page, x, y)"""
+        return self._locations
+
+    def num_pages(self):
+        return len(self.pages)
+
+    def get_page_size(self, page, trim=True):
+        """
+            trim: bool -- whether the last page should be cut down to the height it actually uses.
+            returns: (w, h) of the page's texture
+        """
+        if trim and page == len(self.pages) - 1:
+            return (self.page_size[0], max(1, self.pages[page].used_height))
+        else:
+            return self.page_size
+
+    def total_bytes(self, bytes_per_pixel=4):
+        res = 0
+        for i in range(0, self.num_pages()):
+            w, h = self.get_page_size(i)
+            res += w * h * bytes_per_pixel
+        return res
+
+    def get_report(self, orig_size, bytes_per_pixel=4):
+        """
+            orig_size: (int, int) -- size of the monolithic sheet the atlas replaces
+            returns: list of lines describing how full each page is and how much memory was saved.
+        """
+        lines = []
+        for i, page in enumerate(self.pages):
+            w, h = self.get_page_size(i)
+            lines.append("page {}: {}x{}, {:.1f}% full".format(i, w, h, 100 * page.used_area / (w * h)))
+
+        orig_bytes = orig_size[0] * orig_size[1] * bytes_per_pixel
+        new_bytes = self.total_bytes(bytes_per_pixel=bytes_per_pixel)
+        lines.append("{} pages use {:.1f}MB, vs. {:.1f}MB for the {}x{} sheet ({:.1f}MB saved)".format(
+            self.num_pages(), new_bytes / 2**20, orig_bytes / 2**20, orig_size[0], orig_size[1],
+            (orig_bytes - new_bytes) / 2**20))
+        return lines
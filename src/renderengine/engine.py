@@ -2,10 +2,16 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 
 import numpy
+import bisect
+import ctypes
 import math
 import re
+import time
 import traceback
 
+import src.renderengine.img as img
+from src.renderengine.stats import RenderStats
+
 
 def assert_int(val):
     if not isinstance(val, int):
@@ -19,35 +25,347 @@ def pad_or_trunc(l, length):
         return l[:length]
 
 
-def remove_all_in_place(l, elements):
-    if len(l) == 0:
-        return l
+class _DepthOrder:
+    """
+        keeps a layer's image ids sorted by descending depth between frames. most sprites don't change
+        depth from one frame to the next, so only the ones that did are taken out and re-inserted.
+    """
 
-    rem_set = set(elements)
-    last_element = len(l) - 1
-    i = 0
+    def __init__(self):
+        self.uids = []   # image ids, in draw order
+        self._keys = []  # -depth of each image in uids (so it's ascending)
+        self._depths = {}  # image id -> depth
 
-    while i <= last_element:
-        if l[i] in rem_set:
-            while i <= last_element and l[last_element] in rem_set:
-                last_element -= 1
-            if i > last_element:
-                break
-            else:
-                l[i] = l[last_element]
-                last_element -= 1
-        i += 1
+    def __len__(self):
+        return len(self.uids)
+
+    def apply(self, removed, updated):
+        """
+            removed: image ids to drop.
+            updated: image id -> depth, for new images and images whose depth may have changed.
+            returns: True if the order changed.
+        """
+        removed = [uid for uid in removed if uid in self._depths]
+        moved = {}
+        for uid in updated:
+            if uid not in self._depths or self._depths[uid] != updated[uid]:
+                moved[uid] = updated[uid]
+
+        n_changes = len(removed) + len(moved)
+        if n_changes == 0:
+            return False
+        elif n_changes > max(16, len(self.uids) // 4):
+            self._resort(removed, moved)
+        else:
+            for uid in removed:
+                self._pop(uid)
+            for uid in moved:
+                if uid in self._depths:
+                    self._pop(uid)
+            for uid in moved:
+                self._insert(uid, moved[uid])
+        return True
+
+    def _pop(self, uid):
+        key = -self._depths.pop(uid)
+        lo = bisect.bisect_left(self._keys, key)
+        hi = bisect.bisect_right(self._keys, key)
+        idx = self.uids.index(uid, lo, hi)
+        del self.uids[idx]
+        del self._keys[idx]
+
+    def _insert(self, uid, depth):
+        # goes after other images with the same depth, like a stable sort would put it
+        idx = bisect.bisect_right(self._keys, -depth)
+        self.uids.insert(idx, uid)
+        self._keys.insert(idx, -depth)
+        self._depths[uid] = depth
+
+    def _resort(self, removed, moved):
+        """used when too much changed for re-inserting to be worth it."""
+        for uid in removed:
+            del self._depths[uid]
+        self._depths.update(moved)
+
+        kept = [uid for uid in self.uids if uid in self._depths and uid not in moved]
+        kept.extend(moved)
+        kept.sort(key=lambda uid: -self._depths[uid])
+
+        self.uids[:] = kept
+        self._keys[:] = [-self._depths[uid] for uid in kept]
+
+
+class _CullGrid:
+    """
+        buckets a layer's sprites by the grid cell containing their top left corner, so the sprites
+        near the camera can be found without checking every sprite in the layer.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self._cells = {}  # (cell_x, cell_y) -> set of image ids
+        self._uid_to_cell = {}  # image id -> (cell_x, cell_y)
+        self._margin = 0  # largest sprite dimension seen, which is how far a sprite can reach out of its cell
+
+    def __len__(self):
+        return len(self._uid_to_cell)
+
+    def update(self, uid, x, y, w, h):
+        self._margin = max(self._margin, w, h)
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        old_cell = self._uid_to_cell.get(uid, None)
+        if old_cell == cell:
+            return
+        elif old_cell is not None:
+            self._remove_from_cell(uid, old_cell)
+
+        self._uid_to_cell[uid] = cell
+        if cell not in self._cells:
+            self._cells[cell] = set()
+        self._cells[cell].add(uid)
+
+    def remove(self, uid):
+        old_cell = self._uid_to_cell.pop(uid, None)
+        if old_cell is not None:
+            self._remove_from_cell(uid, old_cell)
+
+    def _remove_from_cell(self, uid, cell):
+        uids = self._cells[cell]
+        uids.discard(uid)
+        if len(uids) == 0:
+            del self._cells[cell]
+
+    def query(self, rect):
+        """returns: list of image ids of sprites that might overlap rect."""
+        cs = self.cell_size
+        x1 = int((rect[0] - self._margin) // cs)
+        y1 = int((rect[1] - self._margin) // cs)
+        x2 = int((rect[0] + rect[2]) // cs)
+        y2 = int((rect[1] + rect[3]) // cs)
+
+        res = []
+        if (x2 - x1 + 1) * (y2 - y1 + 1) < len(self._cells):
+            for cx in range(x1, x2 + 1):
+                for cy in range(y1, y2 + 1):
+                    if (cx, cy) in self._cells:
+                        res.extend(self._cells[(cx, cy)])
+        else:
+            for cell in self._cells:
+                if x1 <= cell[0] <= x2 and y1 <= cell[1] <= y2:
+                    res.extend(self._cells[cell])
+        return res
+
+
+class _GLState:
+    """
+        remembers which buffers are bound so redundant binds can be skipped, and counts the gl calls
+        made while rendering (the frame stats report the count for each layer). the glGetError checks
+        in printOpenGLError aren't counted, since they're debugging overhead rather than rendering work.
+    """
+
+    def __init__(self):
+        self.n_calls = 0
+        self._bound = {}  # target -> buffer id
+
+    def count(self, n=1):
+        self.n_calls += n
+
+    def bind_buffer(self, target, buf_id):
+        if self._bound.get(target) != buf_id:
+            glBindBuffer(target, buf_id)
+            self._bound[target] = buf_id
+            self.n_calls += 1
+
+    def forget_buffers(self, buf_ids):
+        """should be called when buffers are deleted, since gl unbinds them (and may reuse their ids)."""
+        for target in self._bound:
+            if self._bound[target] in buf_ids:
+                self._bound[target] = 0
+
+    def reset(self):
+        """forgets the cached state, for when the gl context was replaced."""
+        self._bound.clear()
+
+
+GL_STATE = _GLState()
+
+
+class _QuadIndices:
+    """
+        the triangle indices for a run of quads only depend on how many quads there are,
+        so every layer draws from slices of this one (growing) array.
+    """
+
+    QUAD = numpy.array([0, 1, 2, 0, 2, 3], dtype=numpy.uint32)
+
+    def __init__(self):
+        self._indices = numpy.array([], dtype=numpy.uint32)
+        self._gpu_buf = None
+        self._gpu_size = 0  # number of indices currently in the gpu buffer
+
+    def capacity(self):
+        return len(self._indices) // 6
+
+    def get(self, n_sprites):
+        """returns: uint32 array of the 6 * n_sprites indices needed to draw n_sprites quads."""
+        if n_sprites > self.capacity():
+            new_capacity = max(n_sprites, 2 * self.capacity(), 256)
+            base = 4 * numpy.arange(new_capacity, dtype=numpy.uint32)
+            self._indices = (base[:, None] + _QuadIndices.QUAD).reshape(-1)
+        return self._indices[:6 * n_sprites]
+
+    def bind_gpu_buffer(self, n_sprites):
+        """binds an element buffer holding (at least) the indices for n_sprites quads."""
+        self.get(n_sprites)
+        if self._gpu_buf is None:
+            self._gpu_buf = glGenBuffers(1)
+            self._gpu_size = 0
+
+        GL_STATE.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, self._gpu_buf)
+        if self._gpu_size < len(self._indices):
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self._indices.nbytes, self._indices, GL_STATIC_DRAW)
+            GL_STATE.count()
+            self._gpu_size = len(self._indices)
 
-    del l[(last_element+1):]
+    def discard_gpu_buffer(self):
+        self._gpu_buf = None
+        self._gpu_size = 0
+
+
+QUAD_INDICES = _QuadIndices()
+
+
+class _LayerBuffers:
+    """
+        GL buffer objects holding a layer's sprite data on the gpu, so that only the parts
+        that changed since the last frame need to be sent over.
+    """
+
+    def __init__(self):
+        self.vertex_buf = None
+        self.tex_coord_buf = None
+        self.color_buf = None
+
+        self.instance_buf = None  # only used by instanced layers
+        self.visible_instance_buf = None  # only used by instanced layers that cull
+        self.visible_index_buf = None  # only used by non-instanced layers that cull
+
+        self.n_sprites = -1  # the number of sprites the buffers are currently allocated for
+
+    def is_allocated(self):
+        return self.vertex_buf is not None or self.instance_buf is not None
+
+    def discard(self):
+        """forgets the buffers without deleting them, for when the gl context they belonged to is gone."""
+        self.vertex_buf = None
+        self.tex_coord_buf = None
+        self.color_buf = None
+        self.instance_buf = None
+        self.visible_instance_buf = None
+        self.visible_index_buf = None
+        self.n_sprites = -1
+
+    def delete(self):
+        to_delete = [buf for buf in (self.vertex_buf, self.tex_coord_buf, self.color_buf, self.instance_buf,
+                                     self.visible_instance_buf, self.visible_index_buf) if buf is not None]
+        if len(to_delete) > 0:
+            glDeleteBuffers(len(to_delete), to_delete)
+            GL_STATE.forget_buffers(to_delete)
+        self.discard()
+
+    def upload(self, layer, dirty_range):
+        """
+            layer: the _Layer whose data should be sent to the gpu.
+            dirty_range: (first_slot, last_slot + 1) of the sprites that changed, or None if nothing changed.
+        """
+        if layer.instanced:
+            self._upload_instances(layer, dirty_range)
+            return
+
+        n_sprites = layer.num_sprites()
+        if n_sprites == self.n_sprites and dirty_range is None:
+            return  # the gpu already has everything
+
+        if not self.is_allocated():
+            self.vertex_buf = glGenBuffers(1)
+            self.tex_coord_buf = glGenBuffers(1)
+            if layer.uses_color():
+                self.color_buf = glGenBuffers(1)
+
+        if n_sprites != self.n_sprites:
+            self._set_data(GL_ARRAY_BUFFER, self.vertex_buf, layer.vertices)
+            self._set_data(GL_ARRAY_BUFFER, self.tex_coord_buf, layer.tex_coords)
+            if layer.uses_color():
+                self._set_data(GL_ARRAY_BUFFER, self.color_buf, layer.colors)
+            self.n_sprites = n_sprites
+
+        elif dirty_range is not None:
+            lo, hi = dirty_range
+            self._set_sub_data(self.vertex_buf, layer.vertices, 8, lo, hi)
+            self._set_sub_data(self.tex_coord_buf, layer.tex_coords, 8, lo, hi)
+            if layer.uses_color():
+                self._set_sub_data(self.color_buf, layer.colors, 12, lo, hi)
+
+        printOpenGLError()
+
+    def _upload_instances(self, layer, dirty_range):
+        n_sprites = layer.num_sprites()
+        if n_sprites == self.n_sprites and dirty_range is None:
+            return
+
+        if not self.is_allocated():
+            self.instance_buf = glGenBuffers(1)
+
+        if n_sprites != self.n_sprites:
+            self._set_data(GL_ARRAY_BUFFER, self.instance_buf, layer.instances)
+            self.n_sprites = n_sprites
+        elif dirty_range is not None:
+            lo, hi = dirty_range
+            self._set_sub_data(self.instance_buf, layer.instances, img.INSTANCE_STRIDE, lo, hi)
+
+        printOpenGLError()
+
+    def upload_visible_instances(self, data):
+        """data: the records of just the sprites that are visible, which are drawn from their own buffer."""
+        if self.visible_instance_buf is None:
+            self.visible_instance_buf = glGenBuffers(1)
+        self._set_data(GL_ARRAY_BUFFER, self.visible_instance_buf, data, usage=GL_STREAM_DRAW)
+        printOpenGLError()
+
+    def upload_visible_indices(self, indices):
+        """indices: the element indices of just the sprites that are visible."""
+        if self.visible_index_buf is None:
+            self.visible_index_buf = glGenBuffers(1)
+        self._set_data(GL_ELEMENT_ARRAY_BUFFER, self.visible_index_buf, indices, usage=GL_STREAM_DRAW)
+        printOpenGLError()
+
+    @staticmethod
+    def _set_data(target, buf_id, data, usage=GL_DYNAMIC_DRAW):
+        GL_STATE.bind_buffer(target, buf_id)
+        glBufferData(target, data.nbytes, data if len(data) > 0 else None, usage)
+        GL_STATE.count()
+
+    @staticmethod
+    def _set_sub_data(buf_id, data, stride, lo, hi):
+        chunk = data[lo * stride:hi * stride]
+        GL_STATE.bind_buffer(GL_ARRAY_BUFFER, buf_id)
+        glBufferSubData(GL_ARRAY_BUFFER, lo * stride * data.itemsize, chunk.nbytes, chunk)
+        GL_STATE.count()
 
 
 class _Layer:
-    def __init__(self, name, layer_id, z_order, sort_sprites, use_color):
+    def __init__(self, name, layer_id, z_order, sort_sprites, use_color, batched=True, cull_cell_size=None,
+                 instanced=False):
         """
             name: str -- used for logging
             z_order: number -- used to decide layer draw order
             sort_sprites: bool -- true if layer should sort sprites by depth
             use_color: bool -- true if layer respects sprites' color value
+            batched: bool -- true if layer should fill its buffers with vectorized operations
+            cull_cell_size: int -- if not None, layer only draws sprites near the visible area, which it
+                                   finds by bucketing sprites into a grid of cells of this size
+            instanced: bool -- true if layer should store one record per sprite instead of four vertices,
+                               and draw them with instanced draw calls (see img.write_instances)
         """
         self.name = name
         self.layer_id = layer_id
@@ -56,13 +374,42 @@ class _Layer:
         self._offset = (0, 0)
         self._z_order = z_order
         self.sort_sprites = sort_sprites
+        self.batched = batched or instanced
+        self.instanced = instanced
 
         # these are the pointers the layer passes to gl
-        self.vertices = numpy.array([], dtype=float)
-        self.tex_coords = numpy.array([], dtype=float)
-        self.indices = numpy.array([], dtype=float)
-        self.colors = numpy.array([], dtype=float) if use_color else None
-        
+        self.vertices = numpy.array([], dtype=numpy.float32)
+        self.tex_coords = numpy.array([], dtype=numpy.float32)
+        self.indices = QUAD_INDICES.get(0)
+        self.colors = numpy.array([], dtype=numpy.float32) if use_color else None
+        self._use_color = use_color
+
+        # the pointer passed to gl instead of the above, for instanced layers
+        self.instances = numpy.array([], dtype=numpy.float32)
+
+        self.pages = numpy.array([], dtype=numpy.int32)  # the atlas page of each sprite
+
+        self._slots = {}  # image id -> index in buffers, only used when sprites aren't sorted
+        self._depth_order = _DepthOrder() if sort_sprites else None
+
+        self._gpu_buffers = _LayerBuffers()
+        self._gpu_dirty_range = None  # (first_slot, last_slot + 1) that changed since the last upload
+
+        self._cull_grid = _CullGrid(cull_cell_size) if cull_cell_size is not None else None
+        self._cull_key = None  # the state the visible sprites were last calculated for
+        self._culled_slots = None  # slots of the sprites that survived culling
+
+        # the sprites to draw, in draw order, or None if that's just every sprite in slot order
+        self._visible_slots = None
+        self._visible_indices = None
+
+        self._batches = []  # list of (page, first, count) runs of the draw order that share a page
+        self._batch_key = None  # the state the batches were last calculated for
+        self._visible_upload_key = None  # the batch key of the visible indices (or records) in the gpu
+        self._rebuild_count = 0
+        self._n_drawn = 0
+        self._upload_time = 0  # seconds spent sending data to the gpu during the last render
+
         self._dirty_sprites = []
         self._to_remove = []
         self._to_add = []
@@ -80,68 +427,347 @@ class _Layer:
         else:
             self._image_set.add(bundle_id)
             self._to_add.append(bundle_id)
+
+        if self._cull_grid is not None:
+            self._cull_grid.update(bundle_id, *img.sprite_table().bounds(bundle_id))
         
     def remove(self, bundle_id):
         assert_int(bundle_id)
         if bundle_id in self._image_set:
             self._image_set.remove(bundle_id)
             self._to_remove.append(bundle_id)
+
+            if self._cull_grid is not None:
+                self._cull_grid.remove(bundle_id)
         
     def is_dirty(self):
         return len(self._dirty_sprites) + len(self._to_add) + len(self._to_remove) > 0
+
+    def pending_changes(self):
+        """returns: (n_dirty, n_added, n_removed) bundle updates waiting for the next rebuild."""
+        return len(self._dirty_sprites), len(self._to_add), len(self._to_remove)
         
     def uses_color(self):
-        return self.colors is not None
+        return self._use_color
         
-    def rebuild(self, bundle_lookup): 
-        if len(self._to_remove) > 0:
-            for bun_id in self._to_remove:
-                if bun_id in self._image_set:
-                    self._image_set.remove(bun_id)
+    def rebuild(self, bundle_lookup):
+        if self.sort_sprites:
+            self._rebuild_sorted(bundle_lookup)
+            if self._cull_grid is not None:
+                self._slots = {uid: i for i, uid in enumerate(self.images)}
+        else:
+            self._rebuild_dirty_slots(bundle_lookup)
+        self._rebuild_count += 1
+
+    def _rebuild_sorted(self, bundle_lookup):
+        removed = [uid for uid in self._to_remove if uid not in self._image_set]
+        updated = {}
+        for uid in self._to_add:
+            if uid in self._image_set:
+                updated[uid] = bundle_lookup[uid].depth()
+        for uid in self._dirty_sprites:
+            if uid in self._image_set:
+                updated[uid] = bundle_lookup[uid].depth()
+
+        self._to_remove.clear()
+        self._to_add.clear()
+        self._dirty_sprites.clear()
 
-            remove_all_in_place(self.images, self._to_remove)
-            remove_all_in_place(self._to_add, self._to_remove)
-            self._to_remove.clear()
+        self._depth_order.apply(removed, updated)
+        self.images = self._depth_order.uids
 
-        if len(self._to_add) > 0:
-            self.images.extend(self._to_add)
-            self._to_add.clear()
+        n_sprites = len(self.images)
+        self._resize_buffers(n_sprites)
+        self._write_slots(bundle_lookup, range(0, n_sprites))
+        self._mark_gpu_dirty(0, n_sprites)
 
+    def _rebuild_dirty_slots(self, bundle_lookup):
+        """
+            each sprite keeps a stable slot in the buffers, so only the slots of added or changed sprites
+            need to be rewritten. removed sprites' slots are filled by moving the last sprite into them.
+        """
+        for uid in self._to_remove:
+            if uid in self._slots and uid not in self._image_set:
+                self._free_slot(uid)
+        self._to_remove.clear()
+
+        to_write = set()
+        n_before = len(self.images)
+        for uid in self._to_add:
+            if uid in self._image_set:
+                if uid not in self._slots:
+                    self._slots[uid] = len(self.images)
+                    self.images.append(uid)
+                to_write.add(uid)
+        self._to_add.clear()
+
+        for uid in self._dirty_sprites:
+            if uid in self._slots:
+                to_write.add(uid)
         self._dirty_sprites.clear()
-        
-        if self.sort_sprites:
-            self.images.sort(key=lambda x: -bundle_lookup[x].depth())
 
-        n_sprites = len(self.images)
+        if len(self.images) != n_before or self._buffer_capacity() != len(self.images):
+            self._resize_buffers(len(self.images))
+
+        slots = [self._slots[uid] for uid in to_write]
+        self._write_slots(bundle_lookup, slots)
+        if len(slots) > 0:
+            self._mark_gpu_dirty(min(slots), max(slots) + 1)
+
+    def _free_slot(self, uid):
+        slot = self._slots.pop(uid)
+        last_slot = len(self.images) - 1
+        if slot != last_slot:
+            last_uid = self.images[last_slot]
+            self.images[slot] = last_uid
+            self._slots[last_uid] = slot
+
+            self.pages[slot] = self.pages[last_slot]
+            if self.instanced:
+                self._copy_slot(self.instances, img.INSTANCE_STRIDE, last_slot, slot)
+            else:
+                self._copy_slot(self.vertices, 8, last_slot, slot)
+                self._copy_slot(self.tex_coords, 8, last_slot, slot)
+                if self.uses_color():
+                    self._copy_slot(self.colors, 12, last_slot, slot)
+            # indices depend only on the sprite count, so they don't need to move
+
+            self._mark_gpu_dirty(slot, slot + 1)
+
+        self.images.pop()
+
+    def _mark_gpu_dirty(self, lo, hi):
+        if self._gpu_dirty_range is None:
+            self._gpu_dirty_range = (lo, hi)
+        else:
+            self._gpu_dirty_range = (min(lo, self._gpu_dirty_range[0]), max(hi, self._gpu_dirty_range[1]))
+
+    @staticmethod
+    def _copy_slot(array, stride, src_slot, dest_slot):
+        array[dest_slot * stride:(dest_slot + 1) * stride] = array[src_slot * stride:(src_slot + 1) * stride]
+
+    def _buffer_capacity(self):
+        """returns: the number of sprites the buffers currently have room for."""
+        if self.instanced:
+            return len(self.instances) // img.INSTANCE_STRIDE
+        else:
+            return len(self.vertices) // 8
+
+    def _resize_buffers(self, n_sprites):
+        self.indices = QUAD_INDICES.get(n_sprites)
 
         # need refcheck to be false or else Pycharm's debugger can cause this to fail (due to holding a ref)
+        self.pages.resize(n_sprites, refcheck=False)
+        if self.instanced:
+            self.instances.resize(img.INSTANCE_STRIDE * n_sprites, refcheck=False)
+            return
+
         self.vertices.resize(8 * n_sprites, refcheck=False)
         self.tex_coords.resize(8 * n_sprites, refcheck=False)
-        self.indices.resize(6 * n_sprites, refcheck=False)
         if self.uses_color():
             self.colors.resize(4 * 3 * n_sprites, refcheck=False)
 
-        for i in range(0, n_sprites):
+    def _write_slots(self, bundle_lookup, slots):
+        if self.batched:
+            self._write_slots_batched(bundle_lookup, slots)
+        else:
+            self._write_slots_per_sprite(bundle_lookup, slots)
+
+    def _write_slots_per_sprite(self, bundle_lookup, slots):
+        for i in slots:
             bundle = bundle_lookup[self.images[i]]
             bundle.add_urself(
                     i,
                     self.vertices, 
                     self.tex_coords, 
-                    self.colors, 
-                    self.indices)
+                    self.colors)
+            self.pages[i] = bundle.model().page if bundle.model() is not None else 0
+
+    def _write_slots_batched(self, bundle_lookup, slots):
+        if len(slots) == 0:
+            return
+        elif isinstance(slots, range) and len(slots) == len(self.images):
+            uids = self.images
+        else:
+            uids = [self.images[i] for i in slots]
+        slots = numpy.fromiter(slots, dtype=numpy.int64, count=len(slots))
+        attrs = img.sprite_table().quad_attributes(uids)
+        self.pages[slots] = attrs["page"]
+        if self.instanced:
+            img.write_instances(slots, attrs, self.instances, use_color=self.uses_color())
+        else:
+            img.write_quads(slots, attrs, self.vertices, self.tex_coords, self.colors)
             
+    def is_culled(self):
+        return self._cull_grid is not None
+
+    def num_drawn(self):
+        """returns: the number of sprites that were sent to be drawn the last time the layer was rendered."""
+        return self._n_drawn
+
+    def num_culled(self):
+        return self.num_sprites() - self._n_drawn
+
+    def _update_visible_indices(self, engine):
+        game_w, game_h = engine.get_game_size()
+        key = (self._offset, game_w, game_h, self._rebuild_count)
+        if key == self._cull_key:
+            return
+        self._cull_key = key
+
+        rect = (self._offset[0], self._offset[1], game_w, game_h)
+        slots = numpy.fromiter((self._slots[uid] for uid in self._cull_grid.query(rect)), dtype=numpy.uint32)
+        slots.sort()  # keeps the draw order
+
+        self._culled_slots = slots
+        self._n_drawn = len(slots)
+
+    def _update_batches(self):
+        """
+            splits the draw order into runs of sprites on the same atlas page, so each run can be
+            drawn with its page's texture bound. sorted layers keep their depth order (and so may need
+            several runs per page), the others are simply grouped by page.
+        """
+        key = (self._cull_key, self._rebuild_count)
+        if key == self._batch_key:
+            return
+        self._batch_key = key
+
+        slots = self._culled_slots if self.is_culled() else None
+        pages = self.pages[:self.num_sprites()] if slots is None else self.pages[slots]
+
+        if len(pages) == 0 or pages.min() == pages.max():
+            self._batches = [(int(pages[0]) if len(pages) > 0 else 0, 0, len(pages))]
+        else:
+            if slots is None:
+                slots = numpy.arange(len(pages), dtype=numpy.uint32)
+            if not self.sort_sprites:
+                order = numpy.argsort(pages, kind="stable")
+                slots = slots[order]
+                pages = pages[order]
+            starts = numpy.concatenate(([0], numpy.flatnonzero(pages[1:] != pages[:-1]) + 1, [len(pages)]))
+            self._batches = [(int(pages[starts[i]]), int(starts[i]), int(starts[i + 1] - starts[i]))
+                             for i in range(0, len(starts) - 1)]
+
+        self._visible_slots = slots
+        if slots is None:
+            self._visible_indices = None
+        else:
+            self._visible_indices = (4 * slots[:, None] + _QuadIndices.QUAD).reshape(-1)
+
+    def _indices_to_draw(self):
+        return self._visible_indices if self._visible_indices is not None else self.indices
+
+    def update_visible_sprites(self, engine):
+        """finds which sprites will be drawn this frame, given the engine's screen size and the layer's offset."""
+        if self.is_culled():
+            self._update_visible_indices(engine)
+        else:
+            self._n_drawn = self.num_sprites()
+        self._update_batches()
+
+    def batches(self):
+        """returns: list of (page, first, count) runs of the draw order (see drawn_indices) that share a page."""
+        return self._batches
+
+    def drawn_indices(self):
+        """returns: the element indices of the sprites that will be drawn (6 per sprite)."""
+        return self._indices_to_draw()
+
     def render(self, engine):
+        self.update_visible_sprites(engine)
+
+        if engine.vbos_enabled():
+            self._render_from_buffers(engine)
+            return
+
+        self._upload_time = 0
+
         # split up like this to make it easier to find performance bottlenecks
-        self._set_client_states(True, engine)
+        self._set_client_states(engine)
         self._pass_attributes(engine)
-        self._draw_elements()
-        self._set_client_states(False, engine)
+        self._draw_elements(engine)
+
+    def _render_from_buffers(self, engine):
+        start = time.perf_counter()
+        self._gpu_buffers.upload(self, self._gpu_dirty_range)
+        self._gpu_dirty_range = None
+        self._upload_time = time.perf_counter() - start
+
+        if self._n_drawn == 0:
+            return
 
-    def _set_client_states(self, enable, engine):
-        engine.set_vertices_enabled(enable)
-        engine.set_texture_coords_enabled(enable)
+        if self.instanced:
+            self._draw_instances(engine)
+            return
+
+        self._set_client_states(engine)
+        self._bind_attribute_buffers(engine)
+        self._draw_bound_elements(engine)
+
+    def _visible_upload_needed(self):
+        """returns: whether the draw order changed since it was last sent to the gpu."""
+        if self._visible_upload_key != self._batch_key:
+            self._visible_upload_key = self._batch_key
+            return True
+        return False
+
+    def _draw_instances(self, engine):
+        if self._visible_slots is not None:
+            # the visible subset (or the page order) isn't contiguous, so it's gathered into its own buffer
+            if self._visible_upload_needed():
+                visible = self.instances.reshape(-1, img.INSTANCE_STRIDE)[self._visible_slots]
+                self._gpu_buffers.upload_visible_instances(visible)
+            buf = self._gpu_buffers.visible_instance_buf
+        else:
+            buf = self._gpu_buffers.instance_buf
+
+        engine.set_instances_enabled(True)
+        GL_STATE.bind_buffer(GL_ARRAY_BUFFER, buf)
+        for page, first, count in self._batches:
+            engine.bind_texture_page(page)
+            engine.set_instances(first=first)
+            engine.draw_instances(count)
+
+    def _bind_attribute_buffers(self, engine):
+        bufs = self._gpu_buffers
+        GL_STATE.bind_buffer(GL_ARRAY_BUFFER, bufs.vertex_buf)
+        engine.set_vertices(None)
+        GL_STATE.bind_buffer(GL_ARRAY_BUFFER, bufs.tex_coord_buf)
+        engine.set_texture_coords(None)
         if self.uses_color():
-            engine.set_colors_enabled(enable)
+            GL_STATE.bind_buffer(GL_ARRAY_BUFFER, bufs.color_buf)
+            engine.set_colors(None)
+
+    def _draw_bound_elements(self, engine):
+        if self._visible_indices is not None:
+            # the draw order only changes when the camera moves or the layer is rebuilt
+            if self._visible_upload_needed():
+                self._gpu_buffers.upload_visible_indices(self._visible_indices)
+            GL_STATE.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, self._gpu_buffers.visible_index_buf)
+        else:
+            QUAD_INDICES.bind_gpu_buffer(self.num_sprites())
+
+        for page, first, count in self._batches:
+            engine.bind_texture_page(page)
+            glDrawElements(GL_TRIANGLES, 6 * count, GL_UNSIGNED_INT, ctypes.c_void_p(6 * first * 4))
+            GL_STATE.count()
+
+    def discard_gpu_buffers(self):
+        self._gpu_buffers.discard()
+        self._gpu_dirty_range = None
+        self._visible_upload_key = None
+
+    def delete_gpu_buffers(self):
+        self._gpu_buffers.delete()
+        self._gpu_dirty_range = None
+        self._visible_upload_key = None
+
+    def _set_client_states(self, engine):
+        """the engine only makes the gl calls for states that differ from the previous layer's."""
+        engine.set_vertices_enabled(True)
+        engine.set_texture_coords_enabled(True)
+        engine.set_colors_enabled(self.uses_color())
 
     def _pass_attributes(self, engine):
         engine.set_vertices(self.vertices)
@@ -149,8 +775,12 @@ class _Layer:
         if self.uses_color():
             engine.set_colors(self.colors)
 
-    def _draw_elements(self):
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, self.indices)
+    def _draw_elements(self, engine):
+        indices = self._indices_to_draw()
+        for page, first, count in self._batches:
+            engine.bind_texture_page(page)
+            glDrawElements(GL_TRIANGLES, 6 * count, GL_UNSIGNED_INT, indices[6 * first:6 * (first + count)])
+            GL_STATE.count()
 
     def __len__(self):
         return len(self.images)   
@@ -164,6 +794,10 @@ class _Layer:
     def num_sprites(self):
         return len(self.images)
 
+    def last_upload_time(self):
+        """returns: seconds spent uploading to the gpu during the last render"""
+        return self._upload_time
+
 
 def printOpenGLError():
     err = glGetError()
@@ -238,11 +872,18 @@ class RenderEngine:
             return RenderEngine130()
 
     @staticmethod
-    def create_instance():
-        """intializes the RenderEngine singleton."""
+    def create_instance(headless=False):
+        """
+            intializes the RenderEngine singleton.
+            headless: bool -- if True, creates an engine that doesn't need a gl context (see headless.py).
+        """
         global _SINGLETON
         if _SINGLETON is not None:
             raise ValueError("There is already a RenderEngine initialized.")
+        elif headless:
+            import src.renderengine.headless as headless_module
+            _SINGLETON = headless_module.HeadlessRenderEngine()
+            return _SINGLETON
         else:
             vstring = glGetString(GL_VERSION)
             vstring = vstring.decode() if vstring is not None else None
@@ -271,18 +912,33 @@ class RenderEngine:
         self.ordered_layers = []
         self.shader = None
 
-        self.tex_id = None
+        self.tex_ids = []  # one texture per page of the atlas
+        self._bound_page = None
+
+        self.raw_texture_pages = []  # list of (data, width, height)
 
-        self.raw_texture_data = (None, 0, 0)  # data, width, height
+        self.use_vbos = True  # whether layers should keep their data in gpu buffers, if the context supports it
+        self._vbos_enabled = False
+
+        # whether layers should be drawn with instanced quads, if the context supports it (and vbos are enabled).
+        # src/utils/glcheck.py compares its output against the regular quad path.
+        self.use_instancing = True
+        self._instancing_enabled = False
+
+        self._stats = None  # RenderStats, if frame stats are being collected
+        self._last_frame_gl_calls = 0
         
-    def add_layer(self, layer_id, layer_name, z_order, sort_sprites, use_color):
-        l = _Layer(layer_name, layer_id, z_order, sort_sprites, use_color)
+    def add_layer(self, layer_id, layer_name, z_order, sort_sprites, use_color, cull_cell_size=None):
+        l = _Layer(layer_name, layer_id, z_order, sort_sprites, use_color, cull_cell_size=cull_cell_size,
+                   instanced=self.instancing_enabled())
         self.layers[layer_id] = l
         
         self.ordered_layers = list(self.layers.values())
         self.ordered_layers.sort(key=lambda x: x.z_order())
         
     def remove_layer(self, layer_id):
+        if self.vbos_enabled():
+            self.layers[layer_id].delete_gpu_buffers()
         del self.layers[layer_id]
         
         self.ordered_layers = list(self.layers.values())
@@ -302,6 +958,7 @@ class RenderEngine:
         for uid in self.bundles:
             for l in self.layers.values():
                 l.remove(uid)
+            self.bundles[uid].release()
         self.bundles.clear()
         
     def clear_bundles(self, bundles):
@@ -374,13 +1031,42 @@ class RenderEngine:
     def set_colors(self, data):
         raise NotImplementedError()
 
+    def set_instances_enabled(self, val):
+        raise NotImplementedError()
+
+    def set_instances(self, first=0):
+        raise NotImplementedError()
+
+    def draw_instances(self, n_sprites):
+        raise NotImplementedError()
+
     def get_shader(self):
         return self.shader
 
+    def buffers_supported(self):
+        """returns: whether the current gl context supports vertex buffer objects."""
+        return False
+
+    def vbos_enabled(self):
+        return self._vbos_enabled
+
+    def instancing_supported(self):
+        """returns: whether the current gl context supports instanced draw calls."""
+        return False
+
+    def instancing_enabled(self):
+        return self._instancing_enabled
+
     def init(self, w, h):
         glShadeModel(GL_FLAT)
         glClearColor(0.5, 0.5, 0.5, 0.0)
 
+        # instanced layers keep their records in buffers, so they need vbos too
+        self._vbos_enabled = self.use_vbos and self.buffers_supported()
+        self._instancing_enabled = self._vbos_enabled and self.use_instancing and self.instancing_supported()
+        print("INFO: vertex buffer objects enabled: {}".format(self._vbos_enabled))
+        print("INFO: instanced rendering enabled: {}".format(self._instancing_enabled))
+
         print("INFO: building shader for GLSL version: {}".format(self.get_glsl_version()))
         self.shader = self.build_shader()
         self.shader.begin()
@@ -399,31 +1085,64 @@ class RenderEngine:
         self.shader.begin()
         self.setup_shader()
 
-        img_data, w, h = self.raw_texture_data
-        if img_data is not None:
-            self.set_texture(img_data, w, h, tex_id=self.tex_id)
+        # the old buffers went away with the old context, so layers need to re-upload everything
+        for layer in self.layers.values():
+            layer.discard_gpu_buffers()
+        QUAD_INDICES.discard_gpu_buffer()
+        GL_STATE.reset()
+
+        if len(self.raw_texture_pages) > 0:
+            self.set_textures(self.raw_texture_pages, tex_ids=self.tex_ids)
 
-    def set_texture(self, img_data, width, height, tex_id=None):
+    def set_texture(self, img_data, width, height):
         """
             img_data: image data in string RGBA format.
         """
-        if tex_id is None:
-            tex_id = glGenTextures(1)
-            self.tex_id = tex_id
-
-        glBindTexture(GL_TEXTURE_2D, tex_id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, img_data)
+        self.set_textures([(img_data, width, height)])
+
+    def set_textures(self, pages, tex_ids=None):
+        """
+            pages: list of (img_data, width, height), one for each page of the atlas (see ImageModel.page).
+                   img_data is image data in string RGBA format.
+        """
+        if tex_ids is None:
+            if len(self.tex_ids) > 0:
+                glDeleteTextures(self.tex_ids)
+            tex_ids = [glGenTextures(1) for _ in pages]
+            self.tex_ids = tex_ids
+
+        for tex_id, (img_data, width, height) in zip(tex_ids, pages):
+            glBindTexture(GL_TEXTURE_2D, tex_id)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, img_data)
         glEnable(GL_TEXTURE_2D)
 
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
-        self.raw_texture_data = (img_data, width, height)
+        self.raw_texture_pages = list(pages)
+
+        self._bound_page = None
+        self.bind_texture_page(0)
+
+    def bind_texture_page(self, page):
+        """makes the given page's texture the one sprites are drawn from (if it isn't already)."""
+        if page == self._bound_page or page >= len(self.tex_ids):
+            return
+        glBindTexture(GL_TEXTURE_2D, self.tex_ids[page])
+        GL_STATE.count()
+        self._bound_page = page
 
         self.set_texture_internal()
 
+    def get_texture_size(self):
+        """returns: (w, h) of the currently bound page."""
+        if self._bound_page is None:
+            return (0, 0)
+        _, w, h = self.raw_texture_pages[self._bound_page]
+        return (w, h)
+
     def set_texture_internal(self):
         pass
 
@@ -440,6 +1159,7 @@ class RenderEngine:
             del self.bundles[img_bundle.uid()]
 
         self.layers[img_bundle.layer()].remove(uid)
+        img_bundle.release()
         
     def update(self, img_bundle):
         if img_bundle is None:
@@ -447,6 +1167,10 @@ class RenderEngine:
 
         for bun in img_bundle.all_bundles():
             uid = bun.uid()
+            if not bun.is_dirty() and uid in self.bundles:
+                continue  # nothing changed since the layer last saw it
+
+            bun.set_clean()
             self.bundles[uid] = bun
 
             layer = self.layers[bun.layer()]
@@ -458,21 +1182,67 @@ class RenderEngine:
         except Exception:
             return False
         
-    def render_layers(self):
+    def set_stats_enabled(self, val, capacity=600):
+        """capacity: int -- the number of frames of stats to keep"""
+        if not val:
+            self._stats = None
+        elif self._stats is None or self._stats.capacity() != capacity:
+            self._stats = RenderStats(capacity=capacity)
+
+    def get_stats(self):
+        """returns: the RenderStats being collected, or None if they're disabled."""
+        return self._stats
+
+    def clear_screen(self):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        GL_STATE.count()
+
+    def draw_layer(self, layer):
+        offs = layer.offset()
+        self.set_matrix_offset(-offs[0], -offs[1])
+        layer.render(self)
+
+    def last_frame_gl_calls(self):
+        """returns: the number of gl calls the last call to render_layers made."""
+        return self._last_frame_gl_calls
+
+    def render_layers(self):
+        frame_start_calls = GL_STATE.n_calls
+        self.clear_screen()
+
+        stats = self._stats
+        if stats is not None:
+            stats.begin_frame()
 
         for layer in self.ordered_layers:
-            if layer.is_dirty():
+            if stats is not None:
+                pending = layer.pending_changes()
+                start_calls = GL_STATE.n_calls
+                start = time.perf_counter()
+
+            rebuilt = layer.is_dirty()
+            if rebuilt:
                 layer.rebuild(self.bundles)
 
-            if layer.layer_id in self.hidden_layers:
-                continue
+            if stats is not None:
+                rebuild_end = time.perf_counter()
 
-            offs = layer.offset()
+            hidden = layer.layer_id in self.hidden_layers
+            if not hidden:
+                self.draw_layer(layer)
 
-            self.set_matrix_offset(-offs[0], -offs[1])
-            
-            layer.render(self)
+            if stats is not None:
+                render_time = time.perf_counter() - rebuild_end
+                upload_time = layer.last_upload_time() if not hidden else 0
+                stats.record_layer(layer.name, 1000 * (rebuild_end - start), 1000 * upload_time,
+                                   1000 * (render_time - upload_time), layer.num_sprites(),
+                                   layer.num_drawn() if not hidden else 0, *pending, rebuilt,
+                                   GL_STATE.n_calls - start_calls)
+
+        if stats is not None:
+            stats.end_frame()
+
+        self._last_frame_gl_calls = GL_STATE.n_calls - frame_start_calls
 
     def cleanup(self):
         self.shader.end()
@@ -483,26 +1253,42 @@ class RenderEngine:
             res += layer.num_sprites()
         return res
 
+    def count_drawn_sprites(self):
+        """returns: the number of sprites drawn last frame, after culling."""
+        res = 0
+        for layer in self.ordered_layers:
+            if layer.layer_id not in self.hidden_layers:
+                res += layer.num_drawn()
+        return res
+
+    def get_cull_stats(self):
+        """returns: map of layer name -> (drawn, culled) for the layers that cull, as of last frame."""
+        res = {}
+        for layer in self.ordered_layers:
+            if layer.is_culled():
+                res[layer.name] = (layer.num_drawn(), layer.num_culled())
+        return res
+
 
 def translation_matrix(x, y):
     res = numpy.identity(4, dtype=numpy.float32)
-    res.itemset((0, 3), float(x))
-    res.itemset((1, 3), float(y))
+    res[0, 3] = float(x)
+    res[1, 3] = float(y)
     return res
 
 
 def ortho_matrix(left, right, bottom, top, near_val, far_val):
     res = numpy.identity(4, dtype=numpy.float32)
-    res.itemset((0, 0), float(2 / (right - left)))
-    res.itemset((1, 1), float(2 / (top - bottom)))
-    res.itemset((2, 2), float(-2 / (far_val - near_val)))
+    res[0, 0] = float(2 / (right - left))
+    res[1, 1] = float(2 / (top - bottom))
+    res[2, 2] = float(-2 / (far_val - near_val))
 
     t_x = -(right + left) / (right - left)
     t_y = -(top + bottom) / (top - bottom)
     t_z = -(far_val + near_val) / (far_val - near_val)
-    res.itemset((0, 3), float(t_x))
-    res.itemset((1, 3), float(t_y))
-    res.itemset((2, 3), float(t_z))
+    res[0, 3] = float(t_x)
+    res[1, 3] = float(t_y)
+    res[2, 3] = float(t_z)
 
     return res
 
@@ -520,13 +1306,37 @@ class RenderEngine130(RenderEngine):
         self._texture_pos_attrib_loc = None
         self._color_attrib_loc = None
 
+        self._rect_attrib_loc = None  # instanced shader only
+        self._tex_rect_attrib_loc = None
+        self._rotation_attrib_loc = None
+
+        # the gl state that's currently set, so that calls which wouldn't change anything can be skipped
+        self._attrib_array_states = {}  # attrib location -> whether it's enabled
+        self._current_offset = None
+        self._current_tex_size = None
+
         self._modelview_matrix = numpy.identity(4, dtype=numpy.float32)
         self._proj_matrix = numpy.identity(4, dtype=numpy.float32)
 
     def get_glsl_version(self):
         return "130"
 
+    def buffers_supported(self):
+        try:
+            return bool(glGenBuffers) and bool(glBufferSubData)
+        except Exception:
+            return False
+
+    def instancing_supported(self):
+        try:
+            return bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor)
+        except Exception:
+            return False
+
     def build_shader(self):
+        if self.instancing_enabled():
+            return self._build_instanced_shader()
+
         return Shader(
             '''
             # version 130
@@ -573,6 +1383,67 @@ class RenderEngine130(RenderEngine):
             '''
         )
 
+    def _build_instanced_shader(self):
+        """
+            each sprite is a single record of (rect, tex rect, rotation, color) and the vertex shader
+            builds its quad from gl_VertexID, in the same order and with the same texture corners
+            that img.write_quads uses.
+        """
+        return Shader(
+            '''
+            # version 130
+            in vec4 iRect;
+            in vec4 iTexRect;
+            in float iRotation;
+            in vec3 iColor;
+
+            uniform mat4 modelview;
+            uniform mat4 proj;
+
+            out vec2 texCoord;
+            out vec3 color;
+
+            const int QUAD[6] = int[6](0, 1, 2, 0, 2, 3);
+            const vec2 OFFSETS[4] = vec2[4](vec2(0.0, 0.0), vec2(0.0, 1.0), vec2(1.0, 1.0), vec2(1.0, 0.0));
+
+            void main()
+            {
+                int corner = QUAD[gl_VertexID % 6];
+
+                vec2 texCorners[4] = vec2[4](vec2(iTexRect.x, iTexRect.w), vec2(iTexRect.x, iTexRect.y),
+                                             vec2(iTexRect.z, iTexRect.y), vec2(iTexRect.z, iTexRect.w));
+                texCoord = texCorners[(corner + int(iRotation)) % 4];
+                color = iColor;
+
+                vec2 position = iRect.xy + OFFSETS[corner] * iRect.zw;
+                gl_Position = proj * modelview * vec4(position.x, position.y, 0.0, 1.0);
+            }
+            ''',
+            '''
+            #version 130
+            in vec2 texCoord;
+            in vec3 color;
+            
+            uniform vec2 texSize;
+            uniform sampler2D tex0;
+
+            void main(void) {
+                vec2 texPos = vec2(texCoord.x / texSize.x, texCoord.y / texSize.y);
+                vec4 tcolor = texture2D(tex0, texPos);
+                
+                for (int i = 0; i < 3; i++) {
+                    if (tcolor[i] >= 0.99) {
+                        gl_FragColor[i] = tcolor[i] * color[i];
+                    } else {
+                        gl_FragColor[i] = tcolor[i] * color[i] * color[i];                    
+                    }
+                }
+                
+                gl_FragColor.w = tcolor.w;
+            }
+            '''
+        )
+
     def _assert_valid_var(self, varname, loc):
         if loc < 0:
             raise ValueError("invalid uniform or attribute: {}, loc={}".format(varname, loc))
@@ -580,6 +1451,12 @@ class RenderEngine130(RenderEngine):
     def setup_shader(self):
         prog_id = self.get_shader().get_program()
 
+        # it's a new program (and maybe a new context), so nothing can be assumed about the state
+        self._attrib_array_states.clear()
+        self._current_offset = None
+        self._current_tex_size = None
+        GL_STATE.reset()
+
         self._tex_uniform_loc = glGetUniformLocation(prog_id, "tex0")
         self._assert_valid_var("tex0", self._tex_uniform_loc)
         glUniform1i(self._tex_uniform_loc, 0)
@@ -599,6 +1476,10 @@ class RenderEngine130(RenderEngine):
         glUniformMatrix4fv(self._proj_matrix_uniform_loc, 1, GL_TRUE, self._proj_matrix)
         printOpenGLError()
 
+        if self.instancing_enabled():
+            self._setup_instance_attributes(prog_id)
+            return
+
         self._position_attrib_loc = glGetAttribLocation(prog_id, "position")
         self._assert_valid_var("position", self._position_attrib_loc)
 
@@ -612,12 +1493,31 @@ class RenderEngine130(RenderEngine):
         glVertexAttrib3f(self._color_attrib_loc, 1.0, 1.0, 1.0)
         printOpenGLError()
 
+    def _setup_instance_attributes(self, prog_id):
+        self._rect_attrib_loc = glGetAttribLocation(prog_id, "iRect")
+        self._assert_valid_var("iRect", self._rect_attrib_loc)
+
+        self._tex_rect_attrib_loc = glGetAttribLocation(prog_id, "iTexRect")
+        self._assert_valid_var("iTexRect", self._tex_rect_attrib_loc)
+
+        self._rotation_attrib_loc = glGetAttribLocation(prog_id, "iRotation")
+        self._assert_valid_var("iRotation", self._rotation_attrib_loc)
+
+        self._color_attrib_loc = glGetAttribLocation(prog_id, "iColor")
+        self._assert_valid_var("iColor", self._color_attrib_loc)
+        printOpenGLError()
+
     def set_matrix_offset(self, x, y):
+        if self._current_offset == (x, y):
+            return
+        self._current_offset = (x, y)
+
         self._modelview_matrix = numpy.identity(4, dtype=numpy.float32)
         trans = translation_matrix(x, y)
         numpy.matmul(self._modelview_matrix, trans, out=self._modelview_matrix, dtype=numpy.float32)
 
         glUniformMatrix4fv(self._modelview_matrix_uniform_loc, 1, GL_TRUE, self._modelview_matrix)
+        GL_STATE.count()
         printOpenGLError()
 
     def resize_internal(self):
@@ -630,6 +1530,7 @@ class RenderEngine130(RenderEngine):
         glUniformMatrix4fv(self._proj_matrix_uniform_loc, 1, GL_TRUE, self._proj_matrix)
         printOpenGLError()
 
+        self._current_offset = None
         self.set_matrix_offset(0, 0)
 
         vp_width, vp_height = self._calc_optimal_vp_size(self.size, self.get_pixel_scale())
@@ -649,44 +1550,83 @@ class RenderEngine130(RenderEngine):
         return (w, h)
 
     def set_texture_internal(self):
-        if self.raw_texture_data is not None:
-            tex_w = self.raw_texture_data[1]
-            tex_h = self.raw_texture_data[2]
-
-            glUniform2f(self._tex_size_uniform_loc, float(tex_w), float(tex_h))
+        # pages can have different sizes (the last one is trimmed), and tex coords are in pixels
+        tex_size = self.get_texture_size()
+        if tex_size != self._current_tex_size:
+            self._current_tex_size = tex_size
+            glUniform2f(self._tex_size_uniform_loc, float(tex_size[0]), float(tex_size[1]))
+            GL_STATE.count()
             printOpenGLError()
 
-    def set_vertices_enabled(self, val):
+    def _set_attrib_array_enabled(self, loc, val):
+        """returns: whether the state actually changed."""
+        if self._attrib_array_states.get(loc) == val:
+            return False
+        self._attrib_array_states[loc] = val
+
         if val:
-            glEnableVertexAttribArray(self._position_attrib_loc)
+            glEnableVertexAttribArray(loc)
         else:
-            glDisableVertexAttribArray(self._position_attrib_loc)
+            glDisableVertexAttribArray(loc)
+        GL_STATE.count()
         printOpenGLError()
+        return True
+
+    def _set_attrib_pointer(self, loc, size, data, stride=0):
+        glVertexAttribPointer(loc, size, GL_FLOAT, GL_FALSE, stride, data)
+        GL_STATE.count()
+
+    def set_vertices_enabled(self, val):
+        self._set_attrib_array_enabled(self._position_attrib_loc, val)
 
     def set_vertices(self, data):
-        glVertexAttribPointer(self._position_attrib_loc, 2, GL_FLOAT, GL_FALSE, 0, data)
+        self._set_attrib_pointer(self._position_attrib_loc, 2, data)
         printOpenGLError()
 
     def set_texture_coords_enabled(self, val):
-        if val:
-            glEnableVertexAttribArray(self._texture_pos_attrib_loc)
-        else:
-            glDisableVertexAttribArray(self._texture_pos_attrib_loc)
-        printOpenGLError()
+        self._set_attrib_array_enabled(self._texture_pos_attrib_loc, val)
 
     def set_texture_coords(self, data):
-        glVertexAttribPointer(self._texture_pos_attrib_loc, 2, GL_FLOAT, GL_FALSE, 0, data)
+        self._set_attrib_pointer(self._texture_pos_attrib_loc, 2, data)
         printOpenGLError()
 
     def set_colors_enabled(self, val):
-        if val:
-            glEnableVertexAttribArray(self._color_attrib_loc)
-        else:
-            glDisableVertexAttribArray(self._color_attrib_loc)
-        printOpenGLError()
+        if self._set_attrib_array_enabled(self._color_attrib_loc, val) and not val:
+            # the default color isn't guaranteed to survive draws that used the color array
+            glVertexAttrib3f(self._color_attrib_loc, 1.0, 1.0, 1.0)
+            GL_STATE.count()
 
     def set_colors(self, data):
-        glVertexAttribPointer(self._color_attrib_loc, 3, GL_FLOAT, GL_FALSE, 0, data)
+        self._set_attrib_pointer(self._color_attrib_loc, 3, data)
+        printOpenGLError()
+
+    def _instance_attributes(self):
+        """returns: list of (attrib location, n floats, offset in floats) for each field of an instance record."""
+        return [(self._rect_attrib_loc, 4, 0),
+                (self._tex_rect_attrib_loc, 4, 4),
+                (self._rotation_attrib_loc, 1, 8),
+                (self._color_attrib_loc, 3, 9)]
+
+    def set_instances_enabled(self, val):
+        for loc, _, _ in self._instance_attributes():
+            if self._set_attrib_array_enabled(loc, val):
+                glVertexAttribDivisor(loc, 1 if val else 0)
+                GL_STATE.count()
+        printOpenGLError()
+
+    def set_instances(self, first=0):
+        """
+            points the instance attributes at the records in the currently bound array buffer.
+            first: int -- index of the record to start from
+        """
+        stride = 4 * img.INSTANCE_STRIDE
+        for loc, size, offs in self._instance_attributes():
+            self._set_attrib_pointer(loc, size, ctypes.c_void_p(first * stride + 4 * offs), stride=stride)
+        printOpenGLError()
+
+    def draw_instances(self, n_sprites):
+        glDrawArraysInstanced(GL_TRIANGLES, 0, 6, n_sprites)
+        GL_STATE.count()
         printOpenGLError()
 
 
@@ -695,6 +1635,9 @@ class RenderEngine120(RenderEngine130):
     def get_glsl_version(self):
         return "120"
 
+    def instancing_supported(self):
+        return False  # gl_VertexID and instanced arrays need GLSL 1.30+
+
     def build_shader(self):
         return Shader(
             '''
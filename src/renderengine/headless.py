@@ -0,0 +1,156 @@
+"""
+A RenderEngine that runs without a gl context or a window, for benchmarking and testing the frame
+pipeline on machines without a display. Layers are rebuilt and culled exactly like they are
+normally, but instead of issuing draw calls the sprites are (optionally) rasterized into a numpy
+framebuffer by a very simple software renderer.
+"""
+
+import numpy
+
+from src.renderengine.engine import RenderEngine
+
+
+class HeadlessRenderEngine(RenderEngine):
+
+    def __init__(self, rasterize=False):
+        """
+            rasterize: bool -- whether to actually draw the sprites into the framebuffer. this is
+                               slow, and only needed when the output image matters (e.g. screenshots).
+        """
+        RenderEngine.__init__(self)
+        self.use_vbos = False
+        self.rasterize = rasterize
+
+        self._clear_color = (0.5, 0.5, 0.5)
+        self._matrix_offset = (0, 0)
+        self._textures = []  # (h, w, 4) uint8 array for each page, origin top left
+        self._framebuffer = None  # (h, w, 3) float32 array, origin top left
+
+    def get_glsl_version(self):
+        return "headless"
+
+    def build_shader(self):
+        return None
+
+    def setup_shader(self):
+        pass
+
+    def init(self, w, h):
+        print("INFO: using headless render engine (rasterize={})".format(self.rasterize))
+        self._vbos_enabled = False
+        self.resize(w, h)
+
+    def reset_for_display_mode_change(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def set_clear_color(self, r, g, b):
+        self._clear_color = (r / 255, g / 255, b / 255)
+
+    def set_textures(self, pages, tex_ids=None):
+        self._textures = []
+        for img_data, width, height in pages:
+            # the data is flipped vertically (row 0 is the bottom of the sheet), same as what gl expects
+            flipped = numpy.frombuffer(img_data, dtype=numpy.uint8).reshape((height, width, 4))
+            self._textures.append(flipped[::-1])
+        self.raw_texture_pages = list(pages)
+
+    def bind_texture_page(self, page):
+        pass  # each sprite is rasterized straight from its own page
+
+    def set_matrix_offset(self, x, y):
+        self._matrix_offset = (x, y)
+
+    def resize_internal(self):
+        game_w, game_h = self.get_game_size()
+        self._framebuffer = numpy.zeros((game_h, game_w, 3), dtype=numpy.float32)
+
+    def set_vertices_enabled(self, val):
+        pass
+
+    def set_vertices(self, data):
+        pass
+
+    def set_texture_coords_enabled(self, val):
+        pass
+
+    def set_texture_coords(self, data):
+        pass
+
+    def set_colors_enabled(self, val):
+        pass
+
+    def set_colors(self, data):
+        pass
+
+    def clear_screen(self):
+        if self.rasterize and self._framebuffer is not None:
+            self._framebuffer[:] = self._clear_color
+
+    def draw_layer(self, layer):
+        offs = layer.offset()
+        self.set_matrix_offset(-offs[0], -offs[1])
+        layer.update_visible_sprites(self)
+
+        if self.rasterize and len(self._textures) > 0 and layer.num_drawn() > 0:
+            self._rasterize_layer(layer)
+
+    def get_framebuffer(self):
+        """returns: (h, w, 3) uint8 array of the last frame, or None if rasterization is disabled."""
+        if not self.rasterize or self._framebuffer is None:
+            return None
+        return (numpy.clip(self._framebuffer, 0, 1) * 255).astype(numpy.uint8)
+
+    def _rasterize_layer(self, layer):
+        slots = layer.drawn_indices()[::6] // 4
+        vertices = layer.vertices.reshape(-1, 4, 2)[slots]
+        tex_coords = layer.tex_coords.reshape(-1, 4, 2)[slots]
+        colors = layer.colors.reshape(-1, 4, 3)[slots, 0] if layer.uses_color() else None
+        pages = layer.pages[slots]
+
+        for i in range(0, len(slots)):
+            self._rasterize_quad(vertices[i], tex_coords[i], colors[i] if colors is not None else None,
+                                 self._textures[pages[i]])
+
+    def _rasterize_quad(self, corners, tex_corners, color, texture):
+        """
+            corners: (4, 2) array of the quad's vertices, in the order ImageBundle writes them:
+                     top left, bottom left, bottom right, top right.
+            tex_corners: (4, 2) array of the texture coords at each corner, in page pixels.
+            texture: (h, w, 4) array of the sprite's page.
+        """
+        fb_h, fb_w = self._framebuffer.shape[0:2]
+        x1, y1 = corners[0] + self._matrix_offset
+        x2, y2 = corners[2] + self._matrix_offset
+
+        # pixels whose centers are inside the quad
+        px1 = max(0, int(numpy.ceil(x1 - 0.5)))
+        px2 = min(fb_w, int(numpy.ceil(x2 - 0.5)))
+        py1 = max(0, int(numpy.ceil(y1 - 0.5)))
+        py2 = min(fb_h, int(numpy.ceil(y2 - 0.5)))
+        if px2 <= px1 or py2 <= py1:
+            return
+
+        # the quad is axis-aligned, so texture coords are an affine function of screen position
+        s = (numpy.arange(px1, px2) + 0.5 - x1) / (x2 - x1)
+        t = (numpy.arange(py1, py2) + 0.5 - y1) / (y2 - y1)
+        du = tex_corners[3] - tex_corners[0]
+        dv = tex_corners[1] - tex_corners[0]
+        uv = (tex_corners[0][None, None, :] + s[None, :, None] * du[None, None, :]
+              + t[:, None, None] * dv[None, None, :])
+
+        tex_h, tex_w = texture.shape[0:2]
+        cols = numpy.clip(numpy.floor(uv[:, :, 0]).astype(numpy.int32), 0, tex_w - 1)
+        rows = numpy.clip(numpy.floor(tex_h - uv[:, :, 1]).astype(numpy.int32), 0, tex_h - 1)
+        texels = texture[rows, cols].astype(numpy.float32) / 255
+
+        rgb = texels[:, :, 0:3]
+        if color is not None:
+            # same as the fragment shader: bright channels are tinted by the color, darker ones by its square
+            rgb = numpy.where(rgb >= 0.99, rgb * color, rgb * color * color)
+        alpha = texels[:, :, 3:4]
+
+        dest = self._framebuffer[py1:py2, px1:px2]
+        dest[:] = rgb * alpha + dest * (1 - alpha)
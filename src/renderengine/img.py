@@ -1,6 +1,8 @@
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
+import numpy
+import operator
 import random
 
 UNIQUE_ID_CTR = 0
@@ -13,30 +15,157 @@ def gen_unique_id():
     return UNIQUE_ID_CTR - 1
     
 
+class SpriteTable:
+    """
+        struct-of-arrays storage for the fields of every ImageBundle, keyed by uid. bundles are
+        thin handles onto a row of this table, so updating one changes its row in place instead of
+        allocating a whole new bundle. rows are freed when their bundle is released (see ImageBundle.release),
+        and reused by new bundles.
+    """
+
+    def __init__(self):
+        self.rows = {}  # uid -> row
+        self._free_rows = []
+
+        self.model = []
+        self.x = []
+        self.y = []
+        self.layer = []
+        self.scale = []
+        self.depth = []
+        self.xflip = []
+        self.rotation = []
+        self.color = []
+        self.ratio = []
+        self.destroyed = []
+        self.dirty = []  # whether the row changed since the render engine last saw it
+        self.quad = []  # the row's quad attributes, kept up to date so rebuilds don't recompute them
+
+        self._columns = (self.model, self.x, self.y, self.layer, self.scale, self.depth, self.xflip,
+                         self.rotation, self.color, self.ratio, self.destroyed, self.dirty, self.quad)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def alloc(self, uid):
+        if len(self._free_rows) > 0:
+            row = self._free_rows.pop()
+        else:
+            row = len(self.model)
+            for col in self._columns:
+                col.append(None)
+        self.rows[uid] = row
+        return row
+
+    def free(self, uid):
+        row = self.rows.pop(uid, None)
+        if row is not None:
+            self.model[row] = None  # don't hold onto models or colors
+            self.color[row] = None
+            self.quad[row] = None
+            self._free_rows.append(row)
+
+    def save_row(self, uid):
+        """frees the uid's row. returns: the row's values, to pass to restore_row."""
+        row = self.rows[uid]
+        res = tuple(col[row] for col in self._columns)
+        self.free(uid)
+        return res
+
+    def restore_row(self, uid, values):
+        """returns: a new row for the uid, holding the values from save_row."""
+        row = self.alloc(uid)
+        for col, val in zip(self._columns, values):
+            col[row] = val
+        return row
+
+    def set_row(self, row, model, x, y, scale, depth, xflip, rotation, color, ratio):
+        self.model[row] = model
+        self.x[row] = x
+        self.y[row] = y
+        self.scale[row] = scale
+        self.depth[row] = depth
+        self.xflip[row] = xflip
+        self.rotation[row] = rotation
+        self.color[row] = color
+        self.ratio[row] = ratio
+        self.dirty[row] = True
+
+        if model is None:
+            self.quad[row] = (x, y, 0, 0, 0, 0, 0, 0, xflip, rotation, *color, 0)
+        else:
+            self.quad[row] = (x, y, model.w * scale * ratio[0], model.h * scale * ratio[1],
+                              model.tx1, model.ty1, model.tx2, model.ty2, xflip, rotation, *color, model.page)
+
+    def bounds(self, uid):
+        """returns: (x, y, w, h) of the bundle's quad, ignoring rotation."""
+        quad = self.quad[self.rows[uid]]
+        return quad[0], quad[1], quad[2], quad[3]
+
+    def quad_attributes(self, uids):
+        """returns: QUAD_DTYPE array of the given bundles' quad attributes, in order."""
+        n = len(uids)
+        if n == 0:
+            return numpy.zeros(0, dtype=QUAD_DTYPE)
+        elif n == 1:
+            return numpy.array([self.quad[self.rows[uids[0]]]], dtype=QUAD_DTYPE)
+        else:
+            rows = operator.itemgetter(*uids)(self.rows)
+            return numpy.array(list(operator.itemgetter(*rows)(self.quad)), dtype=QUAD_DTYPE)
+
+
+_SPRITE_TABLE = SpriteTable()
+
+
+def sprite_table():
+    return _SPRITE_TABLE
+
+
 class ImageBundle:
+    """
+        a sprite in one of the render engine's layers. bundles are mutable handles onto a row of the
+        SpriteTable: update() changes the row in place and returns the same bundle (so the usual
+        'bun = bun.update(...)' just reassigns it). every reference to a bundle sees its latest values,
+        so there's no old version of a bundle to compare against or restore.
+
+        the row is freed explicitly by release(), which RenderEngine.remove calls. a released bundle
+        keeps its values, and gets a new row the next time it's used (e.g. when it's added back to
+        the engine after being offscreen).
+    """
+
+    __slots__ = ("_unique_id", "_row", "_released")
 
     @staticmethod
     def new_bundle(layer_id, scale=1, depth=0):
         return ImageBundle(None, 0, 0, layer=layer_id, scale=scale, depth=depth)
 
-    def __init__(self, model, x, y, layer=0, scale=1, depth=1, xflip=False, rotation=0, color=(1, 1, 1), ratio=(1, 1), uid=None):
-        self._unique_id = gen_unique_id() if uid is None else uid
-        self._model = model
-        self._x = x
-        self._y = y
-        self._layer = layer  # Note: can't be changed once set
-        self._scale = scale
-        self._depth = depth
-        self._xflip = xflip
-        self._rotation = rotation
-        self._color = color
-        self._ratio = ratio
-
-        self._is_destroyed = False
-            
+    def __init__(self, model, x, y, layer=0, scale=1, depth=1, xflip=False, rotation=0, color=(1, 1, 1), ratio=(1, 1)):
+        self._unique_id = gen_unique_id()
+        self._row = _SPRITE_TABLE.alloc(self._unique_id)
+        self._released = None  # the row's values while the bundle is released
+
+        _SPRITE_TABLE.layer[self._row] = layer  # Note: can't be changed once set
+        _SPRITE_TABLE.destroyed[self._row] = False
+        _SPRITE_TABLE.set_row(self._row, model, x, y, scale, depth, xflip, rotation, color, ratio)
+
+    def release(self):
+        """frees the bundle's row in the sprite table. the bundle can still be used afterwards."""
+        if self._row is not None:
+            self._released = _SPRITE_TABLE.save_row(self._unique_id)
+            self._row = None
+
+    def is_released(self):
+        return self._row is None
+
+    def _table_row(self):
+        if self._row is None:
+            self._row = _SPRITE_TABLE.restore_row(self._unique_id, self._released)
+            self._released = None
+        return self._row
+
     def update(self, new_model=None, new_x=None, new_y=None, new_scale=None, new_depth=None,
                new_xflip=None, new_color=None, new_rotation=None, new_ratio=None):
-                
+        """changes the bundle in place. returns: self"""
         model = self.model() if new_model is None else new_model
         x = self.x() if new_x is None else new_x
         y = self.y() if new_y is None else new_y
@@ -47,7 +176,7 @@ class ImageBundle:
         rotation = self.rotation() if new_rotation is None else new_rotation
         ratio = self.ratio() if new_ratio is None else new_ratio
         
-        if (model == self.model() and 
+        if not (model == self.model() and 
                 x == self.x() and 
                 y == self.y() and
                 scale == self.scale() and
@@ -56,21 +185,18 @@ class ImageBundle:
                 color == self.color() and
                 ratio == self.ratio() and
                 rotation == self.rotation()):
-            return self
-        else:
-            res = ImageBundle(model, x, y, scale=scale, depth=depth, xflip=xflip, rotation=rotation,
-                              layer=self.layer(), color=color, ratio=ratio, uid=self.uid())
-            res._is_destroyed = self._is_destroyed
-            return res
+            _SPRITE_TABLE.set_row(self._table_row(), model, x, y, scale, depth, xflip, rotation, color, ratio)
+
+        return self
         
     def model(self):
-        return self._model
+        return _SPRITE_TABLE.model[self._table_row()]
     
     def x(self):
-        return self._x
+        return _SPRITE_TABLE.x[self._table_row()]
         
     def y(self):
-        return self._y
+        return _SPRITE_TABLE.y[self._table_row()]
         
     def width(self):
         if self.model() is None:
@@ -92,26 +218,26 @@ class ImageBundle:
         return (self.width(), self.height())
 
     def scale(self):
-        return self._scale
+        return _SPRITE_TABLE.scale[self._table_row()]
         
     def depth(self):
-        return self._depth
+        return _SPRITE_TABLE.depth[self._table_row()]
 
     def layer(self):
-        return self._layer
+        return _SPRITE_TABLE.layer[self._table_row()]
         
     def xflip(self):
-        return self._xflip
+        return _SPRITE_TABLE.xflip[self._table_row()]
 
     def rotation(self):
         """returns: int: 0, 1, 2, or 3 representing a number of clockwise 90 degree rotations."""
-        return self._rotation
+        return _SPRITE_TABLE.rotation[self._table_row()]
         
     def color(self):
-        return self._color
+        return _SPRITE_TABLE.color[self._table_row()]
 
     def ratio(self):
-        return self._ratio
+        return _SPRITE_TABLE.ratio[self._table_row()]
         
     def uid(self):
         return self._unique_id
@@ -120,12 +246,19 @@ class ImageBundle:
         yield self
 
     def mark_for_removal(self):
-        self._is_destroyed = True
+        _SPRITE_TABLE.destroyed[self._table_row()] = True
 
     def is_destroyed(self):
-        return self._is_destroyed
+        return _SPRITE_TABLE.destroyed[self._table_row()]
+
+    def is_dirty(self):
+        """returns: whether the bundle changed since the last call to set_clean."""
+        return _SPRITE_TABLE.dirty[self._table_row()]
+
+    def set_clean(self):
+        _SPRITE_TABLE.dirty[self._table_row()] = False
         
-    def add_urself(self, i, vertices, texts, colors, indices):
+    def add_urself(self, i, vertices, texts, colors):
         """
             i: sprite's "index", which determines where in the arrays its data is written.
         """
@@ -140,7 +273,7 @@ class ImageBundle:
             w = model.w * self.scale() * self.ratio()[0]
             h = model.h * self.scale() * self.ratio()[1]
 
-        if self.rotation() == 1 or self._rotation == 3:
+        if self.rotation() == 1 or self.rotation() == 3:
             temp_w = w
             w = h
             h = temp_w
@@ -179,12 +312,11 @@ class ImageBundle:
             for j in range(0, 8):
                 texts[i * 8 + j] = corners[j]
 
-        indices[6 * i + 0] = 4 * i
-        indices[6 * i + 1] = 4 * i + 1
-        indices[6 * i + 2] = 4 * i + 2
-        indices[6 * i + 3] = 4 * i
-        indices[6 * i + 4] = 4 * i + 2
-        indices[6 * i + 5] = 4 * i + 3
+    def quad_attributes(self):
+        """
+            returns: tuple matching QUAD_DTYPE, used by write_quads to build many sprites at once.
+        """
+        return _SPRITE_TABLE.quad[self._table_row()]
 
     def __repr__(self):
         return "ImageBundle({}, {}, {}, {}, {}, {}, {}, {}, {}. {})".format(
@@ -192,6 +324,107 @@ class ImageBundle:
                 self.scale(), self.depth(), self.xflip(), self.color(), self.ratio(), self.uid())
 
 
+QUAD_DTYPE = numpy.dtype([
+    ("x", numpy.float64), ("y", numpy.float64), ("w", numpy.float64), ("h", numpy.float64),
+    ("tx1", numpy.float64), ("ty1", numpy.float64), ("tx2", numpy.float64), ("ty2", numpy.float64),
+    ("xflip", numpy.bool_), ("rotation", numpy.int32),
+    ("r", numpy.float64), ("g", numpy.float64), ("b", numpy.float64),
+    ("page", numpy.int32)
+])
+
+
+def write_quads(slots, attrs, vertices, texts, colors):
+    """
+        batched version of ImageBundle.add_urself.
+        slots: int array of sprite "indices", which determine where in the arrays each sprite's data is written.
+        attrs: QUAD_DTYPE array of the same length as slots (see ImageBundle.quad_attributes).
+    """
+    n = len(slots)
+    if n == 0:
+        return
+
+    x = attrs["x"]
+    y = attrs["y"]
+    rot = attrs["rotation"] % 4
+
+    sideways = (rot % 2) == 1
+    w = numpy.where(sideways, attrs["h"], attrs["w"])
+    h = numpy.where(sideways, attrs["w"], attrs["h"])
+
+    verts = numpy.empty((n, 8), dtype=vertices.dtype)
+    verts[:, 0] = x
+    verts[:, 1] = y
+    verts[:, 2] = x
+    verts[:, 3] = y + h
+    verts[:, 4] = x + w
+    verts[:, 5] = y + h
+    verts[:, 6] = x + w
+    verts[:, 7] = y
+    vertices.reshape(-1, 8)[slots] = verts
+
+    if colors is not None:
+        rgb = numpy.stack((attrs["r"], attrs["g"], attrs["b"]), axis=1)
+        colors.reshape(-1, 12)[slots] = numpy.tile(rgb, 4)
+
+    # corners are (u, v) pairs in the same order as add_urself
+    xflip = attrs["xflip"]
+    u1 = numpy.where(xflip, attrs["tx2"], attrs["tx1"])
+    u2 = numpy.where(xflip, attrs["tx1"], attrs["tx2"])
+    corners = numpy.empty((n, 4, 2), dtype=texts.dtype)
+    corners[:, 0, 0] = u1
+    corners[:, 0, 1] = attrs["ty2"]
+    corners[:, 1, 0] = u1
+    corners[:, 1, 1] = attrs["ty1"]
+    corners[:, 2, 0] = u2
+    corners[:, 2, 1] = attrs["ty1"]
+    corners[:, 3, 0] = u2
+    corners[:, 3, 1] = attrs["ty2"]
+
+    # each clockwise rotation shifts the corners left by one pair
+    order = (numpy.arange(4)[None, :] + rot[:, None]) % 4
+    corners = numpy.take_along_axis(corners, order[:, :, None], axis=1)
+    texts.reshape(-1, 8)[slots] = corners.reshape(n, 8)
+
+
+INSTANCE_STRIDE = 12  # floats per sprite: x, y, w, h, u1, v1, u2, v2, rotation, r, g, b
+
+
+def write_instances(slots, attrs, instances, use_color=True):
+    """
+        instanced version of write_quads. writes one record per sprite, which the vertex shader
+        expands into the same quad write_quads would have produced.
+        slots: int array of sprite "indices", which determine where in the array each sprite's record is written.
+        attrs: QUAD_DTYPE array of the same length as slots (see ImageBundle.quad_attributes).
+        instances: float array with INSTANCE_STRIDE values per sprite.
+    """
+    n = len(slots)
+    if n == 0:
+        return
+
+    rot = attrs["rotation"] % 4
+    sideways = (rot % 2) == 1
+    xflip = attrs["xflip"]
+
+    records = numpy.empty((n, INSTANCE_STRIDE), dtype=instances.dtype)
+    records[:, 0] = attrs["x"]
+    records[:, 1] = attrs["y"]
+    records[:, 2] = numpy.where(sideways, attrs["h"], attrs["w"])
+    records[:, 3] = numpy.where(sideways, attrs["w"], attrs["h"])
+    records[:, 4] = numpy.where(xflip, attrs["tx2"], attrs["tx1"])
+    records[:, 5] = attrs["ty1"]
+    records[:, 6] = numpy.where(xflip, attrs["tx1"], attrs["tx2"])
+    records[:, 7] = attrs["ty2"]
+    records[:, 8] = rot
+    if use_color:
+        records[:, 9] = attrs["r"]
+        records[:, 10] = attrs["g"]
+        records[:, 11] = attrs["b"]
+    else:
+        records[:, 9:12] = 1.0
+
+    instances.reshape(-1, INSTANCE_STRIDE)[slots] = records
+
+
 class ImageModel:
 
     def __init__(self, x, y, w, h):
@@ -201,6 +434,8 @@ class ImageModel:
         self.w = w
         self.h = h
         self._rect = (x, y, w, h)
+
+        self.page = 0  # which texture page of the atlas the model is on
         
         # texture coords, origin bottom left corner
         self.tx1 = 0
@@ -225,6 +460,14 @@ class ImageModel:
         self.tx2 = self.x + self.w
         self.ty1 = size[1] - (self.y + self.h)
         self.ty2 = size[1] - self.y
+
+    def set_atlas_location(self, page, x, y, page_size):
+        """moves the model to the given spot on a page of the atlas."""
+        self.page = page
+        self.x = x
+        self.y = y
+        self._rect = (x, y, self.w, self.h)
+        self.set_sheet_size(page_size)
         
     def __repr__(self):
         return "ImageModel({}, {}, {}, {})".format(self.x, self.y, self.w, self.h)
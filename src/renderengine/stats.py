@@ -0,0 +1,174 @@
+"""
+Per-layer frame statistics collected by the RenderEngine. Times are in milliseconds and measure
+how long the cpu spent in each step (gl calls return before the gpu has actually finished).
+"""
+
+import collections
+import csv
+import json
+import os
+
+import numpy
+
+LAYER_FIELDS = ("rebuild_ms", "upload_ms", "draw_ms", "n_sprites", "n_drawn", "n_dirty", "n_added", "n_removed",
+                "rebuilt", "gl_calls")
+
+TIMING_FIELDS = ("rebuild_ms", "upload_ms", "draw_ms")
+
+PERCENTILE_FIELDS = TIMING_FIELDS + ("gl_calls",)  # fields that are summarized by their distribution
+
+PERCENTILES = (50, 95, 99)
+
+_TOTAL = "total"  # pseudo-layer name for the whole frame
+
+
+class RenderStats:
+
+    def __init__(self, capacity=600):
+        """
+            capacity: int -- the number of frames to remember
+        """
+        self._capacity = capacity
+        self._context = None  # str, e.g. the current zone id
+
+        self._frame_idx = 0
+        self._frame_layers = {}  # layer name -> row, for the frame that's being recorded
+
+        self._rows = {}  # layer name -> deque of (frame_idx, context, *LAYER_FIELDS)
+
+    def capacity(self):
+        return self._capacity
+
+    def set_context(self, context):
+        """context: str -- a label stored with each frame (e.g. a zone id), used to filter the stats."""
+        self._context = context
+
+    def get_context(self):
+        return self._context
+
+    def clear(self):
+        self._frame_layers.clear()
+        self._rows.clear()
+
+    def begin_frame(self):
+        self._frame_layers.clear()
+
+    def record_layer(self, layer_name, rebuild_ms, upload_ms, draw_ms, n_sprites, n_drawn, n_dirty, n_added,
+                     n_removed, rebuilt, gl_calls):
+        self._frame_layers[layer_name] = (rebuild_ms, upload_ms, draw_ms, n_sprites, n_drawn,
+                                          n_dirty, n_added, n_removed, rebuilt, gl_calls)
+
+    def end_frame(self):
+        if len(self._frame_layers) == 0:
+            return
+
+        totals = [0] * len(LAYER_FIELDS)
+        for layer_name in self._frame_layers:
+            row = self._frame_layers[layer_name]
+            self._add_row(layer_name, row)
+            for i in range(0, len(row)):
+                totals[i] += row[i]
+
+        self._add_row(_TOTAL, tuple(totals))
+        self._frame_layers.clear()
+        self._frame_idx += 1
+
+    def _add_row(self, layer_name, row):
+        if layer_name not in self._rows:
+            self._rows[layer_name] = collections.deque(maxlen=self._capacity)
+        self._rows[layer_name].append((self._frame_idx, self._context) + row)
+
+    def layer_names(self):
+        """returns: names of the layers that have been recorded, with the frame total last."""
+        res = [name for name in self._rows if name != _TOTAL]
+        if _TOTAL in self._rows:
+            res.append(_TOTAL)
+        return res
+
+    def _get_rows(self, layer_name, context=None):
+        if layer_name not in self._rows:
+            return []
+        elif context is None:
+            return list(self._rows[layer_name])
+        else:
+            return [row for row in self._rows[layer_name] if row[1] == context]
+
+    def summary(self, context=None):
+        """
+            context: str -- if not None, only frames recorded with this context are included.
+            returns: map of layer name -> {
+                        "n_frames", "n_rebuilds", "n_skips",
+                        "<timing>": {"p50", "p95", "p99", "max"} for each timing field and gl_calls,
+                        "<count>": value as of the latest frame, for each count field}
+        """
+        res = {}
+        for layer_name in self.layer_names():
+            rows = self._get_rows(layer_name, context=context)
+            if len(rows) == 0:
+                continue
+
+            data = numpy.array([row[2:] for row in rows], dtype=numpy.float64)
+            layer_res = {"n_frames": len(rows)}
+
+            rebuilt_col = LAYER_FIELDS.index("rebuilt")
+            n_rebuilds = int(numpy.count_nonzero(data[:, rebuilt_col]))
+            layer_res["n_rebuilds"] = n_rebuilds
+            layer_res["n_skips"] = len(rows) - n_rebuilds
+
+            for i, field in enumerate(LAYER_FIELDS):
+                if field in PERCENTILE_FIELDS:
+                    pcnts = numpy.percentile(data[:, i], PERCENTILES)
+                    layer_res[field] = {"p{}".format(p): float(v) for p, v in zip(PERCENTILES, pcnts)}
+                    layer_res[field]["max"] = float(numpy.max(data[:, i]))
+                elif field != "rebuilt":
+                    layer_res[field] = int(data[-1, i])
+
+            res[layer_name] = layer_res
+
+        return res
+
+    def to_json(self, context=None):
+        return json.dumps({"context": context, "layers": self.summary(context=context)}, indent=4, sort_keys=True)
+
+    def to_csv_rows(self, context=None):
+        """returns: list of rows (header first), one per layer per frame."""
+        res = [["frame", "context", "layer"] + list(LAYER_FIELDS)]
+        for layer_name in self.layer_names():
+            for row in self._get_rows(layer_name, context=context):
+                res.append([row[0], row[1], layer_name] + list(row[2:]))
+        res[1:] = sorted(res[1:], key=lambda r: r[0])
+        return res
+
+    def save_to_disk(self, directory, filename, context=None):
+        """writes <filename>.json (the summary) and <filename>.csv (the raw frames) to the given directory."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        json_path = os.path.join(directory, filename + ".json")
+        with open(json_path, "w") as f:
+            f.write(self.to_json(context=context))
+
+        csv_path = os.path.join(directory, filename + ".csv")
+        with open(csv_path, "w", newline="") as f:
+            csv.writer(f).writerows(self.to_csv_rows(context=context))
+
+        print("INFO: saved render stats to {} and {}".format(json_path, csv_path))
+
+    def get_overlay_text(self, context=None):
+        """returns: a short text table of the summary, for displaying in-game."""
+        summary = self.summary(context=context)
+        lines = ["render stats, ms p50/p95/p99 ({} frames{})".format(
+            max([s["n_frames"] for s in summary.values()], default=0),
+            ", " + str(context) if context is not None else "")]
+        if _TOTAL in summary:
+            lines.append("gl calls per frame: {:.0f}/{:.0f}/{:.0f}".format(
+                *[summary[_TOTAL]["gl_calls"]["p{}".format(p)] for p in PERCENTILES]))
+        lines.append("{:<10}{:>7}{:>7}{:>9}  {:<14}{:<14}{:<14}".format(
+            "layer", "sprites", "drawn", "rebuilt", "rebuild", "upload", "draw").rstrip())
+        for layer_name in summary:
+            s = summary[layer_name]
+            timings = ["{:.1f}/{:.1f}/{:.1f}".format(s[f]["p50"], s[f]["p95"], s[f]["p99"]) for f in TIMING_FIELDS]
+            lines.append("{:<10}{:>7}{:>7}{:>9}  {:<14}{:<14}{:<14}".format(
+                layer_name[:10], s["n_sprites"], s["n_drawn"], "{}/{}".format(s["n_rebuilds"], s["n_frames"]),
+                *timings).rstrip())
+        return "\n".join(lines)
@@ -16,6 +16,7 @@ import src.game.globalstate as gs
 import src.game.sound_effects as sound_effects
 from src.renderengine.engine import RenderEngine
 from src.game.inputs import InputState
+from src.game.windowstate import WindowState
 import src.utils.colors as colors
 import src.game.gameengine as gameengine
 import src.game.version as version
@@ -111,7 +112,9 @@ class MenuManager:
                     # as long as the window has focus, even after the cursor has left.
                     cursor = spriteref.UI.Cursors.arrow_cursor
 
-                if cursor is None:
+                if WindowState.get_instance().is_headless():
+                    pass  # there's no cursor to set
+                elif cursor is None:
                     pygame.mouse.set_cursor(*spriteref.UI.Cursors.invisible_cursor)
                 else:
                     pygame.mouse.set_cursor(*cursor)
@@ -1857,3 +1857,40 @@ class CinematicPanel:
         if self.text_img is not None:
             for bun in self.text_img.all_bundles():
                 yield bun
+
+
+class RenderStatsOverlay:
+    """dev tool that shows the render engine's frame stats in the corner of the screen."""
+
+    def __init__(self, refresh_rate=30):
+        """
+            refresh_rate: int -- number of ticks between text updates (rebuilding the text is not free)
+        """
+        self.text_img = None
+        self.refresh_rate = refresh_rate
+        self._ticks_until_refresh = 0
+
+    def update(self):
+        stats = RenderEngine.get_instance().get_stats()
+        if stats is None:
+            return
+
+        self._ticks_until_refresh -= 1
+        if self._ticks_until_refresh <= 0 or self.text_img is None:
+            text = stats.get_overlay_text(context=stats.get_context())
+            if self.text_img is None:
+                self.text_img = TextImage(4, 4, text, spriteref.UI_TOOLTIP_LAYER, scale=0.5, x_kerning=0,
+                                          color=colors.YELLOW, depth=FG_DEPTH_SUPER)
+            else:
+                self.text_img = self.text_img.update(new_text=text)
+            self._ticks_until_refresh = self.refresh_rate
+
+    def cleanup(self):
+        if self.text_img is not None:
+            RenderEngine.get_instance().clear_bundles(self.text_img.all_bundles())
+            self.text_img = None
+
+    def all_bundles(self):
+        if self.text_img is not None:
+            for bun in self.text_img.all_bundles():
+                yield bun
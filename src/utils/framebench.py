@@ -0,0 +1,101 @@
+"""
+Runs the full game loop without a display (see renderengine/headless.py) for a fixed number of frames
+with scripted input, and reports the distribution of frame times and the render engine's per-layer stats.
+
+usage: python -m src.utils.framebench [n_frames] [--rasterize] [--save_stats]
+"""
+
+import sys
+
+import numpy
+import pygame
+
+PERCENTILES = (50, 95, 99)
+
+
+def key_press(key, frame, duration=2):
+    """returns: map of frame -> list of events that press and release the key."""
+    down = pygame.event.Event(pygame.KEYDOWN, key=key, mod=0, unicode="", scancode=0)
+    up = pygame.event.Event(pygame.KEYUP, key=key, mod=0, unicode="", scancode=0)
+    return {frame: [down], frame + duration: [up]}
+
+
+def merge_scripts(scripts):
+    res = {}
+    for script in scripts:
+        for frame in script:
+            if frame not in res:
+                res[frame] = []
+            res[frame].extend(script[frame])
+    return res
+
+
+def new_game_script(n_frames, start_frame=20, skip_interval=12, n_skips=30, walk_interval=20):
+    """
+        starts a new game from the title screen, skips through the intro, then walks around in a square.
+        returns: map of frame -> list of pygame events
+    """
+    scripts = [key_press(pygame.K_SPACE, start_frame),        # title screen -> start menu
+               key_press(pygame.K_RETURN, start_frame + 20)]  # start menu -> new game
+
+    frame = start_frame + 40
+    for _ in range(0, n_skips):
+        scripts.append(key_press(pygame.K_RETURN, frame))     # skipping intro cinematics and dialog
+        frame += skip_interval
+
+    walk_keys = [pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w]
+    i = 0
+    while frame < n_frames:
+        key = walk_keys[(i // 3) % len(walk_keys)]
+        scripts.append(key_press(key, frame, duration=walk_interval // 2))
+        frame += walk_interval
+        i += 1
+
+    return merge_scripts(scripts)
+
+
+def run(n_frames, rasterize=False, scripted_input=None):
+    """returns: (list of frame times in seconds, RenderStats)"""
+    import src.game.gameloop as gameloop
+    from src.renderengine.engine import RenderEngine
+
+    gameloop.init("Skeletris", headless=True)
+
+    render_eng = RenderEngine.get_instance()
+    render_eng.rasterize = rasterize
+    render_eng.set_stats_enabled(True, capacity=n_frames)
+
+    if scripted_input is None:
+        scripted_input = new_game_script(n_frames)
+
+    frame_times = gameloop.run(max_frames=n_frames, scripted_input=scripted_input, uncapped=True)
+    return frame_times, render_eng.get_stats()
+
+
+def print_frame_times(frame_times, skip_first=60):
+    """skip_first: int -- number of frames at the start to ignore (startup and menus)"""
+    times = numpy.array(frame_times[skip_first:]) * 1000
+    if len(times) == 0:
+        print("INFO: no frame times to report")
+        return
+
+    pcnts = numpy.percentile(times, PERCENTILES)
+    print("INFO: frame times over {} frames (ms)".format(len(times)))
+    print("\tmean={:.2f}\t{}\tmax={:.2f}".format(
+        numpy.mean(times), "\t".join(["p{}={:.2f}".format(p, v) for p, v in zip(PERCENTILES, pcnts)]),
+        numpy.max(times)))
+
+
+if __name__ == "__main__":
+    n = 600
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            n = int(arg)
+
+    times, stats = run(n, rasterize="--rasterize" in sys.argv)
+
+    print_frame_times(times)
+    print(stats.get_overlay_text())
+
+    if "--save_stats" in sys.argv:
+        stats.save_to_disk("render_stats", "framebench")
@@ -1,5 +1,6 @@
 import pygame
 import math
+import numpy
 
 import src.utils.colors as colors
 from src.utils.util import Utils
@@ -19,12 +20,23 @@ def to_rgba(color, opacity=1.0):
 
 
 def replace_color(sheet, rect, rgb, rgba):
-    for x in range(rect[0], rect[0] + rect[2]):
-        for y in range(rect[1], rect[1] + rect[3]):
-            if x < 0 or x >= sheet.get_width() or y < 0 or y >= sheet.get_height():
-                continue
-            if sheet.get_at((x, y)) == rgb:
-                sheet.set_at((x, y), rgba)
+    x1 = max(0, rect[0])
+    y1 = max(0, rect[1])
+    x2 = min(sheet.get_width(), rect[0] + rect[2])
+    y2 = min(sheet.get_height(), rect[1] + rect[3])
+    if x2 <= x1 or y2 <= y1:
+        return
+
+    # these lock the sheet until they're deleted
+    pixels = pygame.surfarray.pixels3d(sheet)[x1:x2, y1:y2]
+    alpha = pygame.surfarray.pixels_alpha(sheet)[x1:x2, y1:y2]
+
+    # an rgb color only matches fully opaque pixels, same as comparing with get_at
+    mask = numpy.all(pixels == rgb[0:3], axis=2) & (alpha == (rgb[3] if len(rgb) > 3 else 255))
+    pixels[mask] = rgba[0:3]
+    alpha[mask] = rgba[3] if len(rgba) > 3 else 255
+    del pixels
+    del alpha
 
 
 class GeometricGenerator:
@@ -0,0 +1,216 @@
+"""
+Plays the game headlessly (like framebench) and replays every frame's sprites through real OpenGL render engines
+in each of the draw modes (plain vertex arrays, vbos, instanced), then checks that they all produce exactly the
+same pixels. Needs a gl context, which it gets from EGL without a window (e.g. mesa's llvmpipe on a machine
+without a display).
+
+usage: python -m src.utils.glcheck [n_frames] [check_interval] [zone_id]
+"""
+
+import os
+import sys
+import ctypes
+
+# these have to be set before OpenGL is imported
+os.environ["PYOPENGL_PLATFORM"] = "egl"
+os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+import numpy
+from OpenGL import EGL
+from OpenGL.GL import *
+
+SCREEN_SIZE = (800, 600)
+
+# mode name -> (use_vbos, use_instancing). the first one is the reference the others are compared against.
+MODES = {
+    "arrays": (False, False),
+    "vbos": (True, False),
+    "instanced": (True, True)
+}
+
+
+class _EGLDisplay:
+
+    def __init__(self):
+        self.dpy = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.dpy, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise ValueError("failed to initialize EGL")
+
+        attribs = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                   EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+        self.config = EGL.EGLConfig()
+        n_configs = EGL.EGLint()
+        EGL.eglChooseConfig(self.dpy, attribs, ctypes.pointer(self.config), 1, ctypes.pointer(n_configs))
+        if n_configs.value == 0:
+            raise ValueError("no EGL config supports desktop OpenGL")
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+
+    def new_context(self):
+        """creates a context (with its own offscreen framebuffer to draw into) and makes it current."""
+        ctx = EGL.eglCreateContext(self.dpy, self.config, EGL.EGL_NO_CONTEXT, None)
+        self.make_current(ctx)
+
+        glBindFramebuffer(GL_FRAMEBUFFER, glGenFramebuffers(1))
+        renderbuffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, *SCREEN_SIZE)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, renderbuffer)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise ValueError("offscreen framebuffer is incomplete")
+        return ctx
+
+    def make_current(self, ctx):
+        if not EGL.eglMakeCurrent(self.dpy, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, ctx):
+            raise ValueError("failed to make EGL context current")
+
+
+class MirroredEngines:
+    """
+        forwards every sprite update the game makes to its (headless) render engine to a real gl engine per mode,
+        each in its own context, since the engines remember gl state and can't share one.
+    """
+
+    def __init__(self, src_engine, modes=MODES):
+        from src.renderengine.engine import RenderEngine, GL_STATE
+
+        self.src_engine = src_engine
+        self.display = _EGLDisplay()
+        self.contexts = {}
+        self.engines = {}
+
+        glsl_version = None
+        for mode in modes:
+            self.contexts[mode] = self.display.new_context()
+            GL_STATE.reset()
+            if glsl_version is None:
+                glsl_version = glGetString(GL_SHADING_LANGUAGE_VERSION).decode()
+                print("INFO: gl renderer: {}, version: {}".format(glGetString(GL_RENDERER).decode(),
+                                                                   glGetString(GL_VERSION).decode()))
+
+            eng = RenderEngine._get_best_render_engine(glsl_version)
+            eng.use_vbos, eng.use_instancing = modes[mode]
+            eng.init(*SCREEN_SIZE)
+            eng.set_min_size(*src_engine.min_size)
+            eng.set_textures(src_engine.raw_texture_pages)
+            for layer_id, layer in src_engine.layers.items():
+                cell_size = layer._cull_grid.cell_size if layer._cull_grid is not None else None
+                eng.add_layer(layer_id, layer.name, layer.z_order(), layer.sort_sprites, layer.uses_color(),
+                              cull_cell_size=cell_size)
+
+            if (eng.vbos_enabled(), eng.instancing_enabled()) != modes[mode]:
+                raise ValueError("gl context doesn't support mode: {}".format(mode))
+            self.engines[mode] = eng
+
+        self._src_update = src_engine.update
+        self._src_remove = src_engine.remove
+        self._src_clear_all_sprites = src_engine.clear_all_sprites
+
+        src_engine.update = self.update
+        src_engine.remove = self.remove
+        src_engine.clear_all_sprites = self.clear_all_sprites
+
+    def update(self, img_bundle):
+        if img_bundle is not None:
+            for bun in img_bundle.all_bundles():
+                uid = bun.uid()
+                if bun.is_dirty() or uid not in self.src_engine.bundles:
+                    for eng in self.engines.values():
+                        eng.bundles[uid] = bun
+                        eng.layers[bun.layer()].update(uid)
+        self._src_update(img_bundle)
+
+    def remove(self, img_bundle):
+        for eng in self.engines.values():
+            eng.remove(img_bundle)
+        self._src_remove(img_bundle)
+
+    def clear_all_sprites(self):
+        for eng in self.engines.values():
+            eng.clear_all_sprites()
+        self._src_clear_all_sprites()
+
+    def render(self, read_pixels):
+        """
+            draws the current frame with every engine.
+            returns: map of mode -> (h, w, 4) uint8 array of its pixels, or an empty map if read_pixels is false.
+        """
+        from src.renderengine.engine import GL_STATE
+
+        res = {}
+        clear_color = [round(255 * c) for c in self.src_engine._clear_color]
+        for mode, eng in self.engines.items():
+            self.display.make_current(self.contexts[mode])
+            GL_STATE.reset()
+
+            if eng.get_pixel_scale() != self.src_engine.get_pixel_scale():
+                eng.set_pixel_scale(self.src_engine.get_pixel_scale())
+            eng.set_clear_color(*clear_color)
+            eng.hidden_layers = dict(self.src_engine.hidden_layers)
+            for layer_id, layer in self.src_engine.layers.items():
+                eng.set_layer_offset(layer_id, *layer.offset())
+
+            eng.render_layers()
+            err = glGetError()
+            if err != GL_NO_ERROR:
+                raise ValueError("gl error in mode {}: {}".format(mode, err))
+
+            if read_pixels:
+                data = glReadPixels(0, 0, SCREEN_SIZE[0], SCREEN_SIZE[1], GL_RGBA, GL_UNSIGNED_BYTE)
+                res[mode] = numpy.frombuffer(data, dtype=numpy.uint8).reshape((SCREEN_SIZE[1], SCREEN_SIZE[0], 4))
+        return res
+
+
+def run(n_frames, check_interval=1, zone_id=None, jump_frame=300):
+    """
+        check_interval: int -- how often (in frames) to compare the pixels. every frame is drawn regardless.
+        zone_id: str -- if given, the game jumps to this zone at jump_frame (after the intro).
+        returns: list of (frame, mode, n differing pixels) for each mismatch
+    """
+    import src.game.gameloop as gameloop
+    import src.game.globalstate as gs
+    import src.game.events as events
+    import src.utils.framebench as framebench
+    from src.renderengine.engine import RenderEngine
+
+    gameloop.init("Skeletris", headless=True)
+    src_engine = RenderEngine.get_instance()
+    mirrors = MirroredEngines(src_engine)
+    ref_mode = list(MODES)[0]
+
+    mismatches = []
+    frame_counter = [0]
+    src_render_layers = src_engine.render_layers
+
+    def _render_layers():
+        src_render_layers()
+        frame = frame_counter[0] = frame_counter[0] + 1
+
+        if zone_id is not None and frame == jump_frame:
+            gs.get_instance().add_event(events.NewZoneEvent(zone_id, gs.get_instance().current_zone,
+                                                            show_zone_title_menu=False, do_fade_in=False))
+
+        images = mirrors.render(frame % check_interval == 0)
+        for mode in images:
+            n_diff = numpy.count_nonzero(numpy.any(images[mode] != images[ref_mode], axis=2))
+            if n_diff > 0:
+                print("WARN: frame {}: {} differs from {} in {} pixels".format(frame, mode, ref_mode, n_diff))
+                mismatches.append((frame, mode, n_diff))
+
+    src_engine.render_layers = _render_layers
+    gameloop.run(max_frames=n_frames, scripted_input=framebench.new_game_script(n_frames), uncapped=True)
+    return mismatches
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg.isdigit()]
+    zone_ids = [arg for arg in sys.argv[1:] if not arg.isdigit()]
+
+    n = int(args[0]) if len(args) > 0 else 1000
+    interval = int(args[1]) if len(args) > 1 else 1
+    zone = zone_ids[0] if len(zone_ids) > 0 else None
+
+    bad = run(n, check_interval=interval, zone_id=zone)
+    print("INFO: compared {} frames of {} draw modes, {} mismatches".format(n // interval, len(MODES), len(bad)))
+    if len(bad) > 0:
+        sys.exit(1)
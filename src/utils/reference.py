@@ -0,0 +1,186 @@
+"""
+The old, straightforward implementations of World queries that have since been optimized. The tests check that
+the optimized versions give the same results as these, and worldbench times them against each other.
+"""
+
+import random
+
+from src.utils.util import Utils
+
+
+def linear_get_entities_in_cell(world, grid_x, grid_y, cond=None):
+    """World.get_entities_in_cell, by scanning every entity."""
+    res = []
+    for e in world.all_entities():
+        if cond is None or cond(e):
+            grid_pos = world.to_grid_coords(e.center()[0], e.center()[1])
+            if grid_x == grid_pos[0] and grid_y == grid_pos[1]:
+                res.append(e)
+    return res
+
+
+def linear_get_actor_in_cell(world, grid_x, grid_y):
+    """World.get_actor_in_cell, by scanning every entity."""
+    for e in world.all_entities():
+        if e.is_actor():
+            grid_pos = world.to_grid_coords(e.center()[0], e.center()[1])
+            if grid_x == grid_pos[0] and grid_y == grid_pos[1]:
+                return e
+    return None
+
+
+def linear_is_solid(world, grid_x, grid_y, including_entities=False):
+    """World.is_solid, by scanning every entity."""
+    from src.world.worldstate import World
+    if world.get_geo(grid_x, grid_y) in World.SOLIDS:
+        return True
+    if including_entities:
+        if len(linear_get_entities_in_cell(world, grid_x, grid_y, cond=lambda e: e.is_solid(world))) > 0:
+            return True
+    return False
+
+
+def bfs_get_path_between(world, p1, p2, max_length=-1, cond=None):
+    """World.get_path_between, with a breadth-first search."""
+    if p1 == p2:
+        if cond is None or cond(p1):
+            return [p1]
+        else:
+            return None
+
+    if -1 < max_length < Utils.dist_manhattan(p1, p2):
+        return None
+
+    dists = {p1: 0}
+    backrefs = {p1: None}
+
+    q = [p1]
+    while len(q) > 0:
+        cur = q.pop(0)
+
+        n_dist = dists[cur] + 1
+        if n_dist > max_length > -1:
+            continue
+
+        neighbors = list(Utils.neighbors(cur[0], cur[1]))
+        random.shuffle(neighbors)
+
+        for n in neighbors:
+            if n in dists:
+                continue
+            dists[n] = n_dist
+            if world.is_valid(*n) and (cond is None or cond(n)):
+                backrefs[n] = cur
+                q.append(n)
+
+        if p2 in backrefs:
+            break
+
+    if p2 in backrefs:
+        res = [p2]
+        temp = backrefs[p2]
+        while temp is not None:
+            res.append(temp)
+            temp = backrefs[temp]
+        res.reverse()
+        return res
+    else:
+        return None
+
+
+def search_get_step_towards(world, grid_xy, target, max_length):
+    """World.get_step_towards, with a separate search for each step (the way enemies used to choose them)."""
+    path = world.get_path_between(grid_xy, target, max_length=max_length,
+                                  cond=lambda xy: xy == target or xy == grid_xy or not world.is_blocked(*xy))
+    return path[1] if path is not None and len(path) >= 2 else None
+
+
+def recalc_lighting(world, grid, old_lighting, new_lighting):
+    """
+        the old lighting algorithm, which re-floods every source whenever one is removed.
+        grid: list of lists of light levels, indexed [grid_x][grid_y]. it's updated in place.
+    """
+    from src.world.worldstate import World
+
+    def _set_lighting(x, y, val):
+        if world.is_valid(x, y) and world.get_geo(x, y) in (World.FLOOR, World.DOOR):
+            grid[x][y] = val
+
+    deleted = [src for src in old_lighting if src not in new_lighting]
+
+    for grid_x, grid_y, dist in deleted:
+        for x in range(grid_x - dist, grid_x + dist + 1):
+            for y in range(grid_y - dist, grid_y + dist + 1):
+                _set_lighting(x, y, 0.0)
+
+    if len(deleted) == 0:
+        to_add = [src for src in new_lighting if src not in old_lighting]
+    else:
+        to_add = new_lighting
+
+    for grid_x, grid_y, max_dist in to_add:
+        processed = set()
+        q = [(grid_x, grid_y)]
+        processed.add(q[0])
+        rect = [grid_x - max_dist, grid_y - max_dist, 2 * max_dist + 1, 2 * max_dist + 1]
+
+        while len(q) > 0:
+            x, y = q.pop()
+
+            xy_dist = Utils.dist((x, y), (grid_x, grid_y))
+            if xy_dist <= max_dist:
+                mult = Utils.bound((max_dist / 6) ** (2 / 3), 0, 1)
+                level = mult * (1 - (xy_dist / max_dist) ** 1.5)
+                if world.is_valid(x, y) and level > grid[x][y]:
+                    _set_lighting(x, y, level)
+
+                if (x, y) != (grid_x, grid_y) and world.is_solid(x, y):
+                    continue
+
+                for n in Utils.neighbors(x, y):
+                    if n not in processed and Utils.rect_contains(rect, n):
+                        processed.add(n)
+                        q.append(n)
+
+
+def scan_entities_in_rects(world, grid_rects):
+    """returns: the entities whose centers are inside any of the rects, in the order they were added to the world."""
+    return [e for e in world.all_entities()
+            if any(Utils.rect_contains(r, world.to_grid_coords(*e.center())) for r in grid_rects)]
+
+
+def loop_get_actors_ready_to_act(world, actors):
+    """World._get_actors_ready_to_act, with the old energy loop that adds speed to every actor one tick at a time."""
+    actors = list(actors)
+    actors.sort(key=lambda a: -1 if a.is_player() else a.get_uid())
+    res = [a for a in actors if a.get_actor_state().ready_to_act()]
+
+    while len(res) == 0 and len(actors) > 0:
+        for actor in actors:
+            a_state = actor.get_actor_state()
+
+            if a_state.energy() + a_state.speed() >= a_state.max_energy():
+                a_state.set_ready_to_act(True)
+                res.append(actor)
+
+            a_state.set_energy((a_state.energy() + a_state.speed()) % a_state.max_energy())
+
+    return res
+
+
+def uncached_stat_value(a_state, stat_type, local=False):
+    """ActorState.stat_value, adding everything up on every call."""
+    import src.game.debug as debug
+    from src.game.stats import StatTypes
+
+    res = a_state.base_stats.stat_value(stat_type, local=local)
+    for item in a_state.inventory().all_equipped_items():
+        res += item.stat_value(stat_type, local=local)
+
+    for status_effect in a_state.status_effects:
+        res += status_effect.stat_value(stat_type, local=local)
+
+    if a_state.is_player() and debug.insta_kill() and stat_type == StatTypes.ATT:
+        res += 99
+
+    return res
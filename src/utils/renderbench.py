@@ -0,0 +1,331 @@
+"""
+Benchmarks for the render engine's cpu-side work. Doesn't need an OpenGL context.
+"""
+
+import random
+import time
+
+import numpy
+
+import src.renderengine.img as img
+from src.renderengine.engine import _Layer, _DepthOrder
+from src.renderengine.img import ImageBundle, ImageModel
+
+SHEET_SIZE = (800, 3000)
+
+
+def _make_models(n):
+    res = []
+    for _ in range(0, n):
+        model = ImageModel(random.randint(0, 700), random.randint(0, 2900), random.randint(1, 64), random.randint(1, 64))
+        model.set_sheet_size(SHEET_SIZE)
+        res.append(model)
+    return res
+
+
+def make_bundles(n, layer_id=0, seed=12345):
+    random.seed(seed)
+    models = _make_models(50)
+    res = {}
+    for _ in range(0, n):
+        bun = ImageBundle(random.choice(models), random.randint(-500, 2000), random.randint(-500, 2000),
+                          layer=layer_id, scale=random.choice([1, 2, 3]), depth=random.randint(-100, 100),
+                          xflip=random.random() < 0.5, rotation=random.randint(0, 3),
+                          color=(random.random(), random.random(), random.random()),
+                          ratio=random.choice([(1, 1), (0.5, 1), (1, 0.25)]))
+        res[bun.uid()] = bun
+    return res
+
+
+def make_layer(bundles, sort_sprites=False, batched=True, instanced=False):
+    layer = _Layer("bench", 0, 0, sort_sprites, True, batched=batched, instanced=instanced)
+    for uid in bundles:
+        layer.update(uid)
+    return layer
+
+
+def time_rebuilds(layer, bundles, n_runs):
+    """returns: average seconds per full rebuild"""
+    start = time.perf_counter()
+    for _ in range(0, n_runs):
+        for uid in bundles:
+            layer.update(uid)
+        layer.rebuild(bundles)
+    return (time.perf_counter() - start) / n_runs
+
+
+def layers_are_equal(l1, l2):
+    return (l1.images == l2.images
+            and numpy.array_equal(l1.vertices, l2.vertices)
+            and numpy.array_equal(l1.tex_coords, l2.tex_coords)
+            and numpy.array_equal(l1.colors, l2.colors)
+            and numpy.array_equal(l1.indices, l2.indices))
+
+
+def quads_by_uid(layer):
+    """returns: uid -> (vertices, tex_coords, colors) for each sprite in the layer, independent of draw order."""
+    res = {}
+    for i, uid in enumerate(layer.images):
+        res[uid] = (tuple(layer.vertices[i * 8:(i + 1) * 8]),
+                    tuple(layer.tex_coords[i * 8:(i + 1) * 8]),
+                    tuple(layer.colors[i * 12:(i + 1) * 12]))
+    return res
+
+
+def _mutate_bundles(bundles, n_moved, n_replaced, layer_id=0):
+    """moves some bundles and swaps some out for new ones, like a typical frame of gameplay."""
+    uids = list(bundles.keys())
+    moved = random.sample(uids, n_moved)
+    removed = random.sample(uids, n_replaced)
+    for uid in moved:
+        bun = bundles[uid]
+        bundles[uid] = bun.update(new_x=bun.x() + random.randint(-2, 2), new_y=bun.y() + random.randint(-2, 2))
+
+    for uid in removed:
+        bundles.pop(uid).release()
+    added = make_bundles(n_replaced, layer_id=layer_id, seed=random.randint(0, 99999))
+    bundles.update(added)
+
+    return [uid for uid in moved if uid not in removed] + list(added.keys()), removed
+
+
+def remove_all_in_place(l, elements):
+    if len(l) == 0:
+        return l
+
+    rem_set = set(elements)
+    last_element = len(l) - 1
+    i = 0
+
+    while i <= last_element:
+        if l[i] in rem_set:
+            while i <= last_element and l[last_element] in rem_set:
+                last_element -= 1
+            if i > last_element:
+                break
+            else:
+                l[i] = l[last_element]
+                last_element -= 1
+        i += 1
+
+    del l[(last_element+1):]
+
+
+def _full_rebuild(layer, bundle_lookup):
+    """the old way layers were rebuilt, rewriting every sprite each time. kept as a baseline."""
+    if len(layer._to_remove) > 0:
+        for bun_id in layer._to_remove:
+            if bun_id in layer._image_set:
+                layer._image_set.remove(bun_id)
+
+        remove_all_in_place(layer.images, layer._to_remove)
+        remove_all_in_place(layer._to_add, layer._to_remove)
+        layer._to_remove.clear()
+
+    if len(layer._to_add) > 0:
+        layer.images.extend(layer._to_add)
+        layer._to_add.clear()
+
+    layer._dirty_sprites.clear()
+
+    if layer.sort_sprites:
+        layer.images.sort(key=lambda x: -bundle_lookup[x].depth())
+
+    n_sprites = len(layer.images)
+    layer._resize_buffers(n_sprites)
+    layer._write_slots(bundle_lookup, range(0, n_sprites))
+    layer._mark_gpu_dirty(0, n_sprites)
+
+
+def time_frames(layers, bundles, n_frames, n_moved, n_replaced, rebuild_functs):
+    """returns: list of average seconds spent rebuilding per frame, for each layer"""
+    random.seed(54321)
+    totals = [0] * len(layers)
+    for _ in range(0, n_frames):
+        updated, removed = _mutate_bundles(bundles, n_moved, n_replaced)
+        for i, layer in enumerate(layers):
+            for uid in removed:
+                layer.remove(uid)
+            for uid in updated:
+                layer.update(uid)
+
+            start = time.perf_counter()
+            rebuild_functs[i](bundles)
+            totals[i] += time.perf_counter() - start
+
+    return [t / n_frames for t in totals]
+
+
+def bench_batched_rebuild(sizes=(1000, 5000, 20000), n_runs=5):
+    print("INFO: full layer rebuild, per-sprite vs. batched")
+    for n in sizes:
+        bundles = make_bundles(n)
+        per_sprite = make_layer(bundles, batched=False)
+        batched = make_layer(bundles, batched=True)
+
+        t_per_sprite = time_rebuilds(per_sprite, bundles, n_runs)
+        t_batched = time_rebuilds(batched, bundles, n_runs)
+
+        if not layers_are_equal(per_sprite, batched):
+            raise ValueError("batched rebuild output differs from per-sprite rebuild (n={})".format(n))
+
+        print("\tn={}\tper_sprite={:.2f}ms\tbatched={:.2f}ms\t({:.1f}x)".format(
+            n, t_per_sprite * 1000, t_batched * 1000, t_per_sprite / t_batched))
+
+
+def bench_dirty_slot_updates(sizes=(1000, 5000, 20000), n_frames=20, n_moved=10, n_replaced=2):
+    print("INFO: per-frame rebuild with {} moved and {} replaced sprites, full vs. dirty slots".format(
+        n_moved, n_replaced))
+    for n in sizes:
+        bundles = make_bundles(n)
+        full = make_layer(bundles)
+        _full_rebuild(full, bundles)
+        slotted = make_layer(bundles)
+        slotted.rebuild(bundles)
+
+        t_full, t_slotted = time_frames([full, slotted], bundles, n_frames, n_moved, n_replaced,
+                                        [lambda b: _full_rebuild(full, b), slotted.rebuild])
+
+        if quads_by_uid(full) != quads_by_uid(slotted):
+            raise ValueError("dirty slot rebuild output differs from full rebuild (n={})".format(n))
+
+        print("\tn={}\tfull={:.2f}ms\tdirty_slots={:.3f}ms\t({:.1f}x)".format(
+            n, t_full * 1000, t_slotted * 1000, t_full / t_slotted))
+
+
+def bench_depth_ordering(sizes=(1000, 5000, 20000), n_frames=50, n_updated=40, n_depth_changes=10):
+    print("INFO: ordering a sorted layer with {} updated sprites ({} changing depth), full sort vs. "
+          "re-inserting".format(n_updated, n_depth_changes))
+    for n in sizes:
+        bundles = make_bundles(n)
+        images = list(bundles.keys())
+        images.sort(key=lambda x: -bundles[x].depth())
+
+        order = _DepthOrder()
+        order.apply([], {uid: bundles[uid].depth() for uid in bundles})
+
+        random.seed(4444)
+        t_sort = 0
+        t_order = 0
+        for _ in range(0, n_frames):
+            updated = random.sample(images, n_updated)
+            for uid in updated[:n_depth_changes]:
+                bundles[uid] = bundles[uid].update(new_depth=random.randint(-100, 100))
+
+            start = time.perf_counter()
+            images.sort(key=lambda x: -bundles[x].depth())
+            t_sort += time.perf_counter() - start
+
+            start = time.perf_counter()
+            order.apply([], {uid: bundles[uid].depth() for uid in updated})
+            t_order += time.perf_counter() - start
+
+        if [bundles[uid].depth() for uid in images] != [bundles[uid].depth() for uid in order.uids]:
+            raise ValueError("depth order differs from full sort (n={})".format(n))
+
+        print("\tn={}\tfull_sort={:.3f}ms\tre-insert={:.3f}ms\t({:.1f}x)".format(
+            n, t_sort * 1000 / n_frames, t_order * 1000 / n_frames, t_sort / t_order))
+
+
+class _FakeEngine:
+    """stands in for a RenderEngine when layers only need to know the screen size."""
+
+    def __init__(self, game_size):
+        self.game_size = game_size
+
+    def get_game_size(self):
+        return self.game_size
+
+
+def bench_culling(sizes=(1000, 5000, 20000), world_size=(4000, 4000), game_size=(400, 300), n_frames=50):
+    print("INFO: culling a {}x{} view of a {}x{} world".format(*game_size, *world_size))
+    engine = _FakeEngine(game_size)
+    for n in sizes:
+        random.seed(777)
+        models = _make_models(20)
+        bundles = {}
+        for _ in range(0, n):
+            bun = ImageBundle(random.choice(models), random.randint(0, world_size[0]), random.randint(0, world_size[1]),
+                              scale=random.choice([1, 2]))
+            bundles[bun.uid()] = bun
+
+        layer = _Layer("bench", 0, 0, False, True, cull_cell_size=32)
+        for uid in bundles:
+            layer.update(uid)
+        layer.rebuild(bundles)
+
+        total = 0
+        for _ in range(0, n_frames):
+            layer.set_offset(random.randint(0, world_size[0]), random.randint(0, world_size[1]))
+            start = time.perf_counter()
+            layer.update_visible_sprites(engine)
+            total += time.perf_counter() - start
+
+            ox, oy = layer.offset()
+            drawn = set(layer.drawn_indices()[::6] // 4)
+            for uid, bun in bundles.items():
+                w, h = bun.size()
+                overlaps = (bun.x() < ox + game_size[0] and ox < bun.x() + w
+                            and bun.y() < oy + game_size[1] and oy < bun.y() + h)
+                if overlaps and layer._slots[uid] not in drawn:
+                    raise ValueError("visible sprite was culled (n={}, uid={})".format(n, uid))
+
+        print("\tn={}\tdrawn={}\tculled={}\tcull_time={:.3f}ms".format(
+            n, layer.num_drawn(), layer.num_culled(), total * 1000 / n_frames))
+
+
+_INSTANCE_OFFSETS = numpy.array([[0, 0], [0, 1], [1, 1], [1, 0]], dtype=numpy.float32)
+
+
+def expand_instances(instances):
+    """
+        does what the instanced vertex shader does, on the cpu.
+        returns: (vertices, tex_coords, colors) in the same layout write_quads produces.
+    """
+    records = instances.reshape(-1, img.INSTANCE_STRIDE)
+    n = len(records)
+
+    vertices = records[:, None, 0:2] + _INSTANCE_OFFSETS[None, :, :] * records[:, None, 2:4]
+
+    u1, v1, u2, v2 = records[:, 4], records[:, 5], records[:, 6], records[:, 7]
+    tex_corners = numpy.stack([numpy.stack([u1, v2], axis=1), numpy.stack([u1, v1], axis=1),
+                               numpy.stack([u2, v1], axis=1), numpy.stack([u2, v2], axis=1)], axis=1)
+    rot = records[:, 8].astype(numpy.int32)
+    corner_idx = (numpy.arange(4)[None, :] + rot[:, None]) % 4
+    tex_coords = tex_corners[numpy.arange(n)[:, None], corner_idx]
+
+    colors = numpy.repeat(records[:, 9:12], 4, axis=0)
+
+    return vertices.reshape(-1), tex_coords.reshape(-1), colors.reshape(-1)
+
+
+def bench_instancing(sizes=(1000, 5000, 20000), n_runs=5):
+    print("INFO: full layer rebuild, quads vs. instance records")
+    for n in sizes:
+        bundles = make_bundles(n)
+        quads = make_layer(bundles)
+        instanced = make_layer(bundles, instanced=True)
+
+        t_quads = time_rebuilds(quads, bundles, n_runs)
+        t_instanced = time_rebuilds(instanced, bundles, n_runs)
+
+        vertices, tex_coords, colors = expand_instances(instanced.instances)
+        if (quads.images != instanced.images
+                or not numpy.allclose(quads.vertices, vertices)
+                or not numpy.allclose(quads.tex_coords, tex_coords)
+                or not numpy.allclose(quads.colors, colors)):
+            raise ValueError("expanded instance records differ from quads (n={})".format(n))
+
+        quad_bytes = quads.vertices.nbytes + quads.tex_coords.nbytes + quads.colors.nbytes
+        instance_bytes = instanced.instances.nbytes
+
+        print("\tn={}\tquads={:.2f}ms\tinstances={:.2f}ms\t({:.1f}x)\tbytes/sprite: quads={} instances={}".format(
+            n, t_quads * 1000, t_instanced * 1000, t_quads / t_instanced, quad_bytes // n, instance_bytes // n))
+
+
+if __name__ == "__main__":
+    bench_batched_rebuild()
+    bench_dirty_slot_updates()
+    bench_depth_ordering()
+    bench_culling()
+    bench_instancing()
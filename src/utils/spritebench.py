@@ -0,0 +1,164 @@
+"""
+Checks that the spritesheet generated by spriteref matches the original per-pixel implementation,
+and times how long each version takes to build the sheet. Also checks that packing the sheet into
+atlas pages keeps every sprite's pixels. Doesn't need a display.
+"""
+
+import math
+import time
+
+import pygame
+
+import src.game.spriteref as spriteref
+import src.utils.geometricgen as geometricgen
+from src.utils.util import Utils
+
+
+def _draw_cd_image_per_pixel(sheet, rect, prog, color):
+    c_x = rect[0] + rect[2] / 2
+    c_y = rect[1] + rect[3] / 2
+    for x in range(rect[0], rect[0] + rect[2]):
+        for y in range(rect[1], rect[1] + rect[3]):
+            if x % 2 == y % 2:
+                continue
+            angle_prog = (math.atan2(c_y - y, c_x - x) + math.pi) / (2 * math.pi)
+            if angle_prog > prog:
+                sheet.set_at((x, y), color)
+
+
+def _draw_dark_floor_per_pixel(sheet, darkness, src_rect, dest_rect):
+    sheet.blit(sheet, dest_rect, src_rect)
+
+    MAX_CHANGE = 224
+
+    for x in range(dest_rect[0], dest_rect[0] + dest_rect[2]):
+        for y in range(dest_rect[1], dest_rect[1] + dest_rect[3]):
+            rgb = list(sheet.get_at((x, y)))
+            for i in range(0, 3):
+                val = rgb[i] / 255
+                new_val = (1 - darkness) * val ** (1 / (1 - darkness))
+                new_val = max(val - MAX_CHANGE, new_val)
+                rgb[i] = int(255 * new_val)
+            sheet.set_at((x, y), rgb)
+
+
+def _replace_color_per_pixel(sheet, rect, rgb, rgba):
+    for x in range(rect[0], rect[0] + rect[2]):
+        for y in range(rect[1], rect[1] + rect[3]):
+            if x < 0 or x >= sheet.get_width() or y < 0 or y >= sheet.get_height():
+                continue
+            if sheet.get_at((x, y)) == rgb:
+                sheet.set_at((x, y), rgba)
+
+
+class _TimedFunct:
+
+    def __init__(self, funct):
+        self.funct = funct
+        self.total_time = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        self.funct(*args, **kwargs)
+        self.total_time += time.perf_counter() - start
+
+
+def build_sheet(per_pixel):
+    """returns: (Surface, build time, cooldown drawing time, floor drawing time, effect circle recoloring time)"""
+    raw_imgs = [pygame.image.load(Utils.resource_path(path)) for path in spriteref.SOURCE_IMAGES]
+
+    orig_draw_cd_image = spriteref._draw_cd_image
+    orig_draw_dark_floor = spriteref._draw_dark_floor
+    orig_replace_color = geometricgen.replace_color
+    draw_cd_image = _TimedFunct(_draw_cd_image_per_pixel if per_pixel else orig_draw_cd_image)
+    draw_dark_floor = _TimedFunct(_draw_dark_floor_per_pixel if per_pixel else orig_draw_dark_floor)
+    replace_color = _TimedFunct(_replace_color_per_pixel if per_pixel else orig_replace_color)
+
+    n_imgs_before = len(spriteref.all_imgs)
+    spriteref._draw_cd_image = draw_cd_image
+    spriteref._draw_dark_floor = draw_dark_floor
+    geometricgen.replace_color = replace_color
+    try:
+        start = time.perf_counter()
+        sheet = spriteref.build_spritesheet(*raw_imgs)
+        build_time = time.perf_counter() - start
+    finally:
+        spriteref._draw_cd_image = orig_draw_cd_image
+        spriteref._draw_dark_floor = orig_draw_dark_floor
+        geometricgen.replace_color = orig_replace_color
+        del spriteref.all_imgs[n_imgs_before:]
+
+    return sheet, build_time, draw_cd_image.total_time, draw_dark_floor.total_time, replace_color.total_time
+
+
+def find_differences(sheet1, sheet2, max_results=10):
+    """returns: list of (x, y, color1, color2) for pixels that differ between the sheets"""
+    if sheet1.get_size() != sheet2.get_size():
+        raise ValueError("sheets have different sizes: {} and {}".format(sheet1.get_size(), sheet2.get_size()))
+
+    res = []
+    for x in range(0, sheet1.get_width()):
+        for y in range(0, sheet1.get_height()):
+            c1 = sheet1.get_at((x, y))
+            c2 = sheet2.get_at((x, y))
+            if c1 != c2:
+                res.append((x, y, tuple(c1), tuple(c2)))
+                if len(res) >= max_results:
+                    return res
+    return res
+
+
+def check_spritesheet():
+    print("INFO: building spritesheet, per-pixel vs. numpy")
+    old_sheet, old_time, old_cd_time, old_floor_time, old_circle_time = build_sheet(per_pixel=True)
+    new_sheet, new_time, new_cd_time, new_floor_time, new_circle_time = build_sheet(per_pixel=False)
+
+    if pygame.image.tostring(old_sheet, "RGBA") != pygame.image.tostring(new_sheet, "RGBA"):
+        diffs = find_differences(old_sheet, new_sheet)
+        raise ValueError("numpy spritesheet differs from per-pixel spritesheet, first differences: {}".format(diffs))
+
+    print("\tcooldowns\tper_pixel={:.1f}ms\tnumpy={:.1f}ms\t({:.1f}x)".format(
+        old_cd_time * 1000, new_cd_time * 1000, old_cd_time / new_cd_time))
+    print("\tdark floors\tper_pixel={:.1f}ms\tnumpy={:.1f}ms\t({:.1f}x)".format(
+        old_floor_time * 1000, new_floor_time * 1000, old_floor_time / new_floor_time))
+    print("\teffect circles\tper_pixel={:.1f}ms\tnumpy={:.1f}ms\t({:.1f}x)".format(
+        old_circle_time * 1000, new_circle_time * 1000, old_circle_time / new_circle_time))
+    print("\twhole sheet\tper_pixel={:.1f}ms\tnumpy={:.1f}ms\t({:.1f}x)".format(
+        old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+def check_atlas(page_sizes=((2048, 2048), (1024, 1024), (512, 512))):
+    print("INFO: packing spritesheet into atlas pages")
+    raw_imgs = [pygame.image.load(Utils.resource_path(path)) for path in spriteref.SOURCE_IMAGES]
+
+    n_imgs_before = len(spriteref.all_imgs)
+    try:
+        sheet = spriteref.build_spritesheet(*raw_imgs)
+        orig_rects = {img: img.rect() for img in spriteref.all_imgs}
+
+        for page_size in page_sizes:
+            start = time.perf_counter()
+            pages = spriteref.build_atlas_pages(sheet, page_size=page_size)
+            pack_time = time.perf_counter() - start
+
+            for img, rect in orig_rects.items():
+                if rect[2] <= 0 or rect[3] <= 0:
+                    continue
+                orig = pygame.image.tostring(sheet.subsurface(rect), "RGBA")
+                packed = pygame.image.tostring(pages[img.page].subsurface(img.rect()), "RGBA")
+                if orig != packed:
+                    raise ValueError("sprite {} moved to {} on page {} has different pixels (page_size={})".format(
+                        rect, img.rect(), img.page, page_size))
+
+            # put the models back, so the next page size starts from the original sheet
+            for img, rect in orig_rects.items():
+                img.set_atlas_location(0, rect[0], rect[1], sheet.get_size())
+
+            print("\tpage_size={}\tpages={}\tpack_time={:.1f}ms".format(page_size, len(pages), pack_time * 1000))
+    finally:
+        del spriteref.all_imgs[n_imgs_before:]
+
+
+if __name__ == "__main__":
+    check_spritesheet()
+    check_atlas()
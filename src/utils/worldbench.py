@@ -0,0 +1,374 @@
+"""
+Benchmarks the enemy AI's turn loop and the World queries behind it on a zone that's been filled up with enemies,
+timing each optimized query against the old implementation in src/utils/reference.py. Runs without a display
+(see renderengine/headless.py). The tests in tests/test_world.py check that they give the same results.
+
+usage: python -m src.utils.worldbench [n_entities] [n_rounds] [zone_id]
+"""
+
+import random
+import sys
+import time
+
+import numpy
+
+import src.utils.reference as reference
+
+DEFAULT_ZONE_ID = "city_3"  # one of the larger procedurally generated zones
+
+
+def build_crowded_world(zone_id, n_entities, seed=12345):
+    """
+        builds the zone and adds random enemies on empty floor cells until it has n_entities entities.
+        all the floors are revealed so that the enemies will path towards the player.
+        returns: World
+    """
+    import src.worldgen.zones as zones
+    from src.world.worldstate import World
+    from src.game.enemies import EnemyFactory
+
+    random.seed(seed)
+    world = zones.build_world(zone_id)
+    level = zones.get_zone(zone_id).get_level()
+
+    floors = [(x, y) for x in range(0, world.size()[0]) for y in range(0, world.size()[1])
+              if world.get_geo(x, y) == World.FLOOR and not world.is_solid(x, y, including_entities=True)]
+    random.shuffle(floors)
+
+    while world.num_entities() < n_entities and len(floors) > 0:
+        world.add(EnemyFactory.gen_enemy(None, level), gridcell=floors.pop())
+        world.flush_new_entity_additions()
+
+    for x in range(0, world.size()[0]):
+        for y in range(0, world.size()[1]):
+            world.set_hidden(x, y, False, and_fill_adj_floors=False)
+
+    return world
+
+
+def _time_per_call(func, args_list, n_repeats=1):
+    """returns: the mean duration of func(*args) over args_list, in microseconds."""
+    start_time = time.perf_counter()
+    for _ in range(0, n_repeats):
+        for args in args_list:
+            func(*args)
+    return (time.perf_counter() - start_time) * 1e6 / max(1, n_repeats * len(args_list))
+
+
+def _print_comparison(what, old_us, new_us):
+    print("\t{:<36}  old={:.2f}us\tnew={:.2f}us per call ({:.1f}x faster)".format(
+        what, old_us, new_us, old_us / max(new_us, 1e-9)))
+
+
+def run_turns(world, n_rounds, seed=0):
+    """
+        every enemy picks its next action, and movement actions are applied immediately (without animating).
+        the world is restored to its starting positions afterwards.
+        returns: list of the duration of each round in seconds
+    """
+    enemies = [a for a in world.get_actors() if not a.is_player()]
+    start_positions = {e: e.center() for e in enemies}
+
+    random.seed(seed)
+    round_times = []
+
+    for _ in range(0, n_rounds):
+        start_time = time.perf_counter()
+        for e in enemies:
+            world.start_actor_turn(e)
+            action = e.get_controller().get_actual_next_action(e, world)
+            if action.is_move_action():
+                e.set_center(*world.cell_center(*action.get_position()))
+        round_times.append(time.perf_counter() - start_time)
+
+    for e in enemies:
+        e.set_center(*start_positions[e])
+
+    return round_times
+
+
+def bench_turns(world, n_rounds):
+    """times the whole turn loop, and reports how often the enemies' stat lookups hit the cache."""
+    actors = world.get_actors()
+    counts_before = [a.get_actor_state().get_stat_cache_counts() for a in actors]
+
+    times = numpy.array(run_turns(world, n_rounds)) * 1000
+
+    counts_after = [a.get_actor_state().get_stat_cache_counts() for a in actors]
+    hits = sum(after[0] - before[0] for before, after in zip(counts_before, counts_after))
+    misses = sum(after[1] - before[1] for before, after in zip(counts_before, counts_after))
+
+    print("INFO: {} entities ({} actors), {} rounds".format(world.num_entities(), len(actors), n_rounds))
+    print("\tturn loop  mean={:.2f}ms\tp50={:.2f}ms\tmax={:.2f}ms per round, {:.1f}% stat cache hit rate".format(
+        numpy.mean(times), numpy.percentile(times, 50), numpy.max(times), 100 * hits / max(1, hits + misses)))
+
+
+def bench_cell_queries(world, n_repeats=5):
+    """times the cell queries the AI makes (every cell around each enemy) with the cell index and the linear scan."""
+    cells = []
+    for e in world.get_actors():
+        x, y = world.to_grid_coords(*e.center())
+        cells.extend((x + dx, y + dy) for dx in range(-2, 3) for dy in range(-2, 3))
+
+    print("INFO: cell queries on {} cells".format(len(cells)))
+    _print_comparison("get_entities_in_cell",
+                      _time_per_call(lambda x, y: reference.linear_get_entities_in_cell(world, x, y), cells, n_repeats),
+                      _time_per_call(world.get_entities_in_cell, cells, n_repeats))
+    _print_comparison("get_actor_in_cell",
+                      _time_per_call(lambda x, y: reference.linear_get_actor_in_cell(world, x, y), cells, n_repeats),
+                      _time_per_call(world.get_actor_in_cell, cells, n_repeats))
+    _print_comparison("is_solid(including_entities=True)",
+                      _time_per_call(lambda x, y: reference.linear_is_solid(world, x, y, True), cells, n_repeats),
+                      _time_per_call(lambda x, y: world.is_solid(x, y, including_entities=True), cells, n_repeats))
+
+
+def bench_pathing(world):
+    """times the old breadth-first search and A* on the searches enemies used to make (to every cell in range)."""
+    import src.game.balance as balance
+    from src.world.worldstate import World
+
+    max_length = balance.ENEMY_SMART_PATHING_RANGE
+
+    searches = []
+    for e in world.get_actors():
+        if e.is_player():
+            continue
+        p1 = world.to_grid_coords(*e.center())
+        for dx in range(-max_length, max_length + 1):
+            for dy in range(-max_length, max_length + 1):
+                p2 = (p1[0] + dx, p1[1] + dy)
+                if abs(dx) + abs(dy) <= max_length and world.get_geo(*p2) == World.FLOOR:
+                    cond = (lambda a, b: lambda xy: xy == a or xy == b or not world.is_blocked(*xy))(p1, p2)
+                    searches.append((p1, p2, max_length, cond))
+
+    print("INFO: {} searches with max_length={}".format(len(searches), max_length))
+    world.start_actor_turn(world.get_player())
+    random.seed(0)
+    _print_comparison("bfs -> a* get_path_between",
+                      _time_per_call(lambda *args: reference.bfs_get_path_between(world, *args), searches),
+                      _time_per_call(world.get_path_between, searches))
+
+
+def bench_distance_field(world, n_repeats=5):
+    """
+        times choosing a step towards the player from every floor cell near it (as if an enemy were standing there),
+        with a separate A* search for each one and by descending the shared distance field.
+    """
+    import src.game.balance as balance
+    from src.world.worldstate import World
+
+    max_length = balance.ENEMY_SMART_PATHING_RANGE
+    p_pos = world.to_grid_coords(*world.get_player().center())
+    steps = [((x, y), p_pos, max_length) for x in range(p_pos[0] - max_length, p_pos[0] + max_length + 1)
+             for y in range(p_pos[1] - max_length, p_pos[1] + max_length + 1)
+             if (x, y) != p_pos and world.get_geo(x, y) == World.FLOOR]
+
+    def _new_turn_then(func):
+        # each step gets its own turn, like a crowd of enemies that can't move much
+        def _step(*args):
+            world.start_actor_turn(None)
+            return func(*args)
+        return _step
+
+    print("INFO: {} cells near the player".format(len(steps)))
+    _print_comparison("a* per enemy -> shared field",
+                      _time_per_call(_new_turn_then(lambda *args: reference.search_get_step_towards(world, *args)),
+                                     steps, n_repeats),
+                      _time_per_call(_new_turn_then(world.get_step_towards), steps, n_repeats))
+
+
+def bench_lighting(world, n_steps, n_sources=12, seed=0):
+    """times the old and incremental lighting on a torch that walks around among some lamps that don't move."""
+    from src.world.worldstate import World
+
+    rand = random.Random(seed)
+    w, h = world.size()
+    floors = [(x, y) for x in range(0, w) for y in range(0, h) if world.get_geo(x, y) == World.FLOOR]
+
+    static = set()
+    while len(static) < n_sources:
+        xy = rand.choice(floors)
+        static.add((xy[0], xy[1], rand.randint(2, 6)))
+    walk = floors[len(floors) // 3:len(floors) // 3 + n_steps]
+
+    def _walk(recalc, lighting):
+        start_time = time.perf_counter()
+        for xy in walk:
+            new_lighting = static | {(xy[0], xy[1], 6)}
+            recalc(lighting, new_lighting)
+            lighting = new_lighting
+        return (time.perf_counter() - start_time) * 1e6 / max(1, len(walk)), lighting
+
+    grid = [[0.0] * h for _ in range(0, w)]
+    old_time = _walk(lambda old, new: reference.recalc_lighting(world, grid, old, new), set())[0]
+    new_time, lighting = _walk(world._recalc_lighting, set(world._cached_light_sources))
+
+    print("INFO: moving torch with {} static lights, {} steps".format(n_sources, len(walk)))
+    _print_comparison("full -> incremental _recalc_lighting", old_time, new_time)
+
+    world._recalc_lighting(lighting, world._cached_light_sources)
+
+
+def bench_entity_updates(world, n_frames):
+    """
+        runs World.update_all with the camera following the player around, and times the cell index's chunk query
+        for the rects it wakes entities up in against scanning every entity.
+    """
+    import src.game.globalstate as gs
+    from src.world.worldstate import World
+
+    player = world.get_player()
+    start_xy = player.center()
+    start_cell = world.to_grid_coords(*start_xy)
+    act_range = world._entity_act_range
+
+    times = []
+    n_awake = []
+    queries = []
+    for i in range(0, n_frames):
+        # wander back and forth so that entities keep waking up and falling asleep
+        x = start_cell[0] + (i // 4) % 24 - 12
+        if world.is_valid(x, start_cell[1]) and world.get_geo(x, start_cell[1]) == World.FLOOR:
+            player.set_center(*world.cell_center(x, start_cell[1]))
+        gs.get_instance().set_camera_center_in_world(*player.center())
+
+        # actors don't act, so that every frame does the same kind of work
+        gs.get_instance().pause_world_updates(2)
+
+        start_time = time.perf_counter()
+        world.update_all()
+        times.append(time.perf_counter() - start_time)
+        n_awake.append(len(world._onscreen_entities))
+
+        # the same rects update_all asks for
+        cam_rect = gs.get_instance().get_world_camera_rect(fudge=int(world.cellsize() * 1.5))
+        cam_xy = world.to_grid_coords(cam_rect[0], cam_rect[1])
+        cam_br = world.to_grid_coords(cam_rect[0] + cam_rect[2], cam_rect[1] + cam_rect[3])
+        p_xy = world.to_grid_coords(*player.center())
+        queries.append(([[cam_xy[0], cam_xy[1], cam_br[0] - cam_xy[0] + 1, cam_br[1] - cam_xy[1] + 1],
+                         [p_xy[0] - act_range[0], p_xy[1] - act_range[1], act_range[0] * 2 + 1, act_range[1] * 2 + 1]],))
+
+    player.set_center(*start_xy)
+    gs.get_instance().set_camera_center_in_world(*start_xy)
+
+    times = numpy.array(times) * 1000
+    print("INFO: update_all mean={:.3f}ms\tp50={:.3f}ms\tmax={:.3f}ms per frame, {:.1f} of {} entities awake".format(
+        numpy.mean(times), numpy.percentile(times, 50), numpy.max(times), numpy.mean(n_awake), world.num_entities()))
+    _print_comparison("full scan -> get_near_rects",
+                      _time_per_call(lambda rects: reference.scan_entities_in_rects(world, rects), queries),
+                      _time_per_call(world._cell_index.get_near_rects, queries))
+
+
+def bench_turn_order(world, n_turns, seed=0):
+    """
+        times picking the actors that are ready to act with the old energy loop and the scheduler, on the same
+        sequence of turns. each turn, the first ready actor acts.
+    """
+    actors = world.get_actors()
+    start_states = {a: (a.get_actor_state().energy(), a.get_actor_state().ready_to_act()) for a in actors}
+
+    def _play_turns(get_ready):
+        rand = random.Random(seed)
+        for a in actors:
+            a.get_actor_state().set_energy(start_states[a][0])
+            a.get_actor_state().set_ready_to_act(start_states[a][1])
+
+        elapsed = 0
+        for _ in range(0, n_turns):
+            # a random subset of actors is in range of the player each turn
+            in_range = [a for a in actors if rand.random() < 0.8]
+            rand.shuffle(in_range)
+
+            start_time = time.perf_counter()
+            ready = get_ready(in_range)
+            elapsed += time.perf_counter() - start_time
+
+            if len(ready) > 0:
+                ready[0].get_actor_state().set_ready_to_act(False)
+        return elapsed * 1e6 / max(1, n_turns)
+
+    old_time = _play_turns(lambda in_range: reference.loop_get_actors_ready_to_act(world, in_range))
+    new_time = _play_turns(world._get_actors_ready_to_act)
+
+    for a in actors:
+        a.get_actor_state().set_energy(start_states[a][0])
+        a.get_actor_state().set_ready_to_act(start_states[a][1])
+
+    print("INFO: {} turns with {} actors".format(n_turns, len(actors)))
+    _print_comparison("energy loop -> scheduler", old_time, new_time)
+
+
+def bench_stats(world, n_repeats=100):
+    """times the stat lookups the AI makes while choosing an action, with and without the cache."""
+    from src.game.stats import StatTypes
+
+    lookups = [(actor.get_actor_state(), stat_type) for actor in world.get_actors()
+               for stat_type in (StatTypes.SPEED, StatTypes.INTELLIGENCE, StatTypes.UNARMED_RANGE, StatTypes.ATT)]
+
+    print("INFO: {} stat lookups".format(len(lookups)))
+    _print_comparison("uncached -> cached stat_value",
+                      _time_per_call(reference.uncached_stat_value, lookups, n_repeats),
+                      _time_per_call(lambda a_state, stat_type: a_state.stat_value(stat_type), lookups, n_repeats))
+
+
+def bench_geo_streaming(world, speeds=(1, 2, 4), n_passes=2):
+    """
+        pans the camera (and player) back and forth across the world at a few speeds, and times how long the
+        WorldView takes to update its onscreen geo bundles each frame.
+    """
+    import src.game.globalstate as gs
+    from src.world.worldview import WorldView
+
+    player = world.get_player()
+    start_xy = player.center()
+    row = world.to_grid_coords(*start_xy)[1]
+    w = world.size()[0]
+
+    print("INFO: geo streaming")
+    for speed in speeds:
+        view = WorldView(world)
+        xs = list(range(0, w, speed)) + list(range(w - 1, -1, -speed))
+
+        times = []
+        for _ in range(0, n_passes):
+            for x in xs:
+                player.set_center(*world.cell_center(x, row))
+                gs.get_instance().set_camera_center_in_world(*player.center())
+
+                start_time = time.perf_counter()
+                view._update_onscreen_tile_bundles()
+                times.append(time.perf_counter() - start_time)
+
+        view.cleanup_active_bundles()
+        times = numpy.array(times) * 1000
+        print("\tpan at {} cells/frame: mean={:.3f}ms\tp50={:.3f}ms\tp99={:.3f}ms\tmax={:.3f}ms".format(
+            speed, numpy.mean(times), numpy.percentile(times, 50), numpy.percentile(times, 99), numpy.max(times)))
+
+    player.set_center(*start_xy)
+    gs.get_instance().set_camera_center_in_world(*start_xy)
+
+
+if __name__ == "__main__":
+    import src.game.gameloop as gameloop
+    gameloop.init("Skeletris", headless=True)
+
+    from src.renderengine.engine import RenderEngine
+    RenderEngine.get_instance().init(*gameloop.DEFAULT_SCREEN_SIZE)
+
+    args = [arg for arg in sys.argv[1:] if arg.isdigit()]
+    zone_ids = [arg for arg in sys.argv[1:] if not arg.isdigit()]
+
+    n_entities = int(args[0]) if len(args) > 0 else 200
+    n_rounds = int(args[1]) if len(args) > 1 else 20
+    zone_id = zone_ids[0] if len(zone_ids) > 0 else DEFAULT_ZONE_ID
+
+    w = build_crowded_world(zone_id, n_entities)
+    bench_turns(w, n_rounds)
+    bench_cell_queries(w)
+    bench_pathing(w)
+    bench_distance_field(w)
+    bench_lighting(w, n_rounds * 10)
+    bench_geo_streaming(w)
+    bench_entity_updates(w, n_rounds * 20)
+    bench_turn_order(w, n_rounds * 100)
+    bench_stats(w)
@@ -40,6 +40,7 @@ class Entity:
         self._shadow = None  # shadow image: ImageBundle
         self._last_vel = (0, 0)
         self._alive = False  # World sets this upon adding/removing the entity
+        self._cell_index = None  # the World's EntityCellIndex, while the entity is in a World
 
     def __str__(self):
         typename = type(self).__name__
@@ -77,6 +78,10 @@ class Entity:
     def get_light_level(self):
         return 0
 
+    def emits_light(self):
+        """whether get_light_level can ever be above 0."""
+        return False
+
     def get_map_identifier(self):
         """returns: (char, color) or None"""
         return None
@@ -95,11 +100,15 @@ class Entity:
         self._x = x
         self.rect[0] = int(x)
         self._last_vel = (0, 0)
+        if self._cell_index is not None:
+            self._cell_index.update(self)
     
     def set_y(self, y):
         self._y = y
         self.rect[1] = int(y)
         self._last_vel = (0, 0)
+        if self._cell_index is not None:
+            self._cell_index.update(self)
 
     def valid_to_stand_on(self, world, x, y):
         return not world.is_solid_at(x, y) and world.get_geo_at(x, y) != World.EMPTY
@@ -558,6 +567,9 @@ class LightEmitterAnimation(AnimationEntity):
         l_range = self.end_light - self.start_light
         return int(self.start_light + self.get_progress() * l_range)
 
+    def emits_light(self):
+        return True
+
 
 class FloatingTextEntity(Entity):
 
@@ -716,6 +728,9 @@ class ActorEntity(Entity):
     def get_light_level(self):
         return self.get_actor_state().light_level()
 
+    def emits_light(self):
+        return True
+
     def set_vel(self, vel):
         """this doesn't move the actor or anything. just sets self._last_vel to whatever"""
         self._last_vel = vel
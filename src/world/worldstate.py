@@ -1,5 +1,9 @@
+import collections
+import heapq
 import random
 
+import numpy
+
 import src.game.spriteref as spriteref
 from src.utils.util import Utils
 import src.utils.colors as colors
@@ -8,6 +12,148 @@ import src.game.constants as constants
 
 CELLSIZE = constants.CELLSIZE  # it's 32
 
+ENTITY_CHUNK_SIZE = 8  # EntityCellIndex also groups entities into chunks of this many cells per side
+
+_LIGHT_FALLOFFS = {}  # light range -> (distances, light levels), arrays of shape (2 * range + 1, 2 * range + 1)
+
+
+def _get_light_falloff(max_dist):
+    """returns: (distance from the center of each cell, light level at each cell) for a source with the given range."""
+    if max_dist not in _LIGHT_FALLOFFS:
+        offsets = numpy.arange(-max_dist, max_dist + 1, dtype=numpy.float64)
+        dists = numpy.sqrt(offsets[:, None] ** 2 + offsets[None, :] ** 2)
+        mult = Utils.bound((max_dist / 6) ** (2 / 3), 0, 1)
+        levels = mult * (1 - numpy.minimum(dists / max_dist, 1) ** 1.5)
+        _LIGHT_FALLOFFS[max_dist] = (dists, levels)
+    return _LIGHT_FALLOFFS[max_dist]
+
+
+class EntityCellIndex:
+    """
+        spatial hash of grid cell -> the entities whose centers are in that cell. entities keep it
+        up to date themselves whenever their position changes (see Entity.set_x and set_y).
+    """
+
+    def __init__(self, cellsize):
+        self._cellsize = cellsize
+        self._cells = {}         # (grid_x, grid_y) -> set of entities
+        self._entity_cells = {}  # entity -> (grid_x, grid_y)
+        self._chunks = {}        # (chunk_x, chunk_y) -> set of entities, see ENTITY_CHUNK_SIZE
+        self._order = {}         # entity -> int, the order entities were added in
+        self._counter = 0
+
+        self.version = 0  # incremented whenever an entity is added, removed, or changes cells
+        self._changes = collections.deque(maxlen=256)  # (version, cell) for each of the latest changes
+
+    def _cell_for(self, entity):
+        cx, cy = entity.center()
+        return (cx // self._cellsize, cy // self._cellsize)
+
+    def add(self, entity):
+        if entity in self._entity_cells:
+            self.remove(entity)
+
+        cell = self._cell_for(entity)
+        self._entity_cells[entity] = cell
+        self._add_to_cell(entity, cell)
+
+        self._order[entity] = self._counter
+        self._counter += 1
+        entity._cell_index = self
+        self.version += 1
+        self._changes.append((self.version, cell))
+
+    def remove(self, entity):
+        if entity not in self._entity_cells:
+            return
+        cell = self._entity_cells.pop(entity)
+        self._discard_from_cell(entity, cell)
+        del self._order[entity]
+        if entity._cell_index is self:
+            entity._cell_index = None
+        self.version += 1
+        self._changes.append((self.version, cell))
+
+    def update(self, entity):
+        """called when an entity's position changes."""
+        old_cell = self._entity_cells.get(entity)
+        if old_cell is None:
+            return
+        new_cell = self._cell_for(entity)
+        if new_cell != old_cell:
+            self._discard_from_cell(entity, old_cell)
+            self._entity_cells[entity] = new_cell
+            self._add_to_cell(entity, new_cell)
+            self.version += 1
+            self._changes.append((self.version, old_cell))
+            self._changes.append((self.version, new_cell))
+
+    def changed_cells_since(self, version):
+        """returns: list of cells that entities entered or left after the given version, or None if it's too old."""
+        if version == self.version:
+            return []
+        elif len(self._changes) == 0 or self._changes[0][0] > version + 1:
+            return None
+        else:
+            return [cell for v, cell in self._changes if v > version]
+
+    @staticmethod
+    def _chunk_for(cell):
+        return (int(cell[0]) // ENTITY_CHUNK_SIZE, int(cell[1]) // ENTITY_CHUNK_SIZE)
+
+    def _add_to_cell(self, entity, cell):
+        if cell not in self._cells:
+            self._cells[cell] = set()
+        self._cells[cell].add(entity)
+
+        chunk = self._chunk_for(cell)
+        if chunk not in self._chunks:
+            self._chunks[chunk] = set()
+        self._chunks[chunk].add(entity)
+
+    def _discard_from_cell(self, entity, cell):
+        in_cell = self._cells[cell]
+        in_cell.discard(entity)
+        if len(in_cell) == 0:
+            del self._cells[cell]
+
+        chunk = self._chunk_for(cell)
+        in_chunk = self._chunks[chunk]
+        in_chunk.discard(entity)
+        if len(in_chunk) == 0:
+            del self._chunks[chunk]
+
+    def get(self, grid_x, grid_y):
+        """returns: list of the entities in the cell, in the order they were added to the index."""
+        in_cell = self._cells.get((grid_x, grid_y))
+        if in_cell is None:
+            return []
+        elif len(in_cell) == 1:
+            return list(in_cell)
+        else:
+            return sorted(in_cell, key=lambda e: self._order[e])
+
+    def get_near_rects(self, grid_rects):
+        """
+            grid_rects: list of [grid_x, grid_y, w, h]
+            returns: list of the entities in the chunks that overlap any of the rects, in the order they were
+                     added to the index. this includes every entity inside the rects, plus some that are near them.
+        """
+        found = set()
+        for rect in grid_rects:
+            x1, y1 = self._chunk_for((rect[0], rect[1]))
+            x2, y2 = self._chunk_for((rect[0] + rect[2] - 1, rect[1] + rect[3] - 1))
+            for chunk_x in range(x1, x2 + 1):
+                for chunk_y in range(y1, y2 + 1):
+                    in_chunk = self._chunks.get((chunk_x, chunk_y))
+                    if in_chunk is not None:
+                        found.update(in_chunk)
+
+        return sorted(found, key=lambda e: self._order[e])
+
+    def __len__(self):
+        return len(self._entity_cells)
+
 
 class World:
     EMPTY = 0
@@ -20,11 +166,15 @@ class World:
     
     def __init__(self, width, height):
         self._size = (width, height)
-        self._level_geo = []
-        self._level_lighting = []  # 0.0 = totally dark, 1.0 = fully lit
-        self._hidden = []
+        # grids are indexed [x, y]
+        self._level_geo = numpy.full((width, height), World.EMPTY, dtype=numpy.uint8)
+        self._level_lighting = numpy.zeros((width, height), dtype=numpy.float32)  # 0.0 = totally dark, 1.0 = fully lit
+        self._hidden = numpy.zeros((width, height), dtype=bool)
 
         self._cached_light_sources = set()  # used to track changes in lighting between updates
+        self._light_maps = {}  # light source -> the light it adds to the cells around it (see _calc_light_map)
+        self._geo_changed_since_lighting = set()  # cells whose geo changed since the lighting was last updated
+        self._geo_changed_since_popped = set()  # cells whose geo changed since pop_geo_changes was last called
 
         self._bg_color = (92, 92, 92)
 
@@ -32,15 +182,31 @@ class World:
         self._dirty_geo = set()
         self._needs_full_geo_rebuild = False
 
-        for _ in range(0, width):
-            self._level_geo.append([World.EMPTY] * height)
-            self._level_lighting.append([0.0] * height)
-            self._hidden.append([False] * height)
+        self._entities = {}  # uid -> entity, in the order they were added
+
+        # sub-indexes of _entities, see _get_sub_indexes
+        self._actors = {}
+        self._players = {}
+        self._npcs = {}
+        self._doors = {}
+        self._light_emitters = {}
 
-        self.entities = []
         self._ents_to_remove = set()
         self._ents_to_add = []
         self._onscreen_entities = set()
+        self._cell_index = EntityCellIndex(CELLSIZE)
+
+        # caches is_blocked for the actor that's currently choosing its action
+        self._turn_count = 0
+        self._geo_version = 0
+        self._blocked_cache = {}  # (grid_x, grid_y) -> bool
+        self._blocked_cache_key = None  # (turn count, geo version, cell index version)
+
+        # the latest distance field, shared by all the enemies pathing towards the player
+        self._player_turn_count = 0
+        self._dist_field = None
+        self._dist_field_key = None  # (target, max_length, geo version, player turn count)
+        self._dist_field_version = 0  # cell index version the field was built at
 
         # actors within this x, y range from player will act
         self._entity_act_range = (9, 8)
@@ -127,19 +293,22 @@ class World:
                         self.remove(dep_ent)
 
     def __contains__(self, entity):
-        return entity in self.entities
+        return entity is not None and entity.get_uid() in self._entities
         
     def get_player(self):
-        for e in self.entities:
-            if e.is_player():
-                return e
+        for e in self._players.values():
+            return e
         return None
 
     def get_npc(self, npc_id):
-        for e in self.entities:
-            if e.is_npc() and e.get_id() == npc_id:
+        for e in self._npcs.values():
+            if e.get_npc_id() == npc_id:
                 return e
         return None
+
+    def get_doors(self):
+        """returns: list of the doors and exits in the world"""
+        return list(self._doors.values())
     
     def entities_in_circle(self, center, radius, onscreen=True, cond=None):
         """
@@ -147,7 +316,7 @@ class World:
         """
         r2 = radius*radius
         res = []
-        search_space = self._onscreen_entities if onscreen else self.entities
+        search_space = self._onscreen_entities if onscreen else self._entities.values()
         for e in search_space:
             if cond is None or cond(e):
                 e_c = e.center()
@@ -173,27 +342,25 @@ class World:
             return None
 
     def get_entity(self, uid, onscreen=True):
-        if onscreen:
-            for e in self._onscreen_entities:
-                if e.get_uid() == uid:
-                    return e
-        else:
-            for e in self.entities:
-                if e.get_uid() == uid:
-                    return e
-        return None
+        e = self._entities.get(uid)
+        if e is not None and onscreen and e not in self._onscreen_entities:
+            return None
+        return e
 
     def all_entities(self, onscreen=False):
         if onscreen:
             for e in self._onscreen_entities:
                 yield e
         else:
-            for e in self.entities:
+            for e in self._entities.values():
                 yield e
 
+    def num_entities(self):
+        return len(self._entities)
+
     def get_light_sources(self, onscreen=True):
         """returns: set of (grid_x, grid_y, int: light_range)"""
-        search_domain = self._onscreen_entities if onscreen else self.entities
+        search_domain = self._onscreen_entities if onscreen else self._light_emitters.values()
         res = set()
         for e in search_domain:
             if e.get_light_level() > 0:
@@ -258,10 +425,13 @@ class World:
 
     def set_geo(self, grid_x, grid_y, geo_id):
         if self.is_valid(grid_x, grid_y):
-            old_geo_id = self._level_geo[grid_x][grid_y]
-            self._level_geo[grid_x][grid_y] = geo_id
+            old_geo_id = int(self._level_geo[grid_x, grid_y])
+            self._level_geo[grid_x, grid_y] = geo_id
 
             if old_geo_id != geo_id:
+                self._geo_version += 1
+                self._geo_changed_since_lighting.add((grid_x, grid_y))
+                self._geo_changed_since_popped.add((grid_x, grid_y))
                 self._dirty_geo.add((grid_x, grid_y))
                 for n in World.ALL_NEIGHBORS:
                     self._dirty_geo.add((grid_x + n[0], grid_y + n[1]))
@@ -275,10 +445,61 @@ class World:
 
     def get_geo(self, grid_x, grid_y):
         if self.is_valid(grid_x, grid_y):
-            return self._level_geo[grid_x][grid_y]
+            return int(self._level_geo[grid_x, grid_y])
         else:
             return World.EMPTY
 
+    def _read_rect(self, grid, grid_rect, fill):
+        """returns: a copy of the grid's values in the rect, with shape (w, h). cells out of bounds get the fill value."""
+        res = numpy.full((grid_rect[2], grid_rect[3]), fill, dtype=grid.dtype)
+        x1, y1 = max(0, grid_rect[0]), max(0, grid_rect[1])
+        x2 = min(self.size()[0], grid_rect[0] + grid_rect[2])
+        y2 = min(self.size()[1], grid_rect[1] + grid_rect[3])
+        if x1 < x2 and y1 < y2:
+            res[x1 - grid_rect[0]:x2 - grid_rect[0], y1 - grid_rect[1]:y2 - grid_rect[1]] = grid[x1:x2, y1:y2]
+        return res
+
+    def get_geo_rect(self, grid_rect):
+        """returns: uint8 array of the geo ids in the rect, indexed [x, y] from the rect's corner."""
+        return self._read_rect(self._level_geo, grid_rect, World.EMPTY)
+
+    def get_hidden_rect(self, grid_rect):
+        """returns: bool array of the hidden flags in the rect, indexed [x, y] from the rect's corner."""
+        return self._read_rect(self._hidden, grid_rect, False)
+
+    def get_lighting_rect(self, grid_rect):
+        """returns: float32 array of the light levels in the rect, indexed [x, y] from the rect's corner."""
+        return self._read_rect(self._level_lighting, grid_rect, 0.0)
+
+    def get_neighbor_masks(self, grid_rect, geo_ids):
+        """
+            the same info as get_neighbor_info, for a whole rect at once.
+            geo_ids: collection of geo ids to look for.
+            returns: int array indexed [x, y] from the rect's corner. bit i of each value is set if the cell's neighbor
+                     at offset World.ALL_NEIGHBORS[i] has one of the geo ids.
+        """
+        w, h = grid_rect[2], grid_rect[3]
+        padded = numpy.isin(self.get_geo_rect([grid_rect[0] - 1, grid_rect[1] - 1, w + 2, h + 2]), geo_ids)
+
+        res = numpy.zeros((w, h), dtype=numpy.int32)
+        for i, (dx, dy) in enumerate(World.ALL_NEIGHBORS):
+            res |= padded[1 + dx:1 + dx + w, 1 + dy:1 + dy + h].astype(numpy.int32) << i
+        return res
+
+    def _add_dirty_cells(self, mask, x_offs=0, y_offs=0):
+        """mask: bool array of cells to mark dirty, indexed [x, y] from (x_offs, y_offs)."""
+        for x, y in zip(*numpy.nonzero(mask)):
+            self._dirty_geo.add((int(x) + x_offs, int(y) + y_offs))
+
+    def pop_geo_changes(self):
+        """
+            returns: set of the cells whose geo changed since the last call. unlike the cells that are dirty for
+                     the WorldView, this doesn't include cells that only changed lighting or visibility.
+        """
+        res = self._geo_changed_since_popped
+        self._geo_changed_since_popped = set()
+        return res
+
     def get_geo_at(self, pixel_x, pixel_y):
         return self.get_geo(pixel_x // self.cellsize(), pixel_y // self.cellsize())
 
@@ -291,7 +512,7 @@ class World:
 
     def get_hidden(self, grid_x, grid_y):
         if self.is_valid(grid_x, grid_y):
-            return self._hidden[grid_x][grid_y]
+            return bool(self._hidden[grid_x, grid_y])
         else:
             return False
 
@@ -310,81 +531,118 @@ class World:
         if not self.is_valid(grid_x, grid_y):
             return 0.0
         else:
-            return self._level_lighting[grid_x][grid_y]
+            return float(self._level_lighting[grid_x, grid_y])
 
-    def _set_lighting(self, grid_x, grid_y, val):
-        if val < 0 or val > 1:
-            raise ValueError("light value out of range: {}".format(val))
+    def _light_rect(self, src):
+        """returns: [x, y, w, h] of the cells a light source of (grid_x, grid_y, range) can reach."""
+        return [src[0] - src[2], src[1] - src[2], 2 * src[2] + 1, 2 * src[2] + 1]
 
-        if not self.is_valid(grid_x, grid_y):
-            return
-        elif self._level_lighting[grid_x][grid_y] == val:
+    def _calc_light_map(self, src):
+        """
+            floods outward from the light source until it hits something solid or runs out of range.
+            src: (grid_x, grid_y, int: light range)
+            returns: array of the light level the source adds to each cell in its _light_rect.
+        """
+        max_dist = src[2]
+        geo = self.get_geo_rect(self._light_rect(src))
+
+        dists, levels = _get_light_falloff(max_dist)
+        in_range = dists <= max_dist
+
+        can_spread = in_range & ~numpy.isin(geo, World.SOLIDS)
+        # it's sometimes expected to have light sources embedded inside solid blocks
+        # (like when the player is walking through a door that's opening...)
+        can_spread[max_dist, max_dist] = True
+
+        reached = numpy.zeros(geo.shape, dtype=bool)
+        reached[max_dist, max_dist] = True
+        n_reached = 1
+        while True:
+            spreading = reached & can_spread
+            reached[1:] |= spreading[:-1]
+            reached[:-1] |= spreading[1:]
+            reached[:, 1:] |= spreading[:, :-1]
+            reached[:, :-1] |= spreading[:, 1:]
+
+            new_n_reached = numpy.count_nonzero(reached)
+            if new_n_reached == n_reached:
+                break
+            n_reached = new_n_reached
+
+        lit = reached & in_range & numpy.isin(geo, (World.FLOOR, World.DOOR))
+        return numpy.where(lit, levels, 0).astype(numpy.float32)
+
+    def _recompose_lighting(self, rect):
+        """sets the lighting in the rect to the brightest light map at each cell."""
+        x1, y1 = max(0, rect[0]), max(0, rect[1])
+        x2, y2 = min(self.size()[0], rect[0] + rect[2]), min(self.size()[1], rect[1] + rect[3])
+        if x1 >= x2 or y1 >= y2:
             return
-        elif self.get_geo(grid_x, grid_y) in (World.FLOOR, World.DOOR):
-            self._dirty_geo.add((grid_x, grid_y))
-            self._level_lighting[grid_x][grid_y] = val
+
+        new_vals = numpy.zeros((x2 - x1, y2 - y1), dtype=numpy.float32)
+        for src in self._light_maps:
+            src_rect = self._light_rect(src)
+            ox1, oy1 = max(x1, src_rect[0]), max(y1, src_rect[1])
+            ox2, oy2 = min(x2, src_rect[0] + src_rect[2]), min(y2, src_rect[1] + src_rect[3])
+            if ox1 < ox2 and oy1 < oy2:
+                light_map = self._light_maps[src]
+                numpy.maximum(new_vals[ox1 - x1:ox2 - x1, oy1 - y1:oy2 - y1],
+                              light_map[ox1 - src_rect[0]:ox2 - src_rect[0], oy1 - src_rect[1]:oy2 - src_rect[1]],
+                              out=new_vals[ox1 - x1:ox2 - x1, oy1 - y1:oy2 - y1])
+
+        old_vals = self._level_lighting[x1:x2, y1:y2]
+        self._add_dirty_cells(new_vals != old_vals, x1, y1)
+        old_vals[:] = new_vals
+
+    def _light_sources_touching(self, sources, cells):
+        """
+            :param sources: list of (grid_x, grid_y, int: light range)
+            :param cells: collection of in-bounds (grid_x, grid_y)
+            returns: bool numpy array of whether each source's light rect contains any of the cells
+        """
+        w, h = self.size()
+        mask = numpy.zeros((w, h), dtype=numpy.int32)
+        mask[tuple(numpy.array(list(cells), dtype=numpy.int32).T)] = 1
+
+        # summed-area table, so each rect's count is four lookups
+        sums = numpy.zeros((w + 1, h + 1), dtype=numpy.int32)
+        sums[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+        sources = numpy.array(sources, dtype=numpy.int32).reshape((-1, 3))
+        x1 = numpy.clip(sources[:, 0] - sources[:, 2], 0, w)
+        y1 = numpy.clip(sources[:, 1] - sources[:, 2], 0, h)
+        x2 = numpy.clip(sources[:, 0] + sources[:, 2] + 1, 0, w)
+        y2 = numpy.clip(sources[:, 1] + sources[:, 2] + 1, 0, h)
+        return sums[x2, y2] - sums[x1, y2] - sums[x2, y1] + sums[x1, y1] > 0
 
     def _recalc_lighting(self, old_lighting, new_lighting):
         """
-        :param old_lighting: set of (grid_x, grid_y, int: light range)
-        :param new_lighting: set of (grid_x, grid_y, int: light range)
+            each light source's contribution is cached, so only the cells that changed sources (or sources near
+            changed geometry) can reach are recalculated.
+            :param old_lighting: set of (grid_x, grid_y, int: light range)
+            :param new_lighting: set of (grid_x, grid_y, int: light range)
         """
+        changed = set(src for src in old_lighting if src not in new_lighting)
+        changed.update(src for src in new_lighting if src not in old_lighting or src not in self._light_maps)
 
-        deleted = []
-        for src in old_lighting:
-            if src not in new_lighting:
-                deleted.append(src)
-
-        for d_src in deleted:
-            grid_x = d_src[0]
-            grid_y = d_src[1]
-            dist = d_src[2]
-
-            for x in range(grid_x - dist, grid_x + dist + 1):
-                for y in range(grid_y - dist, grid_y + dist + 1):
-                    self._set_lighting(x, y, 0.0)
-
-        if len(deleted) == 0:
-            to_add = []
-            for src in new_lighting:
-                if src not in old_lighting:
-                    to_add.append(src)
-        else:
-            to_add = new_lighting
-
-        for src in to_add:
-            grid_x = src[0]
-            grid_y = src[1]
-            max_dist = src[2]
-
-            processed = set()
-            q = [(grid_x, grid_y)]
-            processed.add(q[0])
-            rect = [grid_x - max_dist,
-                    grid_y - max_dist,
-                    2 * max_dist + 1,
-                    2 * max_dist + 1]
-
-            while len(q) > 0:
-                x, y = q.pop()
-
-                xy_dist = Utils.dist((x, y), (grid_x, grid_y))
-                if xy_dist <= max_dist:
-                    mult = Utils.bound((max_dist / 6) ** (2 / 3), 0, 1)
-                    level = mult * (1 - (xy_dist / max_dist) ** 1.5)
-                    if level > self.get_lighting(x, y):
-                        self._set_lighting(x, y, level)
-
-                    # it's sometimes expected to have light sources embedded inside solid blocks
-                    # (like when the player is walking through a door that's opening...)
-                    if (x, y) != (grid_x, grid_y) and self.is_solid(x, y):
-                        continue
-
-                    for n in Utils.neighbors(x, y):
-                        if n not in processed:
-                            if rect[0] <= n[0] < rect[0] + rect[2] and rect[1] <= n[1] < rect[1] + rect[3]:
-                                processed.add(n)
-                                q.append(n)
+        if len(self._geo_changed_since_lighting) > 0:
+            # sources already in changed are being recalculated anyway (e.g. every source, right after worldgen)
+            to_check = [src for src in new_lighting if src not in changed]
+            if len(to_check) > 0:
+                touching = self._light_sources_touching(to_check, self._geo_changed_since_lighting)
+                changed.update(src for src, val in zip(to_check, touching) if val)
+            self._geo_changed_since_lighting.clear()
+
+        for src in changed:
+            if src in self._light_maps:
+                del self._light_maps[src]
+
+        for src in changed:
+            if src in new_lighting and src not in self._light_maps:
+                self._light_maps[src] = self._calc_light_map(src)
+
+        for src in changed:
+            self._recompose_lighting(self._light_rect(src))
 
     def set_bg_color(self, color):
         self._bg_color = color
@@ -401,8 +659,8 @@ class World:
             self._geo_color = color
 
     def set_hidden(self, grid_x, grid_y, val, and_fill_adj_floors=True):
-        if self.get_geo(grid_x, grid_y) == World.FLOOR and self._hidden[grid_x][grid_y] != val:
-            self._hidden[grid_x][grid_y] = val
+        if self.get_geo(grid_x, grid_y) == World.FLOOR and self._hidden[grid_x, grid_y] != val:
+            self._hidden[grid_x, grid_y] = val
             self._dirty_geo.add((grid_x, grid_y))
 
             if and_fill_adj_floors:
@@ -410,10 +668,9 @@ class World:
                     self.set_hidden(grid_x + n[0], grid_y + n[1], val, and_fill_adj_floors=True)
 
     def hide_all_floors(self):
-        for x in range(0, self.size()[0]):
-            for y in range(0, self.size()[1]):
-                if self.get_geo(x, y) == World.FLOOR:
-                    self.set_hidden(x, y, True, and_fill_adj_floors=False)
+        to_hide = (self._level_geo == World.FLOOR) & ~self._hidden
+        self._hidden |= to_hide
+        self._add_dirty_cells(to_hide)
 
     def is_solid_at(self, pixel_x, pixel_y, including_entities=False):
         grid_xy = self.to_grid_coords(pixel_x, pixel_y)
@@ -425,18 +682,96 @@ class World:
             return True
 
         if including_entities:
-            if len(self.get_entities_in_cell(grid_x, grid_y, cond=lambda e: e.is_solid(self))) > 0:
-                return True
+            for e in self._cell_index.get(grid_x, grid_y):
+                if e.is_solid(self):
+                    return True
 
         return False
 
+    def is_blocked(self, grid_x, grid_y):
+        """
+            same as is_solid(grid_x, grid_y, including_entities=True), but the results are cached until the
+            next actor's turn starts (or the geometry or entity positions change).
+        """
+        key = (self._turn_count, self._geo_version, self._cell_index.version)
+        if key != self._blocked_cache_key:
+            self._blocked_cache.clear()
+            self._blocked_cache_key = key
+
+        xy = (grid_x, grid_y)
+        if xy not in self._blocked_cache:
+            self._blocked_cache[xy] = self.is_solid(grid_x, grid_y, including_entities=True)
+        return self._blocked_cache[xy]
+
+    def start_actor_turn(self, actor):
+        """called right before an actor chooses its next action. clears the per-turn caches."""
+        self._turn_count += 1
+        if actor is not None and actor.is_player():
+            # interacting with things (e.g. opening chests) can change what's solid without moving anything
+            self._player_turn_count += 1
+
+    def get_distance_field(self, target, max_length):
+        """
+            target: (int, int) -- grid cell to measure distances to, usually the player's.
+            max_length: int -- max number of steps to search.
+            returns: map of grid cell -> number of steps to the target, for the cells that can reach it without
+                     passing through anything blocked. the field is rebuilt only when the target moves, or when
+                     the geometry or an entity changes within max_length of the target.
+        """
+        key = (target, max_length, self._geo_version, self._player_turn_count)
+        if key == self._dist_field_key:
+            changed = self._cell_index.changed_cells_since(self._dist_field_version)
+            if changed is not None and all(Utils.dist_manhattan(target, c) > max_length for c in changed):
+                self._dist_field_version = self._cell_index.version
+                return self._dist_field
+
+        # breadth-first search outward from the target
+        dists = {target: 0}
+        q = collections.deque([target])
+        while len(q) > 0:
+            cur = q.popleft()
+            n_dist = dists[cur] + 1
+            if n_dist > max_length:
+                continue
+            for n in Utils.neighbors(cur[0], cur[1]):
+                if n not in dists and self.is_valid(*n) and not self.is_blocked(*n):
+                    dists[n] = n_dist
+                    q.append(n)
+
+        self._dist_field = dists
+        self._dist_field_key = key
+        self._dist_field_version = self._cell_index.version
+        return dists
+
+    def get_step_towards(self, grid_xy, target, max_length):
+        """
+            returns: the neighboring cell that's next along a shortest path from grid_xy to target (with ties broken
+                     randomly), or None if there's no path of at most max_length steps. grid_xy itself may be blocked.
+        """
+        if grid_xy == target or Utils.dist_manhattan(grid_xy, target) > max_length:
+            return None
+
+        field = self.get_distance_field(target, max_length)
+
+        best = []
+        best_dist = max_length - 1  # the step itself counts towards max_length
+        for n in Utils.neighbors(grid_xy[0], grid_xy[1]):
+            n_dist = field.get(n)
+            if n_dist is None or n_dist > best_dist:
+                continue
+            elif n_dist < best_dist:
+                best = [n]
+                best_dist = n_dist
+            else:
+                best.append(n)
+
+        return random.choice(best) if len(best) > 0 else None
+
     def get_actor_in_cell(self, grid_x, grid_y):
         """returns: an ActorEntity, if there's an actor entity in the specified cell"""
-        for e in self.entities:
+        for e in self._cell_index.get(grid_x, grid_y):
             if e.is_actor():
-                grid_pos = self.to_grid_coords(e.center()[0], e.center()[1])
-                if grid_x == grid_pos[0] and grid_y == grid_pos[1]:
-                    return e
+                return e
         return None
 
     def get_door_in_cell(self, grid_x, grid_y):
@@ -458,13 +793,7 @@ class World:
             return ents[0]
 
     def get_entities_in_cell(self, grid_x, grid_y, cond=None):
-        res = []
-        for e in self.entities:
-            if cond is None or cond(e):
-                grid_pos = self.to_grid_coords(e.center()[0], e.center()[1])
-                if grid_x == grid_pos[0] and grid_y == grid_pos[1]:
-                    res.append(e)
-        return res
+        return [e for e in self._cell_index.get(grid_x, grid_y) if cond is None or cond(e)]
 
     def get_map_text_for_cells(self, grid_rect, ignore_visiblity=False):
         from src.ui.ui import TextBuilder, TextImage
@@ -484,6 +813,30 @@ class World:
                 if identifier is not None:
                     ent_coords[e_pos] = identifier
 
+        # what to draw at each cell, if there's no entity there
+        padded_rect = [grid_rect[0] - 1, grid_rect[1] - 1, grid_rect[2] + 2, grid_rect[3] + 2]
+        padded_geo = self.get_geo_rect(padded_rect)
+        padded_shown_floor = (padded_geo == World.FLOOR) & ~self.get_hidden_rect(padded_rect)
+
+        geo = padded_geo[1:-1, 1:-1]
+        shown_floor = padded_shown_floor[1:-1, 1:-1]
+        lit = self.get_lighting_rect(grid_rect) > 0
+
+        if ignore_visiblity:
+            shown_walls = numpy.ones(geo.shape, dtype=bool)
+        else:
+            w, h = grid_rect[2], grid_rect[3]
+            shown_walls = numpy.zeros(geo.shape, dtype=bool)
+            for dx, dy in World.ALL_NEIGHBORS:
+                shown_walls |= padded_shown_floor[1 + dx:1 + dx + w, 1 + dy:1 + dy + h]
+
+        cell_chars = numpy.full(geo.shape, -1, dtype=numpy.int8)  # index into map_chars, or -1 for nothing
+        map_chars = [(".", colors.LIGHT_GRAY), (".", colors.DARK_GRAY), ("X", colors.DARK_GRAY), ("0", colors.BLUE)]
+        cell_chars[shown_floor & lit] = 0
+        cell_chars[shown_floor & ~lit] = 1
+        cell_chars[(geo == World.WALL) & shown_walls] = 2
+        cell_chars[(geo == World.DOOR) & shown_walls] = 3
+
         for y in range(grid_rect[1], grid_rect[1] + grid_rect[3]):
             for x in range(grid_rect[0], grid_rect[0] + grid_rect[2]):
                 did_add = False
@@ -492,26 +845,11 @@ class World:
                     res.add(char, color=color)
                     did_add = True
 
-                if not did_add and self.get_geo(x, y) == World.FLOOR:
-                    if not self.get_hidden(x, y):
-                        if self.get_lighting(x, y) > 0:
-                            res.add(".", color=colors.LIGHT_GRAY)
-                        else:
-                            res.add(".", color=colors.DARK_GRAY)
-                        did_add = True
-
-                if not did_add and self.get_geo(x, y) in (World.WALL, World.DOOR):
-                    touching_non_hidden = False
-                    for n in Utils.neighbors(x, y, and_diags=True):
-                        if self.get_geo(*n) == World.FLOOR and not self.get_hidden(*n):
-                            touching_non_hidden = True
-                            break
-                    if touching_non_hidden or ignore_visiblity:
-                        if self.get_geo(x, y) == World.WALL:
-                            res.add("X", color=colors.DARK_GRAY)
-                        else:
-                            res.add("0", color=colors.BLUE)
-                        did_add = True
+                char_idx = cell_chars[x - grid_rect[0], y - grid_rect[1]]
+                if not did_add and char_idx >= 0:
+                    char, color = map_chars[char_idx]
+                    res.add(char, color=color)
+                    did_add = True
 
                 if not did_add:
                     if (x, y) in corners:
@@ -524,6 +862,11 @@ class World:
         return res
 
     def get_path_between(self, p1, p2, max_length=-1, cond=None):
+        """
+            returns: a shortest list of cells from p1 to p2 (inclusive) whose cells all pass cond, or None.
+            nothing in the game calls this anymore, since enemies step along get_distance_field instead. it's
+            only used by worldbench and the tests.
+        """
         if p1 == p2:
             if cond is None or cond(p1):
                 return [p1]
@@ -533,31 +876,43 @@ class World:
         if -1 < max_length < Utils.dist_manhattan(p1, p2):
             return None
 
-        # it's just djikstra's
+        # A* with a manhattan heuristic, which never overestimates on a grid without diagonal moves,
+        # so the paths are as short as a full search's. ties are broken randomly to keep movement varied.
+        def _heuristic(xy):
+            return abs(xy[0] - p2[0]) + abs(xy[1] - p2[1])
+
         dists = {p1: 0}        # pos -> dist
         backrefs = {p1: None}  # pos -> pos
+        rejected = set()       # cells that failed cond or are out of bounds
 
-        q = [p1]
-        while len(q) > 0:
-            cur = q.pop(0)  # O(n) but i ~don't~ care
+        h = _heuristic(p1)
+        heap = [(h, h, random.random(), p1)]  # (dist + heuristic, heuristic, tie breaker, pos)
 
-            n_dist = dists[cur] + 1
-            if n_dist > max_length > -1:
-                continue
+        while len(heap) > 0:
+            f, h, _, cur = heapq.heappop(heap)
+            if cur == p2:
+                break
 
-            neighbors = list(Utils.neighbors(cur[0], cur[1]))
-            random.shuffle(neighbors)
+            cur_dist = f - h
+            if cur_dist > dists[cur]:
+                continue  # already expanded via a shorter route
 
-            for n in neighbors:
-                if n in dists:
+            n_dist = cur_dist + 1
+            for n in Utils.neighbors(cur[0], cur[1]):
+                if n in rejected or (n in dists and dists[n] <= n_dist):
                     continue
-                dists[n] = n_dist
-                if self.is_valid(*n) and (cond is None or cond(n)):
-                    backrefs[n] = cur
-                    q.append(n)
 
-            if p2 in backrefs:
-                break
+                n_h = _heuristic(n)
+                if n_dist + n_h > max_length > -1:
+                    continue
+
+                if not self.is_valid(*n) or (cond is not None and not cond(n)):
+                    rejected.add(n)
+                    continue
+
+                dists[n] = n_dist
+                backrefs[n] = cur
+                heapq.heappush(heap, (n_dist + n_h, n_h, random.random(), n))
 
         if p2 in backrefs:
             res = [p2]  # building the list in reverse
@@ -571,10 +926,7 @@ class World:
             return None
 
     def get_actors(self):
-        res = []
-        for e in self.entities:
-            if e.is_actor():
-                res.append(e)
+        res = list(self._actors.values())
         res.sort(key=lambda a: a.get_uid())
         return res
             
@@ -590,12 +942,68 @@ class World:
     def get_neighbor_info(self, grid_x, grid_y, mapping=lambda x: x):
         return [mapping(self.get_geo(grid_x + offs[0], grid_y + offs[1])) for offs in World.ALL_NEIGHBORS]
 
+    def _get_sub_indexes(self, entity):
+        """returns: the sub-indexes of _entities the entity belongs in."""
+        res = []
+        if entity.is_actor():
+            res.append(self._actors)
+        if entity.is_player():
+            res.append(self._players)
+        if entity.is_npc():
+            res.append(self._npcs)
+        if entity.is_door() or entity.is_exit():
+            res.append(self._doors)
+        if entity.emits_light():
+            res.append(self._light_emitters)
+        return res
+
     def flush_new_entity_additions(self):
         for e in self._ents_to_add:
-            self.entities.append(e)
+            uid = e.get_uid()
+            self._entities[uid] = e
+            for sub_index in self._get_sub_indexes(e):
+                sub_index[uid] = e
+            self._cell_index.add(e)
             e._alive = True
         self._ents_to_add.clear()
 
+    def _get_actors_ready_to_act(self, actors):
+        """
+            if none of the actors are ready to act, gives them all energy (speed() at a time) until at least
+            one of them is. rather than adding it one tick at a time, this jumps straight to the tick when the
+            first actor becomes ready.
+            actors: list of actors that are in range of the player
+            returns: list of the actors that are ready to act, player first and then by uid.
+        """
+        def _turn_order(a):
+            return -1 if a.is_player() else a.get_uid()
+
+        res = [a for a in actors if a.get_actor_state().ready_to_act()]
+        if len(res) > 0 or len(actors) == 0:
+            res.sort(key=_turn_order)
+            return res
+
+        heap = []  # (ticks until ready, turn order, speed, actor)
+        for actor in actors:
+            a_state = actor.get_actor_state()
+            speed = a_state.speed()
+            ticks = max(1, -(-(a_state.max_energy() - a_state.energy()) // speed))
+            heap.append((ticks, _turn_order(actor), speed, actor))
+
+        heapq.heapify(heap)
+        n_ticks = heap[0][0]
+
+        for _, _, speed, actor in heap:
+            a_state = actor.get_actor_state()
+            a_state.set_energy((a_state.energy() + n_ticks * speed) % a_state.max_energy())
+
+        while len(heap) > 0 and heap[0][0] == n_ticks:
+            actor = heapq.heappop(heap)[3]
+            actor.get_actor_state().set_ready_to_act(True)
+            res.append(actor)
+
+        return res
+
     def update_all(self):
         old_lighting = self._cached_light_sources
 
@@ -603,7 +1011,11 @@ class World:
 
         for e in self._ents_to_remove:
             e.cleanup()
-            self.entities.remove(e)  # n^2 but whatever
+            uid = e.get_uid()
+            del self._entities[uid]
+            for sub_index in self._get_sub_indexes(e):
+                del sub_index[uid]
+            self._cell_index.remove(e)
             e._alive = False
             if e in self._onscreen_entities:
                 self._onscreen_entities.remove(e)
@@ -622,7 +1034,19 @@ class World:
         else:
             player_xy = self.to_grid_coords(*Utils.rect_center(cam_rect))
 
-        for e in self.entities:
+        # entities far from the camera and player are asleep (they don't get updated), so
+        # only the ones in nearby chunks of the cell index need to be checked.
+        act_range = self._entity_act_range
+        cam_grid_xy = self.to_grid_coords(cam_rect[0], cam_rect[1])
+        cam_grid_br = self.to_grid_coords(cam_rect[0] + cam_rect[2], cam_rect[1] + cam_rect[3])
+        near_rects = [[cam_grid_xy[0], cam_grid_xy[1],
+                       cam_grid_br[0] - cam_grid_xy[0] + 1, cam_grid_br[1] - cam_grid_xy[1] + 1],
+                      [player_xy[0] - act_range[0], player_xy[1] - act_range[1],
+                       act_range[0] * 2 + 1, act_range[1] * 2 + 1]]
+
+        awake_entities = set()
+
+        for e in self._cell_index.get_near_rects(near_rects):
             on_camera = Utils.rect_contains(cam_rect, e.center())
 
             e_xy = self.to_grid_coords(*e.center())
@@ -633,6 +1057,7 @@ class World:
 
             if on_camera or should_act_if_actor:
                 e.update(self)
+                awake_entities.add(e)
                 self._onscreen_entities.add(e)
 
                 if not gs.get_instance().world_updates_paused():
@@ -647,23 +1072,10 @@ class World:
                             an_actor_is_acting = True
                             gs.get_instance().set_player_turn_to_act(e.is_player())
 
-            elif e in self._onscreen_entities:
-                self._onscreen_entities.remove(e)
+        self._onscreen_entities.intersection_update(awake_entities)
 
         if not gs.get_instance().world_updates_paused() and not an_actor_is_acting:
-            actors_to_process.sort(key=lambda a: -1 if a.is_player() else a.get_uid())
-            actors_ready_to_act = [a for a in actors_to_process if a.get_actor_state().ready_to_act()]
-
-            while len(actors_ready_to_act) == 0 and len(actors_to_process) > 0:
-                for i in range(0, len(actors_to_process)):
-                    actor = actors_to_process[i]
-                    a_state = actor.get_actor_state()
-
-                    if a_state.energy() + a_state.speed() >= a_state.max_energy():
-                        a_state.set_ready_to_act(True)
-                        actors_ready_to_act.append(actor)
-
-                    a_state.set_energy((a_state.energy() + a_state.speed()) % a_state.max_energy())
+            actors_ready_to_act = self._get_actors_ready_to_act(actors_to_process)
 
             for actor in actors_ready_to_act:
                 # if a different actor added a new solid entity this frame as part of its action,
@@ -671,6 +1083,7 @@ class World:
                 self.flush_new_entity_additions()
 
                 a_state = actor.get_actor_state()
+                self.start_actor_turn(actor)
                 action = actor.get_controller().get_actual_next_action(actor, self)
 
                 if actor.is_player():
@@ -707,7 +1120,7 @@ class World:
 
         new_lighting = self.get_light_sources(onscreen=False)
 
-        if old_lighting != new_lighting:
+        if old_lighting != new_lighting or len(self._geo_changed_since_lighting) > 0:
             self._recalc_lighting(old_lighting, new_lighting)
             self._cached_light_sources = new_lighting
 
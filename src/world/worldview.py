@@ -1,5 +1,8 @@
+import collections
 import math
 
+import numpy
+
 import src.game.spriteref as spriteref
 import src.renderengine.img as img
 import src.game.globalstate as gs
@@ -10,14 +13,35 @@ import src.utils.colors as colors
 import src.game.constants as constants
 
 
+# neighbors that connect to walls and floors, for picking their sprites
+WALL_CONNECTING_GEO = (World.WALL, World.DOOR)
+FLOOR_EDGE_GEO = (World.WALL, World.EMPTY, World.DOOR)
+
+# geo bundles are made, shown and hidden a chunk of cells at a time
+GEO_CHUNK_SIZE = 8
+GEO_CHUNK_CACHE_SIZE = 48  # offscreen chunks whose bundles are kept around, in case they come back into view
+GEO_CHUNK_PREFETCHES_PER_FRAME = 2  # chunks ahead of the player that can be built each frame
+
+
 class WorldView:
 
     def __init__(self, world):
         self.world = world
 
-        self._geo_bundle_lookup = {}  # x,y -> ImageBundle
-        self._onscreen_geo_bundles = set()
-        self._dirty_geo_bundles = []
+        # autotile encodings for each cell (see spriteref.get_wall and get_floor), indexed [x, y]
+        self._wall_encodings = None
+        self._floor_encodings = None
+
+        self._geo_bundle_lookup = {}  # x,y -> ImageBundle, for the non-empty cells of built chunks
+        self._onscreen_geo_bundles = set()  # x,y of the bundles that are in the render engine
+        self._dirty_geo_bundles = set()  # x,y of the bundles that changed this frame
+
+        self._chunk_cells = {}  # chunk x,y -> list of the x,y of its bundles, for chunks that have been built
+        self._shown_chunks = {}  # chunk x,y -> the rect its bundles are clipped to (or None), for onscreen chunks
+        self._cached_chunks = collections.OrderedDict()  # built chunks that are offscreen, least recently seen first
+
+        self._last_grid_center = None
+        self._prefetch_dir = (0, 0)
 
         self._onscreen_entities = set()
 
@@ -30,7 +54,20 @@ class WorldView:
         if not self.world.is_valid(grid_x, grid_y):
             return
 
-        bundle = self.get_geo_bundle(grid_x, grid_y)
+        chunk = self._get_chunk(grid_x, grid_y)
+        if chunk not in self._chunk_cells:
+            return  # it'll be up to date when its chunk is built
+
+        bundle = self.get_geo_bundle(grid_x, grid_y, create_if_missing=False)
+        if bundle is None:
+            if self.world.get_geo(grid_x, grid_y) != World.EMPTY:
+                # the cell was empty when its chunk was built
+                self._chunk_cells[chunk].append((grid_x, grid_y))
+                self.get_geo_bundle(grid_x, grid_y, create_if_missing=True)
+                if chunk in self._shown_chunks:
+                    self._show_chunk(chunk, self._shown_chunks[chunk])
+            return
+
         sprite = self.calc_sprite_for_geo(grid_x, grid_y)  # this may be None
 
         if self.world.get_geo(grid_x, grid_y) not in (World.FLOOR, World.DOOR):
@@ -47,16 +84,14 @@ class WorldView:
                                     new_depth=10,
                                     new_color=color)
             self._geo_bundle_lookup[(grid_x, grid_y)] = new_bun
-            self._dirty_geo_bundles.append((grid_x, grid_y))
+            self._dirty_geo_bundles.add((grid_x, grid_y))
 
     def calc_sprite_for_geo(self, grid_x, grid_y):
+        self._update_autotile_encodings()
         geo = self.world.get_geo(grid_x, grid_y)
 
         if geo == World.WALL:
-            def mapping(x): return 1 if x == World.WALL or x == World.DOOR else 0
-            n_info = self.world.get_neighbor_info(grid_x, grid_y, mapping=mapping)
-            mults = [1, 2, 4, 8, 16, 32, 64, 128]
-            wall_img_id = sum(n_info[i] * mults[i] for i in range(0, 8))
+            wall_img_id = int(self._wall_encodings[grid_x, grid_y])
             return spriteref.get_wall(wall_img_id, wall_type_id=self.world.wall_type_at((grid_x, grid_y)))
 
         elif geo == World.DOOR:
@@ -66,16 +101,40 @@ class WorldView:
             if self.world.get_hidden(grid_x, grid_y):
                 return spriteref.floor_hidden
             else:
-                def mapping(x): return 1 if x in (World.WALL, World.EMPTY, World.DOOR) else 0
-                n_info = self.world.get_neighbor_info(grid_x, grid_y, mapping=mapping)
-
-                encoding = 2 * n_info[0] + 4 * n_info[1] + 1 * n_info[7]
+                encoding = int(self._floor_encodings[grid_x, grid_y])
                 lighting = self.world.get_lighting(grid_x, grid_y)
                 floor_id = self.world.floor_type_at((grid_x, grid_y))
                 return spriteref.get_floor(encoding, floor_type_id=floor_id, darkness_level=1-lighting)
 
         return None
 
+    def _update_autotile_encodings(self):
+        """recalculates the encodings around the cells whose geo changed since the last update."""
+        changed = self.world.pop_geo_changes()
+
+        w, h = self.world.size()
+        if self._wall_encodings is None:
+            self._wall_encodings = numpy.zeros((w, h), dtype=numpy.uint8)
+            self._floor_encodings = numpy.zeros((w, h), dtype=numpy.uint8)
+            rect = [0, 0, w, h]
+        elif len(changed) == 0:
+            return
+        else:
+            # a cell's encoding depends on its neighbors, so the changed cells' neighbors need updating too
+            x1 = max(0, min(xy[0] for xy in changed) - 1)
+            y1 = max(0, min(xy[1] for xy in changed) - 1)
+            x2 = min(w, max(xy[0] for xy in changed) + 2)
+            y2 = min(h, max(xy[1] for xy in changed) + 2)
+            rect = [x1, y1, x2 - x1, y2 - y1]
+
+        x1, y1, x2, y2 = rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3]
+
+        self._wall_encodings[x1:x2, y1:y2] = self.world.get_neighbor_masks(rect, WALL_CONNECTING_GEO)
+
+        # floors only care about the neighbors above, to the left, and above-left (see spriteref.get_floor)
+        edges = self.world.get_neighbor_masks(rect, FLOOR_EDGE_GEO)
+        self._floor_encodings[x1:x2, y1:y2] = ((edges & 1) << 1) | ((edges & 2) << 1) | ((edges >> 7) & 1)
+
     def get_geo_bundle(self, grid_x, grid_y, create_if_missing=True):
         key = (grid_x, grid_y)
         if key in self._geo_bundle_lookup:
@@ -120,39 +179,133 @@ class WorldView:
                 1 + 2 * self._max_render_range[0],
                 1 + 2 * self._max_render_range[1]]
 
-    def _update_onscreen_tile_bundles(self):
+    def _get_chunk(self, grid_x, grid_y):
+        return (grid_x // GEO_CHUNK_SIZE, grid_y // GEO_CHUNK_SIZE)
+
+    def _get_chunk_rect(self, chunk):
+        return [chunk[0] * GEO_CHUNK_SIZE, chunk[1] * GEO_CHUNK_SIZE, GEO_CHUNK_SIZE, GEO_CHUNK_SIZE]
+
+    def _get_chunks_in_rect(self, grid_rect):
+        x1, y1 = self._get_chunk(grid_rect[0], grid_rect[1])
+        x2, y2 = self._get_chunk(grid_rect[0] + grid_rect[2] - 1, grid_rect[1] + grid_rect[3] - 1)
+        return [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+    def _build_chunk(self, chunk):
+        """makes the bundles for the chunk's non-empty cells (without adding them to the render engine)."""
+        rect = self._get_chunk_rect(chunk)
+        self._chunk_cells[chunk] = []
+
+        non_empty = self.world.get_geo_rect(rect) != World.EMPTY
+        for x, y in zip(*numpy.nonzero(non_empty)):
+            xy = (int(x) + rect[0], int(y) + rect[1])
+            self._chunk_cells[chunk].append(xy)
+            self.get_geo_bundle(xy[0], xy[1], create_if_missing=True)
+
+    def _show_chunk(self, chunk, clip_rect):
+        """clip_rect: [x, y, w, h] -- if not None, only the chunk's cells inside this rect are shown."""
+        render_eng = RenderEngine.get_instance()
+        for xy in self._chunk_cells[chunk]:
+            should_show = clip_rect is None or Utils.rect_contains(clip_rect, xy)
+            if should_show and xy not in self._onscreen_geo_bundles:
+                self._onscreen_geo_bundles.add(xy)
+                render_eng.update(self._geo_bundle_lookup[xy])
+            elif not should_show and xy in self._onscreen_geo_bundles:
+                self._onscreen_geo_bundles.remove(xy)
+                render_eng.remove(self._geo_bundle_lookup[xy])
+        self._shown_chunks[chunk] = clip_rect
+
+    def _hide_chunk(self, chunk):
+        render_eng = RenderEngine.get_instance()
+        for xy in self._chunk_cells[chunk]:
+            if xy in self._onscreen_geo_bundles:
+                self._onscreen_geo_bundles.remove(xy)
+                render_eng.remove(self._geo_bundle_lookup[xy])
+        del self._shown_chunks[chunk]
+
+    def _cache_chunk(self, chunk):
+        self._cached_chunks[chunk] = None
+        self._cached_chunks.move_to_end(chunk)
+
+        while len(self._cached_chunks) > GEO_CHUNK_CACHE_SIZE:
+            old_chunk, _ = self._cached_chunks.popitem(last=False)
+            for xy in self._chunk_cells[old_chunk]:
+                del self._geo_bundle_lookup[xy]
+            del self._chunk_cells[old_chunk]
+
+    def _clear_geo_bundles(self):
         render_eng = RenderEngine.get_instance()
+        for bun_key in self._onscreen_geo_bundles:
+            render_eng.remove(self._geo_bundle_lookup[bun_key])
+        self._geo_bundle_lookup.clear()
+        self._onscreen_geo_bundles.clear()
+        self._dirty_geo_bundles.clear()
+
+        self._chunk_cells.clear()
+        self._shown_chunks.clear()
+        self._cached_chunks.clear()
 
+    def _update_onscreen_tile_bundles(self):
         grid_rect = self._get_grid_rect_to_render()
+        max_grid_rect = self._get_max_grid_rect_to_render()
 
-        old_onscreen_geo = self._onscreen_geo_bundles
-        new_onscreen_geo = set()
-        for x in range(grid_rect[0], grid_rect[0] + grid_rect[2]):
-            for y in range(grid_rect[1], grid_rect[1] + grid_rect[3]):
-                bun_key = (x, y)
+        visible_chunks = set() if grid_rect is None else set(self._get_chunks_in_rect(grid_rect))
 
-                if bun_key in old_onscreen_geo:
-                    old_onscreen_geo.remove(bun_key)
+        for chunk in list(self._shown_chunks.keys()):
+            if chunk not in visible_chunks:
+                self._hide_chunk(chunk)
+                self._cache_chunk(chunk)
 
-                bun = self.get_geo_bundle(*bun_key, create_if_missing=False)
+        for chunk in visible_chunks:
+            # the render engine culls whatever's off camera, so chunks only need to be clipped to the max render range
+            chunk_rect = self._get_chunk_rect(chunk)
+            if Utils.get_rect_intersect(chunk_rect, max_grid_rect) == chunk_rect:
+                clip_rect = None
+            else:
+                clip_rect = max_grid_rect
 
-                if bun is None and self.world.get_geo(x, y) != World.EMPTY:
-                    bun = self.get_geo_bundle(*bun_key, create_if_missing=True)
+            if chunk in self._shown_chunks and self._shown_chunks[chunk] == clip_rect:
+                continue
+            elif chunk in self._cached_chunks:
+                del self._cached_chunks[chunk]
+            elif chunk not in self._chunk_cells:
+                self._build_chunk(chunk)
 
-                if bun is not None:
-                    new_onscreen_geo.add(bun_key)
-                    if bun_key not in self._onscreen_geo_bundles or bun_key in self._dirty_geo_bundles:
-                        render_eng.update(bun)
+            self._show_chunk(chunk, clip_rect)
 
-        # clear out the bundles that aren't onscreen anymore
-        for bun_key in old_onscreen_geo:
-            expired_bun = self.get_geo_bundle(*bun_key, create_if_missing=False)
-            if expired_bun is not None:
-                render_eng.remove(expired_bun)
-                if bun_key in self._geo_bundle_lookup:
-                    del self._geo_bundle_lookup[bun_key]
+        render_eng = RenderEngine.get_instance()
+        for bun_key in self._dirty_geo_bundles:
+            if bun_key in self._onscreen_geo_bundles:
+                render_eng.update(self._geo_bundle_lookup[bun_key])
+        self._dirty_geo_bundles.clear()
+
+        if grid_rect is not None:
+            self._prefetch_chunks(grid_rect, visible_chunks)
+
+    def _prefetch_chunks(self, grid_rect, visible_chunks):
+        """builds a few of the chunks that are about to come onscreen, in the direction the player is moving."""
+        center = self._get_cam_grid_center()
+        if self._last_grid_center is not None and center != self._last_grid_center:
+            self._prefetch_dir = (Utils.bound(center[0] - self._last_grid_center[0], -1, 1),
+                                  Utils.bound(center[1] - self._last_grid_center[1], -1, 1))
+        self._last_grid_center = center
+
+        if self._prefetch_dir == (0, 0):
+            return
 
-        self._onscreen_geo_bundles = new_onscreen_geo
+        ahead_rect = [grid_rect[0] + self._prefetch_dir[0] * GEO_CHUNK_SIZE,
+                      grid_rect[1] + self._prefetch_dir[1] * GEO_CHUNK_SIZE,
+                      grid_rect[2], grid_rect[3]]
+
+        n_built = 0
+        for chunk in self._get_chunks_in_rect(ahead_rect):
+            if chunk in visible_chunks:
+                continue
+            elif chunk in self._cached_chunks:
+                self._cached_chunks.move_to_end(chunk)
+            elif chunk not in self._chunk_cells and n_built < GEO_CHUNK_PREFETCHES_PER_FRAME:
+                self._build_chunk(chunk)
+                self._cache_chunk(chunk)
+                n_built += 1
 
     def _calc_new_camera_center(self):
         p = self.world.get_player()
@@ -181,10 +334,7 @@ class WorldView:
                 render_eng.remove(bun)
         self._onscreen_entities.clear()
 
-        for bun_key in self._onscreen_geo_bundles:
-            render_eng.remove(self._geo_bundle_lookup[bun_key])
-        self._geo_bundle_lookup.clear()
-        self._onscreen_geo_bundles.clear()
+        self._clear_geo_bundles()
 
         if self._fade_overlay_bundle is not None:
             render_eng.remove(self._fade_overlay_bundle)
@@ -229,8 +379,10 @@ class WorldView:
             leftover_e.cleanup()
         self._onscreen_entities = new_onscreens
 
+        self._update_autotile_encodings()
+
         if self.world._needs_full_geo_rebuild:
-            self._geo_bundle_lookup.clear()
+            self._clear_geo_bundles()
         else:
             for dirty_xy in self.world._dirty_geo:
                 self.update_geo_bundle(dirty_xy[0], dirty_xy[1])
@@ -353,7 +353,7 @@ def build_world(zone_id, spawn_at_save_point=None, spawn_at_door_with_zone_id=No
                     special_spawn_pos = w.to_grid_coords(*e.center())
 
         elif spawn_at_door_with_zone_id is not None:
-            for e in w.all_entities(onscreen=False):
+            for e in w.get_doors():
                 if e.is_exit() and e.get_zone() == spawn_at_door_with_zone_id:
                     special_spawn_pos = w.to_grid_coords(*e.center())
 
@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def game():
+    """initializes the game without a window, sound, or gl context (see renderengine/headless.py)."""
+    import src.game.gameloop as gameloop
+    gameloop.init("Skeletris", headless=True)
+
+
+@pytest.fixture
+def crowded_world(game):
+    """returns: a World with enemies spread around it, and every floor revealed (see worldbench)."""
+    from src.utils.worldbench import build_crowded_world
+    return build_crowded_world("city_3", 80)
@@ -0,0 +1,284 @@
+import random
+
+import numpy
+
+import src.game.balance as balance
+import src.utils.reference as reference
+from src.utils.util import Utils
+from src.world.worldstate import World
+
+
+def _floors(world):
+    w, h = world.size()
+    return [(x, y) for x in range(0, w) for y in range(0, h) if world.get_geo(x, y) == World.FLOOR]
+
+
+def _enemies(world):
+    return [a for a in world.get_actors() if not a.is_player()]
+
+
+def test_cell_queries_match_linear_scan(crowded_world):
+    world = crowded_world
+    rand = random.Random(0)
+    floors = _floors(world)
+    w, h = world.size()
+
+    for step in range(0, 3):
+        for x in range(0, w):
+            for y in range(0, h):
+                assert world.get_entities_in_cell(x, y) == reference.linear_get_entities_in_cell(world, x, y)
+                assert world.get_actor_in_cell(x, y) is reference.linear_get_actor_in_cell(world, x, y)
+                assert (world.is_solid(x, y, including_entities=True) ==
+                        reference.linear_is_solid(world, x, y, including_entities=True))
+
+        # the index has to follow entities around as they move
+        for e in rand.sample(_enemies(world), 20):
+            e.set_center(*world.cell_center(*rand.choice(floors)))
+
+
+def test_a_star_paths_are_as_short_as_bfs(crowded_world):
+    world = crowded_world
+    max_length = balance.ENEMY_SMART_PATHING_RANGE
+    world.start_actor_turn(world.get_player())
+
+    n_found = 0
+    for e in _enemies(world):
+        p1 = world.to_grid_coords(*e.center())
+        for dx in range(-max_length, max_length + 1):
+            for dy in range(-max_length, max_length + 1):
+                p2 = (p1[0] + dx, p1[1] + dy)
+                if abs(dx) + abs(dy) > max_length or world.get_geo(*p2) != World.FLOOR:
+                    continue
+
+                cond = lambda xy: xy == p1 or xy == p2 or not world.is_blocked(*xy)
+                a_star_path = world.get_path_between(p1, p2, max_length=max_length, cond=cond)
+                bfs_path = reference.bfs_get_path_between(world, p1, p2, max_length=max_length, cond=cond)
+
+                if bfs_path is None:
+                    assert a_star_path is None
+                    continue
+
+                assert a_star_path is not None and len(a_star_path) == len(bfs_path)
+                assert a_star_path[0] == p1 and a_star_path[-1] == p2
+                for prev, cur in zip(a_star_path, a_star_path[1:]):
+                    assert Utils.dist_manhattan(prev, cur) == 1 and world.is_valid(*cur) and cond(cur)
+                n_found += 1
+
+    assert n_found > 0
+
+
+def test_steps_towards_the_player_are_as_short_as_a_star(crowded_world):
+    world = crowded_world
+    max_length = balance.ENEMY_SMART_PATHING_RANGE
+    target = world.to_grid_coords(*world.get_player().center())
+    world.start_actor_turn(world.get_player())
+
+    n_steps = 0
+    for pos in _floors(world):
+        if pos == target or Utils.dist_manhattan(pos, target) > max_length:
+            continue
+
+        path = world.get_path_between(pos, target, max_length=max_length,
+                                      cond=lambda xy: xy == target or xy == pos or not world.is_blocked(*xy))
+        step = world.get_step_towards(pos, target, max_length)
+
+        if path is None or len(path) < 2:
+            assert step is None
+        else:
+            assert step is not None and Utils.dist_manhattan(pos, step) == 1
+            field = world.get_distance_field(target, max_length)
+            assert field[step] + 1 == len(path) - 1
+            n_steps += 1
+
+    assert n_steps > 0
+
+
+def test_lighting_matches_full_recompute(crowded_world):
+    world = crowded_world
+    rand = random.Random(0)
+    floors = _floors(world)
+    w, h = world.size()
+
+    sources = set(world._cached_light_sources)
+    for step in range(0, 100):
+        new_sources = set(sources)
+        roll = rand.random()
+        if roll < 0.4 or len(new_sources) == 0:
+            xy = rand.choice(floors)
+            new_sources.add((xy[0], xy[1], rand.randint(1, 8)))
+        elif roll < 0.6:
+            new_sources.remove(rand.choice(sorted(new_sources)))
+        elif roll < 0.8:
+            x, y, dist = rand.choice(sorted(new_sources))
+            new_sources.remove((x, y, dist))
+            dx, dy = rand.choice(World.NEIGHBORS)
+            new_sources.add((x + dx, y + dy, dist))
+        else:
+            # walls going up and coming down near the lights
+            for _ in range(0, rand.randint(1, 4)):
+                x, y = rand.choice(floors)
+                world.set_geo(x, y, World.WALL if world.get_geo(x, y) == World.FLOOR else World.FLOOR)
+
+        world._recalc_lighting(sources, new_sources)
+        sources = new_sources
+
+        grid = [[0.0] * h for _ in range(0, w)]
+        reference.recalc_lighting(world, grid, set(), sources)
+
+        lit_geo = numpy.isin(world._level_geo, (World.FLOOR, World.DOOR))
+        diff = numpy.abs(world._level_lighting - numpy.array(grid))
+        assert numpy.max(diff[lit_geo]) < 1e-6, "lighting differs at step {}".format(step)
+
+
+def test_near_rects_include_every_entity_in_order(crowded_world):
+    world = crowded_world
+    rand = random.Random(0)
+    w, h = world.size()
+    index = world._cell_index
+    order = {e: i for i, e in enumerate(world.all_entities())}
+
+    for _ in range(0, 200):
+        rects = []
+        for _ in range(0, rand.randint(1, 2)):
+            rect_w, rect_h = rand.randint(1, 30), rand.randint(1, 20)
+            rects.append([rand.randint(-rect_w, w), rand.randint(-rect_h, h), rect_w, rect_h])
+
+        res = index.get_near_rects(rects)
+        assert set(reference.scan_entities_in_rects(world, rects)).issubset(res)
+        assert [order[e] for e in res] == sorted(order[e] for e in res)
+
+
+def test_entity_sub_indexes_match_scan(crowded_world):
+    world = crowded_world
+
+    def _check():
+        all_ents = list(world.all_entities())
+        assert world.get_actors() == sorted([e for e in all_ents if e.is_actor()], key=lambda e: e.get_uid())
+        assert set(world.get_doors()) == set(e for e in all_ents if e.is_door() or e.is_exit())
+        assert world.get_player() is [e for e in all_ents if e.is_player()][0]
+        assert world.num_entities() == len(all_ents)
+
+        lights = set()
+        for e in all_ents:
+            if e.get_light_level() > 0:
+                xy = world.to_grid_coords(*e.center())
+                lights.add((xy[0], xy[1], e.get_light_level()))
+        assert world.get_light_sources(onscreen=False) == lights
+
+        for e in all_ents:
+            assert e in world and world.get_entity(e.get_uid(), onscreen=False) is e
+
+    _check()
+
+    removed = _enemies(world)[::3]
+    for e in removed:
+        world.remove(e)
+    world.update_all()
+    assert all(e not in world for e in removed)
+    _check()
+
+
+def test_turn_order_matches_energy_loop(crowded_world):
+    world = crowded_world
+    actors = world.get_actors()
+    start_states = {a: (a.get_actor_state().energy(), a.get_actor_state().ready_to_act()) for a in actors}
+
+    def _play_turns(get_ready):
+        rand = random.Random(0)
+        for a in actors:
+            a.get_actor_state().set_energy(start_states[a][0])
+            a.get_actor_state().set_ready_to_act(start_states[a][1])
+
+        turns = []
+        for _ in range(0, 500):
+            # a random subset of actors is in range of the player each turn
+            in_range = [a for a in actors if rand.random() < 0.8]
+            rand.shuffle(in_range)
+
+            ready = get_ready(in_range)
+            if len(ready) > 0:
+                ready[0].get_actor_state().set_ready_to_act(False)
+            if rand.random() < 0.1:
+                victim = rand.choice(actors).get_actor_state()
+                victim.set_energy(rand.randint(0, victim.max_energy() - 1))
+
+            turns.append(tuple(a.get_uid() for a in ready))
+            turns.append(tuple(a.get_actor_state().energy() for a in actors))
+        return turns
+
+    expected = _play_turns(lambda in_range: reference.loop_get_actors_ready_to_act(world, in_range))
+    assert _play_turns(world._get_actors_ready_to_act) == expected
+    assert _play_turns(world._get_actors_ready_to_act) == expected
+
+
+def test_cached_stats_match_uncached(crowded_world):
+    from src.game.stats import StatTypes
+    import src.game.statuseffects as statuseffects
+    from src.items.item import ItemTypes
+    from src.items.itemgen import ItemFactory
+
+    world = crowded_world
+    rand = random.Random(0)
+    actors = world.get_actors()
+    all_stat_types = list(StatTypes.all_types())
+    all_effects = [e for e in vars(statuseffects.StatusEffectTypes).values()
+                   if isinstance(e, statuseffects.StatusEffectType)]
+
+    player_state = world.get_player().get_actor_state()
+    random.seed(0)
+    for _ in range(0, 4):
+        player_state.inventory().add_to_equipment(ItemFactory.gen_item(3, item_type=ItemTypes.STAT_CUBE_5))
+
+    equip_grid = player_state.inventory().get_equip_grid()
+    start_equipment = [(item, equip_grid.get_pos(item)) for item in equip_grid.all_items()]
+
+    assert len(start_equipment) > 0
+
+    for _ in range(0, 1000):
+        a_state = rand.choice(actors).get_actor_state()
+        roll = rand.random()
+        if roll < 0.3:
+            a_state.try_to_add_status_effect(rand.choice(all_effects), rand.randint(1, 3))
+        elif roll < 0.6:
+            a_state.countdown_status_effects()
+        elif roll < 0.65:
+            a_state.clear_all_status_effects()
+        elif roll < 0.8:
+            item, pos = rand.choice(start_equipment)
+            if item in equip_grid:
+                equip_grid.remove(item)
+            else:
+                equip_grid.place(item, pos)
+            a_state = player_state
+
+        for stat_type in all_stat_types:
+            for local in (False, True):
+                assert (a_state.stat_value(stat_type, local=local) ==
+                        reference.uncached_stat_value(a_state, stat_type, local=local))
+
+
+def test_autotile_encodings_follow_geo_changes(crowded_world):
+    from src.world.worldview import WorldView
+
+    world = crowded_world
+    rand = random.Random(0)
+    floors = _floors(world)
+    view = WorldView(world)
+    view._update_autotile_encodings()
+
+    for _ in range(0, 20):
+        for _ in range(0, rand.randint(1, 4)):
+            x, y = rand.choice(floors)
+            world.set_geo(x, y, World.WALL if world.get_geo(x, y) == World.FLOOR else World.FLOOR)
+
+        # cells that are only dirty from visibility shouldn't count as geo changes
+        x, y = rand.choice(floors)
+        world.set_hidden(x, y, not world.get_hidden(x, y), and_fill_adj_floors=False)
+
+        view._update_autotile_encodings()
+        assert len(world.pop_geo_changes()) == 0
+
+        rebuilt = WorldView(world)
+        rebuilt._update_autotile_encodings()
+        assert numpy.array_equal(view._wall_encodings, rebuilt._wall_encodings)
+        assert numpy.array_equal(view._floor_encodings, rebuilt._floor_encodings)